@@ -21,4 +21,6 @@ from .compiler import Compiler, KaldiRule
 from .wrapper import KaldiAgfNNet3Decoder, KaldiLafNNet3Decoder, KaldiPlainNNet3Decoder
 from .wfst import NativeWFST, WFST
 from .plain_dictation import PlainDictationRecognizer
+from .alternative_dictation import AlternativeDictationClient, AlternativeDictationServer
+from .vad import EndpointedDecoder, VADEndpointer
 from .utils import disable_donation_message
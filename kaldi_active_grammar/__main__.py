@@ -5,6 +5,7 @@
 #
 
 import logging, os.path, shutil
+from io import open
 
 from six import print_
 
@@ -19,14 +20,25 @@ def main():
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('-m', '--model_dir')
     parser.add_argument('-t', '--tmp_dir')
+    parser.add_argument('--num_rules', type=int, help="number of rule nonterminals for convert_generic_model_to_agf")
+    parser.add_argument('--host', default='127.0.0.1', help="host for serve_alternative_dictation")
+    parser.add_argument('--port', type=int, default=0, help="port for serve_alternative_dictation (default: any free port)")
+    parser.add_argument('--force', action='store_true', help="rebuild dictation graphs, even if unchanged")
+    parser.add_argument('--target_ngrams', type=int, help="prune to at most this many n-grams for compile_reduced_dictation_graph")
+    parser.add_argument('--prune_threshold', type=float, help="prune n-grams increasing perplexity relatively by less than this for compile_reduced_dictation_graph")
+    parser.add_argument('--vocabulary', help="file of words (one per line) to restrict to for compile_reduced_dictation_graph")
+    parser.add_argument('--plain', action='store_true', help="build a plain HCLG.fst for compile_reduced_dictation_graph")
+    parser.add_argument('--test_set', help="file of wav filename & transcript per line, to report WER for compile_reduced_dictation_graph")
     parser.add_argument('command', choices=[
         'compile_agf_dictation_graph',
         'compile_plain_dictation_graph',
+        'compile_reduced_dictation_graph',
         'convert_generic_model_to_agf',
         'add_word',
         'generate_lexicon_files',
         'reset_user_lexicon',
         'generate_words_relabeled_file',
+        'serve_alternative_dictation',
     ])
     # FIXME: helps
     # FIXME: subparsers?
@@ -38,19 +50,50 @@ def main():
         compiler = Compiler(args.model_dir, args.tmp_dir)
         g_filename = unknown.pop(0) if unknown else None
         print_("Compiling dictation graph...")
-        compiler.compile_agf_dictation_fst(g_filename=g_filename)
+        print_report(compiler.compile_agf_dictation_fst(g_filename=g_filename, force=args.force))
 
     if args.command == 'compile_plain_dictation_graph':
         compiler = Compiler(args.model_dir, args.tmp_dir)
         g_filename = unknown.pop(0) if unknown else None
         output_filename = unknown.pop(0) if unknown else None
         print_("Compiling plain dictation graph...")
-        compiler.compile_plain_dictation_fst(g_filename=g_filename, output_filename=output_filename)
+        print_report(compiler.compile_plain_dictation_fst(g_filename=g_filename, output_filename=output_filename, force=args.force))
+
+    if args.command == 'compile_reduced_dictation_graph':
+        if not unknown: parser.error("ARPA language model file required for %s" % args.command)
+        compiler = Compiler(args.model_dir, args.tmp_dir)
+        arpa_filename = unknown.pop(0)
+        output_filename = unknown.pop(0) if unknown else None
+        vocabulary = None
+        if args.vocabulary:
+            with open(args.vocabulary, 'r', encoding='utf-8') as f:
+                vocabulary = set(line.split()[0] for line in f if line.strip())
+        print_("Compiling reduced dictation graph...")
+        result = compiler.compile_reduced_dictation_fst(arpa_filename, output_filename=output_filename, target_num_ngrams=args.target_ngrams,
+            prune_threshold=args.prune_threshold, vocabulary=vocabulary, plain=args.plain, force=args.force)
+        print_report(result['build_report'])
+        print_("N-grams: %s -> %s (%d words removed)" % ('/'.join(map(str, result['num_ngrams_before'])),
+            '/'.join(map(str, result['num_ngrams'])), result['num_removed_words']))
+        print_("G.fst: %s (%.1f MB)" % (result['g_filename'], result['g_size_mb']))
+        print_("Graph: %s (%.1f MB)" % (result['output_filename'], result['graph_size_mb']))
+
+        if args.test_set:
+            from .dictation_graph import evaluate_dictation_graph, read_test_set
+            test_set = read_test_set(args.test_set)
+            baseline_filename = compiler._plain_dictation_hclg_fst_filepath if args.plain else compiler._dictation_fst_filepath
+            compiler.close()
+            print_("%-10s %10s %8s %10s" % ("graph", "size (MB)", "WER", "time (s)"))
+            for name, graph_filename in [('baseline', baseline_filename), ('reduced', result['output_filename'])]:
+                if not os.path.isfile(graph_filename):
+                    print_("%-10s (missing %s)" % (name, graph_filename))
+                    continue
+                evaluation = evaluate_dictation_graph(graph_filename, test_set, plain=args.plain, model_dir=args.model_dir, tmp_dir=args.tmp_dir)
+                print_("%-10s %10.1f %7.2f%% %10.1f" % (name, evaluation['graph_size_mb'], 100 * evaluation['wer'], evaluation['seconds']))
 
     if args.command == 'convert_generic_model_to_agf':
         # if not args.model_dir: parser.error("MODEL_DIR required for %s" % args.command)
         file = unknown[0]
-        convert_generic_model_to_agf(file, args.model_dir)
+        convert_generic_model_to_agf(file, args.model_dir, num_rules=args.num_rules)
 
     if args.command == 'add_word':
         word = unknown[0]
@@ -71,5 +114,23 @@ def main():
         Model.generate_words_relabeled_file(*unknown)
         print_("Generated words_relabeled file")
 
+    if args.command == 'serve_alternative_dictation':
+        from .alternative_dictation import AlternativeDictationServer
+        server = AlternativeDictationServer(host=args.host, port=args.port, model_dir=args.model_dir, tmp_dir=args.tmp_dir)
+        print_("Serving alternative dictation at %s" % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+
+def print_report(report):
+    if report['skipped']:
+        print_("  skipped (unchanged)")
+    else:
+        peak_memory = ('%.0f MB' % report['peak_memory_mb']) if report['peak_memory_mb'] is not None else 'unknown'
+        print_("  %.1f s   peak memory %s" % (report['seconds'], peak_memory))
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,319 @@
+#
+# This file is part of kaldi-active-grammar.
+# (c) Copyright 2019 by David Zurow
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Client and local stand-in server for alternative dictation over HTTP.
+
+Protocol: ``POST /recognize`` with body the concatenated ``int16`` audio of one or more spans, header ``X-Audio-Lengths``
+the comma-separated byte length of each, and headers ``X-Sample-Rate`` and ``X-Num-Channels`` (interleaved); the response
+is JSON ``{"texts": [...], "decode_ms": [...]}`` with one entry per span. Connections are kept alive (HTTP/1.1).
+"""
+
+import http.client, http.server, json, queue, socketserver, statistics, threading, time
+import concurrent.futures
+from urllib.parse import urlsplit
+
+from . import _log, KaldiError
+from .utils import clock
+
+_log = _log.getChild('alternative_dictation')
+
+
+########################################################################################################################
+
+class LatencyMetrics(object):
+    """ Thread-safe collection of latency samples (in seconds) by name. """
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._samples = dict()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(name, [])
+            samples.append(seconds)
+            if len(samples) > self.max_samples:
+                del samples[:len(samples) - self.max_samples]
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self):
+        """ Returns dict of name -> dict(count, mean_ms, p50_ms, p95_ms, max_ms), over the most recent samples. """
+        with self._lock:
+            samples_by_name = { name: sorted(samples) for (name, samples) in self._samples.items() }
+        return { name: {
+                'count': len(samples),
+                'mean_ms': 1000 * statistics.mean(samples),
+                'p50_ms': 1000 * samples[(len(samples) - 1) // 2],
+                'p95_ms': 1000 * samples[int(0.95 * (len(samples) - 1))],
+                'max_ms': 1000 * samples[-1],
+            } for (name, samples) in samples_by_name.items() if samples }
+
+
+########################################################################################################################
+
+class AlternativeDictationClient(object):
+    """
+    Callable for ``Compiler(alternative_dictation=...)`` that sends each span's audio to an alternative dictation server.
+
+    Keeps a pool of persistent connections, so there is no per-utterance connection setup, and batches spans submitted
+    concurrently (e.g. with ``Compiler(alternative_dictation_parallel=True)``) within ``batch_window`` seconds into a
+    single request. Latencies are recorded in ``metrics``: ``queue`` (waiting for the batch to be sent), ``request``
+    (round trip), ``decode`` (server-side), and ``total`` (per span). The audio format sent to the server is that of the
+    Compiler's decoder, set by ``Compiler.init_decoder`` via ``set_audio_format``.
+    """
+
+    def __init__(self, url, timeout=10.0, pool_size=4, batch_window=0.005, max_batch_size=8, sample_rate=16000, num_channels=1):
+        parts = urlsplit(url if '//' in url else ('http://' + url))
+        if parts.scheme not in ('http', 'https'): raise KaldiError("unsupported alternative dictation url: %r" % url)
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip('/') + '/recognize'
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.sample_rate = int(sample_rate)
+        self.num_channels = int(num_channels)
+        self.metrics = LatencyMetrics()
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._pending = []  # (audio_data, future, enqueue_time)
+        self._pending_lock = threading.Lock()
+
+    def set_audio_format(self, sample_rate, num_channels):
+        """ Sets the format of the audio that will be passed to us (as passed to the decoder). """
+        self.sample_rate = int(sample_rate)
+        self.num_channels = int(num_channels)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __call__(self, audio_data):
+        """ Returns the recognized text for ``audio_data`` (bytes-like in ``int16`` format). """
+        start_time = clock()
+        future = concurrent.futures.Future()
+        with self._pending_lock:
+            self._pending.append((bytes(audio_data), future, start_time))
+            is_leader = (len(self._pending) == 1)
+        if is_leader:
+            # First span of a batch: give concurrent spans a chance to join, then send everything pending
+            if self.batch_window:
+                time.sleep(self.batch_window)
+            self._send_pending()
+        text = future.result(timeout=self.timeout)
+        self.metrics.record('total', clock() - start_time)
+        return text
+
+    def recognize_batch(self, audio_datas):
+        """ Returns list of recognized texts for each of ``audio_datas``, in a single request. """
+        texts, decode_times = self._request([bytes(audio_data) for audio_data in audio_datas])
+        return texts
+
+    def _send_pending(self):
+        while True:
+            with self._pending_lock:
+                batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            if not batch:
+                return
+            send_time = clock()
+            for (audio_data, future, enqueue_time) in batch:
+                self.metrics.record('queue', send_time - enqueue_time)
+            try:
+                texts, decode_times = self._request([audio_data for (audio_data, future, enqueue_time) in batch])
+            except Exception as e:
+                for (audio_data, future, enqueue_time) in batch:
+                    future.set_exception(e)
+            else:
+                for (audio_data, future, enqueue_time), text in zip(batch, texts):
+                    future.set_result(text)
+
+    def _request(self, audio_datas):
+        body = b''.join(audio_datas)
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Audio-Lengths': ','.join(str(len(audio_data)) for audio_data in audio_datas),
+            'X-Sample-Rate': str(self.sample_rate),
+            'X-Num-Channels': str(self.num_channels),
+        }
+        start_time = clock()
+        for attempt in range(2):
+            pooled_connection = self._get_pooled_connection() if not attempt else None
+            connection = pooled_connection or self._new_connection()
+            try:
+                connection.request('POST', self.path, body=body, headers=headers)
+                response = connection.getresponse()
+                response_body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                # Server closed an idle pooled connection before it got our request; retry once on a fresh one
+                if pooled_connection is not None: continue
+                raise KaldiError("alternative dictation request failed: %s" % e)
+            except (http.client.HTTPException, OSError) as e:
+                # Including timeouts: never resend, since the server may already be decoding the request
+                connection.close()
+                raise KaldiError("alternative dictation request failed: %s" % e)
+            if response.status != 200:
+                connection.close()
+                raise KaldiError("alternative dictation server error %d: %s" % (response.status, response_body[:200]))
+            self._put_connection(connection)
+            break
+        self.metrics.record('request', clock() - start_time)
+
+        result = json.loads(response_body.decode('utf-8'))
+        texts, decode_times = result['texts'], result.get('decode_ms', [])
+        if len(texts) != len(audio_datas): raise KaldiError("alternative dictation server returned wrong number of texts")
+        for decode_ms in decode_times:
+            self.metrics.record('decode', decode_ms / 1000.0)
+        return texts, decode_times
+
+    def _get_pooled_connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _new_connection(self):
+        return self._connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _put_connection(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+
+########################################################################################################################
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Same as http.server.ThreadingHTTPServer, which requires Python 3.7+. """
+    daemon_threads = True
+
+class AlternativeDictationServer(object):
+    """
+    Local stand-in alternative dictation server, serving the protocol of AlternativeDictationClient by decoding each span
+    with a (second) recognizer, by default a PlainDictationRecognizer. Useful for testing offline and for measuring the
+    latency budget of alternative dictation without an external engine.
+    """
+
+    def __init__(self, recognizer=None, host='127.0.0.1', port=0, model_dir=None, tmp_dir=None):
+        """
+        Args:
+            recognizer: optional object with ``decode_utterance(samples_data) -> (text, info)``; default is a new PlainDictationRecognizer (owned by the server)
+            port (int): port to listen on; 0 picks a free one (see ``url``)
+        """
+        self._owns_recognizer = (recognizer is None)
+        if recognizer is None:
+            from .plain_dictation import PlainDictationRecognizer
+            recognizer = PlainDictationRecognizer(model_dir=model_dir, tmp_dir=tmp_dir)
+        self.recognizer = recognizer
+        self._recognizer_lock = threading.Lock()  # Decoders are not thread-safe
+        self._thread = None
+        self._httpd = _ThreadingHTTPServer((host, port), self._make_handler_class())
+
+    host = property(lambda self: self._httpd.server_address[0])
+    port = property(lambda self: self._httpd.server_address[1])
+    url = property(lambda self: 'http://%s:%d' % (self.host, self.port))
+
+    def recognize(self, audio_data):
+        """ Returns (text, decode time in seconds) for ``audio_data``. """
+        with self._recognizer_lock:
+            start_time = clock()
+            text, info = self.recognizer.decode_utterance(audio_data)
+            return text, clock() - start_time
+
+    def check_audio_format(self, sample_rate, num_channels):
+        """ Raises ValueError if the recognizer's decoder (if it has one) does not decode audio of the given format. """
+        decoder = getattr(self.recognizer, 'decoder', None)
+        if decoder is None:
+            return
+        if sample_rate is not None and sample_rate != decoder.sample_rate:
+            raise ValueError("X-Sample-Rate %d does not match the recognizer's %d" % (sample_rate, decoder.sample_rate))
+        if num_channels != decoder.num_channels:
+            raise ValueError("X-Num-Channels %d does not match the recognizer's %d" % (num_channels, decoder.num_channels))
+
+    def _make_handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.rstrip('/').split('/')[-1] != 'recognize':
+                    return self._respond(404, {'error': 'not found'})
+                try:
+                    lengths = [int(length) for length in self.headers.get('X-Audio-Lengths', str(len(body))).split(',') if length]
+                    if sum(lengths) != len(body): raise ValueError("X-Audio-Lengths does not match body")
+                    server.check_audio_format(int(self.headers['X-Sample-Rate']) if 'X-Sample-Rate' in self.headers else None,
+                        int(self.headers.get('X-Num-Channels', 1)))
+                    texts, decode_ms = [], []
+                    offset = 0
+                    for length in lengths:
+                        text, decode_time = server.recognize(body[offset : offset + length])
+                        texts.append(text)
+                        decode_ms.append(1000 * decode_time)
+                        offset += length
+                except Exception as e:
+                    _log.exception("%s: error handling request", server)
+                    return self._respond(400, {'error': str(e)})
+                self._respond(200, {'texts': texts, 'decode_ms': decode_ms})
+
+            def _respond(self, status, result):
+                data = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                _log.log(5, "%s: " + format, server, *args)
+
+        return Handler
+
+    def start(self):
+        """ Serve in a background thread. """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._httpd.serve_forever, name='kaldi_alternative_dictation_server', daemon=True)
+            self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def close(self):
+        httpd, self._httpd = self._httpd, None
+        if httpd is not None:
+            if self._thread is not None:
+                httpd.shutdown()
+                self._thread.join()
+                self._thread = None
+            httpd.server_close()
+        recognizer, self.recognizer = self.recognizer, None
+        if recognizer is not None and self._owns_recognizer:
+            recognizer.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.url if self._httpd is not None else 'closed')
@@ -4,18 +4,20 @@
 # Licensed under the AGPL-3.0; see LICENSE.txt file.
 #
 
-import collections, copy, logging, multiprocessing, os, re, shlex, shutil, subprocess, threading
-import concurrent.futures
+import asyncio, collections, copy, inspect, logging, multiprocessing, os, re, shlex, shutil, subprocess, threading
+import concurrent.futures, functools
 from contextlib import contextmanager
 from io import open
 
 from six.moves import range, zip
+import numpy as np
 
 from . import _log, KaldiError
-from .utils import ExternalProcess, debug_timer, platform, show_donation_message
+from .utils import ExternalProcess, clock, debug_timer, platform, show_donation_message
 from .wfst import WFST, NativeWFST, SymbolTable
-from .model import Model
-from .wrapper import KaldiAgfCompiler, KaldiAgfNNet3Decoder, KaldiLafNNet3Decoder
+from .model import Model, make_nonterminals
+from .dictation_graph import ArpaLanguageModel, DictationGraphBuilder
+from .wrapper import KaldiAgfCompiler, KaldiAgfNNet3Decoder, KaldiLafNNet3Decoder, active_grammar_ids, is_sparse_grammars_activity
 import kaldi_active_grammar.defaults as defaults
 
 _log = _log.getChild('compiler')
@@ -27,19 +29,24 @@ class KaldiRule(object):
 
     cls_lock = threading.Lock()
 
-    def __init__(self, compiler, name, nonterm=True, has_dictation=None, is_complex=None):
+    def __init__(self, compiler, name, nonterm=True, has_dictation=None, is_complex=None, subgrammar=False):
         """
         :param nonterm: bool whether rule represents a nonterminal in the active-grammar-fst (only False for the top FST?)
+        :param subgrammar: bool whether rule is only a sub-graph referenced from other rules (e.g. a list), via add_subgrammar_arc(), and is not recognized on its own
         """
         self.compiler = compiler
         self.name = name
         self.nonterm = nonterm
         self.has_dictation = has_dictation
         self.is_complex = is_complex
+        self.subgrammar = bool(subgrammar)
+        if self.subgrammar and not self.nonterm: raise KaldiError("subgrammar KaldiRule must be a nonterm")
 
         # id: matches "nonterm:rule__"; 0-based; can/will change due to rule unloading!
         self.id = int(self.compiler.alloc_rule_id() if nonterm else -1)
-        if self.id > self.compiler._max_rule_id: raise KaldiError("KaldiRule id > compiler._max_rule_id")
+        if self.id > self.compiler._max_rule_id:
+            self.compiler.free_rule_id()
+            raise KaldiError("KaldiRule id > compiler._max_rule_id (max_num_rules=%d)" % self.compiler.max_num_rules)
         if self.id in self.compiler.kaldi_rule_by_id_dict: raise KaldiError("KaldiRule id already in use")
         if self.id >= 0:
             self.compiler.kaldi_rule_by_id_dict[self.id] = self
@@ -51,22 +58,30 @@ class KaldiRule(object):
         self.reloading = False  # KaldiRule is in the process of the reload contextmanager
         self.has_been_loaded = False  # KaldiRule was loaded, then reload() was called & completed, and now it is not currently loaded, and load() we need to call the decoder's reload
         self.destroyed = False  # KaldiRule must not be used/referenced anymore
+        self.resident = False  # KaldiRule's real compiled graph is in the decoder (rather than the placeholder)
+        self.last_active_time = None
+        self.compile_future = None  # concurrent.futures.Future of background compilation (with compiler.background_compilation)
+        self._staged_fst = None  # New version of our FST being compiled by staged_reload(), to be swapped in when ready
+        self.staged_future = None
 
         # Public
         self.fst = WFST() if not self.compiler.native_fst else NativeWFST()
         self.matcher = None
         self.active = True
+        self.subgrammar_rules = set()  # subgrammar KaldiRules referenced by our FST
 
     def __repr__(self):
         return "%s(%s, %s)" % (self.__class__.__name__, self.id, self.name)
 
+    nonterm_label = property(lambda self: '#nonterm:rule%d' % self.id)
     fst_cache = property(lambda self: self.compiler.fst_cache)
     decoder = property(lambda self: self.compiler.decoder)
 
     pending_compile = property(lambda self: (self in self.compiler.compile_queue) or (self in self.compiler.compile_duplicate_filename_queue))
     pending_load = property(lambda self: self in self.compiler.load_queue)
 
-    fst_wrapper = property(lambda self: self.fst if self.fst.native else self.filepath)
+    # Prefer handing the decoder the compiled graph file, so it is only read (and held) once, by the decoder itself
+    fst_wrapper = property(lambda self: self.fst if (self.fst.native and self.fst.compiled_native_obj is not None) else self.filepath)
     filename = property(lambda self: self.fst.filename)
 
     @property
@@ -75,6 +90,22 @@ class KaldiRule(object):
         assert self.compiler.tmp_dir is not None
         return os.path.join(self.compiler.tmp_dir, self.filename)
 
+    def add_subgrammar_arc(self, src_state, dst_state, subgrammar_rule, fst=None):
+        """
+        Adds arcs to our FST (or the given ``fst``, e.g. in staged_reload()) from src_state to dst_state that match the
+        separately compiled ``subgrammar_rule``, similarly to #nonterm:dictation. So changing the subgrammar (e.g. a list's
+        items) only requires recompiling its own small graph, not ours. The subgrammar must be active whenever we are (see
+        Compiler.add_subgrammar_activity). ``subgrammar_rule`` may also be the name of a shared subgrammar (see
+        Compiler.compile_shared_subgrammar).
+        """
+        if isinstance(subgrammar_rule, str): subgrammar_rule = self.compiler.get_shared_subgrammar(subgrammar_rule)
+        if not subgrammar_rule.subgrammar: raise KaldiError("%s is not a subgrammar KaldiRule" % subgrammar_rule)
+        if fst is None: fst = self.fst
+        return_state = fst.add_state()
+        fst.add_arc(src_state, return_state, subgrammar_rule.nonterm_label)
+        fst.add_arc(return_state, dst_state, None, '#nonterm:end')
+        self.subgrammar_rules.add(subgrammar_rule)
+
     def compile(self, lazy=False, duplicate=None):
         if self.destroyed: raise KaldiError("Cannot use a KaldiRule after calling destroy()")
         if self.compiled: return self
@@ -94,8 +125,8 @@ class KaldiRule(object):
 
         if self.compiler.cache_fsts and self.fst_cache.fst_is_current(self.filepath, touch=True):
             _log.debug("%s: Skipped FST compilation thanks to FileCache" % self)
-            if self.compiler.decoding_framework == 'agf' and self.fst.native:
-                self.fst.compiled_native_obj = NativeWFST.load_file(self.filepath)
+            # The decoder loads the cached graph directly from its file (see fst_wrapper), rather than us first loading a
+            # separate copy into memory here.
             self.compiled = True
             return self
         else:
@@ -109,10 +140,29 @@ class KaldiRule(object):
                     self.compiler.compile_queue.add(self)
                 else:
                     self.compiler.compile_duplicate_filename_queue.add(self)
+            if self.compiler.background_compilation:
+                self._submit_compile()
             return self
 
         return self.finish_compile()
 
+    def _submit_compile(self):
+        """ Starts compiling in the background, exposing its completion as compile_future. """
+        if self.compile_future is not None: return
+        if self in self.compiler.compile_duplicate_filename_queue:
+            # Our graph is being compiled for another rule with identical contents, which will put it in the FileCache
+            self.compile_future = next((kaldi_rule.compile_future for kaldi_rule in self.compiler.compile_queue
+                if kaldi_rule.filename == self.filename and kaldi_rule != self), None)
+        else:
+            self.compile_future = self.compiler.compile_executor.submit(self.finish_compile)
+
+    def _cancel_compile(self):
+        """ Cancels or waits for any background compilation, so we can safely modify/destroy our FST. """
+        compile_future, self.compile_future = self.compile_future, None
+        if compile_future is not None and self not in self.compiler.compile_duplicate_filename_queue:  # Duplicates share another rule's future
+            if not compile_future.cancel():
+                concurrent.futures.wait([compile_future])
+
     def finish_compile(self):
         # Must be thread-safe!
         with self.cls_lock:
@@ -154,35 +204,98 @@ class KaldiRule(object):
             self.compiler.load_queue.add(self)
             return self
         assert self.compiled
+        self.compiler.load_decoder_lexicon()
 
         if self.has_been_loaded:
             # FIXME: why is this necessary?
             self._do_reloading()
         else:
-            if self.compiler.decoding_framework == 'agf':
-                grammar_fst_index = self.decoder.add_grammar_fst(self.fst if self.fst.native else self.filepath)
+            if self.compiler.decoding_framework == 'agf' and self.compiler.lazy_load_rules:
+                # Our real graph is loaded upon first activation
+                return self.load_placeholder()
+            elif self.compiler.decoding_framework == 'agf':
+                grammar_fst_index = self._add_to_decoder(self.fst_wrapper)
+                self.resident = True
             elif self.compiler.decoding_framework == 'laf':
                 grammar_fst_index = self.decoder.add_grammar_fst(self.fst) if self.fst.native else self.decoder.add_grammar_fst_text(self._fst_text)
+                self.resident = True
             else: raise KaldiError("unknown compiler decoding_framework")
             assert self.id == grammar_fst_index, "add_grammar_fst allocated invalid grammar_fst_index %d != %d for %s" % (grammar_fst_index, self.id, self)
 
         self.loaded = True
         self.has_been_loaded = True
+        self._release_compiled_graph()
+        return self
+
+    def load_placeholder(self):
+        """ Occupies our grammar index in the decoder with the placeholder graph, until our real graph is needed/ready. """
+        grammar_fst_index = self._add_to_decoder(self.compiler._ensure_placeholder_fst())
+        assert self.id == grammar_fst_index, "add_grammar_fst allocated invalid grammar_fst_index %d != %d for %s" % (grammar_fst_index, self.id, self)
+        self.loaded = True
+        self.has_been_loaded = True
+        self.resident = False
+        self._release_compiled_graph()
         return self
 
+    def _add_to_decoder(self, grammar_fst):
+        """ Adds grammar_fst to the (agf) decoder at our id, first filling any vacant ids below it (see destroy) with the placeholder, and returns the grammar index. """
+        vacant_rule_ids = self.compiler._vacant_rule_ids
+        while self.decoder.num_grammars < self.id and self.decoder.num_grammars in vacant_rule_ids:
+            self.decoder.add_grammar_fst(self.compiler._ensure_placeholder_fst())
+        if self.id < self.decoder.num_grammars:
+            # We were allocated a vacant id, whose grammar index is still occupied by the placeholder
+            self.decoder.reload_grammar_fst(self.id, grammar_fst)
+            return self.id
+        return self.decoder.add_grammar_fst(grammar_fst)
+
+    def _release_compiled_graph(self):
+        """ Frees our in-memory copy of the compiled graph, if the decoder can (re)load it from the cache file instead. """
+        if (self.compiler.decoding_framework == 'agf' and self.fst.native and self.fst.compiled_native_obj is not None
+                and self.compiler.cache_fsts and os.path.isfile(self.filepath)):
+            del self.fst.compiled_native_obj
+
     def _do_reloading(self):
+        self.compiler.load_decoder_lexicon()
         if self.compiler.decoding_framework == 'agf':
-            return self.decoder.reload_grammar_fst(self.id, (self.fst if self.fst.native else self.filepath))
+            if not self.resident:
+                # Only the placeholder is in the decoder, so there is nothing to replace until our real graph is needed/ready
+                self._release_compiled_graph()
+                return
+            result = self.decoder.reload_grammar_fst(self.id, self.fst_wrapper)
+            self._release_compiled_graph()
+            return result
         elif self.compiler.decoding_framework == 'laf':
             assert self.fst.native
             return self.decoder.reload_grammar_fst(self.id, self.fst)
             if not self.fst.native: return self.decoder.reload_grammar_fst_text(self.id, self._fst_text)  # FIXME: not implemented
         else: raise KaldiError("unknown compiler decoding_framework")
 
+    def make_resident(self):
+        """ Replaces the placeholder in the decoder with our real compiled graph (only used with compiler.lazy_load_rules). """
+        if self.resident or not self.loaded: return
+        _log.debug("%s: loading graph upon activation", self)
+        if self.fst_wrapper == self.filepath and not os.path.isfile(self.filepath):
+            # Our cached graph has been removed (e.g. by lexicon regeneration invalidating the cache), so recompile it
+            self.compiled = False
+            self.fst.filename = None
+            self.compile()
+        self.decoder.reload_grammar_fst(self.id, self.fst_wrapper)
+        self._release_compiled_graph()
+        self.resident = True
+
+    def make_nonresident(self):
+        """ Replaces our real compiled graph in the decoder with the placeholder, freeing its memory (only used with compiler.lazy_load_rules). """
+        if not self.resident or not self.loaded: return
+        _log.debug("%s: unloading graph after inactivity", self)
+        self.decoder.reload_grammar_fst(self.id, self.compiler._ensure_placeholder_fst())
+        self.resident = False
+
     @contextmanager
     def reload(self):
         """ Used for modifying a rule in place, e.g. ListRef. """
         if self.destroyed: raise KaldiError("Cannot use a KaldiRule after calling destroy()")
+        self._cancel_compile()
+        self._discard_staged()
 
         was_loaded = self.loaded
         self.reloading = True
@@ -202,13 +315,102 @@ class KaldiRule(object):
             self.compiler.load_queue.add(self)
         self.reloading = False
 
+    @contextmanager
+    def staged_reload(self):
+        """
+        Like reload(), but yields a new, empty FST to build the new version of this rule in, while the current graph stays
+        live in the decoder. The new graph is compiled in the background, and swapped in by prepare_for_recognition (at an
+        utterance boundary) once it is ready, without ever blocking on it. A newer staged_reload() supersedes a pending one.
+        """
+        if self.destroyed: raise KaldiError("Cannot use a KaldiRule after calling destroy()")
+        if self.compiler.decoding_framework != 'agf': raise KaldiError("staged_reload requires framework='agf-*'")
+
+        fst = WFST() if not self.fst.native else NativeWFST()
+        yield fst
+
+        self._discard_staged()
+        if fst.native:
+            fst.compute_hash(self.fst_cache.dependencies_hash)
+            fst_text = None
+        else:
+            fst_text = fst.get_fst_text(fst_cache=self.fst_cache)
+        if self.compiled and fst.filename == self.filename:
+            _log.debug("%s: staged_reload produced identical FST; nothing to do", self)
+            if fst.native: fst.close()
+            return
+
+        self._staged_fst = fst
+        self.staged_future = self.compiler.compile_executor.submit(self._compile_staged, fst, fst_text)
+        self.compiler.staged_reload_queue.add(self)
+
+    def _compile_staged(self, fst, fst_text):
+        # Must be thread-safe!
+        with self.cls_lock:
+            self.compiler.prepare_for_compilation()
+        filepath = os.path.join(self.compiler.tmp_dir, fst.filename) if self.compiler.tmp_dir is not None else None
+        if self.compiler.cache_fsts and self.fst_cache.fst_is_current(filepath, touch=True):
+            return
+        _log.log(15, "%s: Compiling staged %sstate/%sarc FST to %s" % (self, fst.num_states, fst.num_arcs, fst.filename))
+        if fst.native:
+            fst.compiled_native_obj = self.compiler._compile_agf_graph(compile=True, nonterm=self.nonterm, input_fst=fst, return_output_fst=True,
+                output_filename=(filepath if self.compiler.cache_fsts else None))
+        else:
+            self.compiler._compile_agf_graph(compile=True, nonterm=self.nonterm, input_text=fst_text, output_filename=filepath)
+
+    staged_ready = property(lambda self: self.staged_future is not None and self.staged_future.done())
+
+    def swap_staged(self):
+        """ Replaces our FST and graph (in the decoder, if loaded) with the staged version. Must only be called between utterances! """
+        fst, future = self._staged_fst, self.staged_future
+        self._staged_fst = self.staged_future = None
+        self.compiler.staged_reload_queue.discard(self)
+        try:
+            future.result()  # Raises any exception from compilation
+        except Exception:
+            if fst.native: fst.close()
+            raise KaldiError("Exception while compiling staged reload", self)
+
+        old_fst, self.fst = self.fst, fst
+        self._fst_text = None
+        self.compiled = True
+        if self.loaded:
+            self._do_reloading()
+        if old_fst.native:
+            old_fst.close()
+        return self
+
+    def _discard_staged(self):
+        fst, future = self._staged_fst, self.staged_future
+        self._staged_fst = self.staged_future = None
+        if self.compiler is not None:
+            self.compiler.staged_reload_queue.discard(self)
+        if future is not None and fst.native:
+            # Must not close the FST while it is still being compiled
+            if future.cancel(): fst.close()
+            else: future.add_done_callback(lambda future: fst.close())
+
     def destroy(self):
         """ Destructor. Unloads rule. The rule should not be used/referenced anymore after calling! """
         if self.destroyed:
             return
+        self._cancel_compile()
+        self._discard_staged()
 
+        other_kaldi_rules = list(self.compiler.kaldi_rule_by_id_dict.values())
+        other_kaldi_rules.remove(self)
+        for kaldi_rule in other_kaldi_rules:
+            kaldi_rule.subgrammar_rules.discard(self)
+        # Compiled graphs refer to their subgrammars by id, so those ids must not change. If any is above ours, we leave our
+        # id vacant (occupied in the decoder by the placeholder) rather than shifting all ids above it down.
+        pin_ids = (self.compiler.decoding_framework == 'agf'
+            and any(subgrammar_rule.id > self.id for kaldi_rule in other_kaldi_rules for subgrammar_rule in kaldi_rule.subgrammar_rules))
+
+        if self.loaded or (pin_ids and self.id < self.decoder.num_grammars):
+            if pin_ids:
+                self.decoder.reload_grammar_fst(self.id, self.compiler._ensure_placeholder_fst())
+            else:
+                self.decoder.remove_grammar_fst(self.id)
         if self.loaded:
-            self.decoder.remove_grammar_fst(self.id)
             assert self not in self.compiler.compile_queue
             assert self not in self.compiler.compile_duplicate_filename_queue
             assert self not in self.compiler.load_queue
@@ -217,15 +419,22 @@ class KaldiRule(object):
             if self in self.compiler.compile_duplicate_filename_queue: self.compiler.compile_duplicate_filename_queue.remove(self)
             if self in self.compiler.load_queue: self.compiler.load_queue.remove(self)
 
-        # Adjust other kaldi_rules ids down, if above self.id, then rebuild dict
-        other_kaldi_rules = list(self.compiler.kaldi_rule_by_id_dict.values())
-        other_kaldi_rules.remove(self)
-        for kaldi_rule in other_kaldi_rules:
-            if kaldi_rule.id > self.id:
-                kaldi_rule.id -= 1
-        self.compiler.kaldi_rule_by_id_dict = { kaldi_rule.id: kaldi_rule for kaldi_rule in other_kaldi_rules }
-
-        self.compiler.free_rule_id()
+        if pin_ids:
+            del self.compiler.kaldi_rule_by_id_dict[self.id]
+            self.compiler._vacant_rule_ids.add(self.id)
+            self.compiler._parse_output_cache_clear()
+        else:
+            # Adjust other kaldi_rules ids down, if above self.id, then rebuild dict
+            for kaldi_rule in other_kaldi_rules:
+                if kaldi_rule.id > self.id:
+                    kaldi_rule.id -= 1
+            self.compiler.kaldi_rule_by_id_dict = { kaldi_rule.id: kaldi_rule for kaldi_rule in other_kaldi_rules }
+            self.compiler._vacant_rule_ids = set((id if id < self.id else id - 1) for id in self.compiler._vacant_rule_ids)
+            self.compiler.free_rule_id()
+        self.compiler._trim_vacant_rule_ids()
+
+        if self.compiler.shared_subgrammars.get(self.name) is self:
+            del self.compiler.shared_subgrammars[self.name]
         self.destroyed = True
 
 
@@ -233,14 +442,33 @@ class KaldiRule(object):
 
 class Compiler(object):
 
+    parse_output_cache_size = 256
+
     def __init__(self, model_dir=None, tmp_dir=None, alternative_dictation=None,
-            framework='agf-direct', native_fst=True, cache_fsts=True):
+            framework='agf-direct', native_fst=True, cache_fsts=True, lazy_load_rules=False, lazy_unload_timeout=None,
+            background_compilation=False, background_compilation_timeout=None, max_num_rules=None,
+            alternative_dictation_parallel=False, alternative_dictation_timeout=None, alternative_dictation_speculative_delay=None):
         # Supported parameter combinations:
         #   framework='agf-indirect' native_fst=False (original method)
         #   framework='agf-direct' native_fst=False (no external CLI programs needed)
         #   framework='agf-direct' native_fst=True (no external CLI programs needed; no cache/temp files used)
         #   framework='laf' native_fst=False (no reloading supported)
         #   framework='laf' native_fst=True (no reloading supported)
+        # lazy_load_rules: only load each rule's (cached) compiled graph into the decoder upon its first activation (passed to
+        #   prepare_for_recognition), and unload it again after lazy_unload_timeout seconds of inactivity (if not None)
+        # background_compilation: start compiling lazily-compiled rules as soon as they are queued, so prepare_for_recognition
+        #   only waits (up to background_compilation_timeout seconds, if not None) for the rules active in the coming utterance
+        # max_num_rules: number of rule ids to support (default: all #nonterm:ruleN symbols in the model). The top FST has one
+        #   arc per id, all expanded at every utterance start, so capping this near the number actually needed reduces latency
+        # alternative_dictation: callable taking a dictation span's audio_data and returning its text (or None); if it has a
+        #   ``set_audio_format(sample_rate, num_channels)`` method, init_decoder calls it with the format of the decoder's audio
+        # alternative_dictation_parallel: call alternative_dictation for all dictation spans of an utterance concurrently (always
+        #   the case for async callables), with each span falling back to the kaldi dictation after alternative_dictation_timeout
+        #   seconds (if not None) or upon exception
+        # alternative_dictation_speculative_delay: if not None, and alternative_dictation has a ``start_stream()`` method, start
+        #   streaming a dictation span's audio once parse_partial_output has been within it for this many seconds. The stream
+        #   must have ``feed(audio_data)``, ``finish() -> text`` (blocking, for all audio fed), and ``cancel()`` methods.
+        #   parse_output then only feeds the tail of the span, if the final alignment still matches the span's start.
 
         show_donation_message()
         self._log = _log
@@ -261,10 +489,27 @@ class Compiler(object):
         self.native_fst = bool(native_fst)
         self.cache_fsts = bool(cache_fsts)
         self.alternative_dictation = alternative_dictation
+        self.alternative_dictation_parallel = bool(alternative_dictation_parallel)
+        self.alternative_dictation_timeout = alternative_dictation_timeout
+        self._alternative_dictation_executor = None
+        self.alternative_dictation_speculative_delay = alternative_dictation_speculative_delay
+        if self.alternative_dictation_speculative_delay is not None and not hasattr(self.alternative_dictation, 'start_stream'):
+            raise KaldiError("alternative_dictation_speculative_delay requires alternative_dictation with a start_stream() method")
+        self._speculative_dictation = None  # dict(stream, offset_start, offset_fed) for the alternative dictation span being streamed
+        self.lazy_load_rules = bool(lazy_load_rules)
+        self.lazy_unload_timeout = lazy_unload_timeout
+        if self.lazy_load_rules and not (self.decoding_framework == 'agf' and self.cache_fsts):
+            raise KaldiError("lazy_load_rules requires framework='agf-*' and cache_fsts=True")
+        self.background_compilation = bool(background_compilation)
+        self.background_compilation_timeout = background_compilation_timeout
+        if self.background_compilation and not (self.decoding_framework == 'agf' and self.cache_fsts):
+            raise KaldiError("background_compilation requires framework='agf-*' and cache_fsts=True")
+        self._compile_executor = None
 
         tmp_dir_needed = bool(self.cache_fsts)
         self.model = Model(model_dir, tmp_dir, tmp_dir_needed=tmp_dir_needed)
         self._lexicon_files_stale = False
+        self._decoder_lexicon_stale = False  # Lexicon files regenerated by prepare_for_compilation, but not yet loaded by the decoder
 
         if self.native_fst:
             NativeWFST.init_class(
@@ -275,17 +520,27 @@ class Compiler(object):
         self.decoder = None
 
         self._num_kaldi_rules = 0
-        self._max_rule_id = 999
-        self.nonterminals = tuple(['#nonterm:dictation'] + ['#nonterm:rule%i' % i for i in range(self._max_rule_id + 1)])
+        model_max_num_rules = self.model.count_rule_nonterms()
+        if max_num_rules is None:
+            max_num_rules = model_max_num_rules
+        elif not (0 < max_num_rules <= model_max_num_rules):
+            raise KaldiError("max_num_rules=%s not supported by model (supports %d); reconvert model with more rules" % (max_num_rules, model_max_num_rules))
+        if max_num_rules < 1: raise KaldiError("model has no rule nonterminals")
+        self._max_rule_id = max_num_rules - 1
+        self.nonterminals = tuple(make_nonterminals(max_num_rules))
         words_set = frozenset(self.model.words_table.words)
         self._oov_word = '<unk>' if ('<unk>' in self.model.words_table) else None  # FIXME: make this configurable, for different models
         self._silence_words = frozenset(['!SIL']) & words_set  # FIXME: make this configurable, for different models
         self._noise_words = frozenset(['<unk>', '!SIL']) & words_set  # FIXME: make this configurable, for different models
 
         self.kaldi_rule_by_id_dict = collections.OrderedDict()  # maps KaldiRule.id -> KaldiRule
+        self._vacant_rule_ids = set()  # ids of destroyed KaldiRules kept so that referenced subgrammar ids don't change; see KaldiRule.destroy
         self.compile_queue = set()  # KaldiRule
         self.compile_duplicate_filename_queue = set()  # KaldiRule; queued KaldiRules with a duplicate filename (and thus contents), so can skip compilation
         self.load_queue = set()  # KaldiRule; must maintain same order as order of instantiation!
+        self.staged_reload_queue = set()  # KaldiRule; with a new version being compiled by staged_reload()
+        self.shared_subgrammars = dict()  # maps name -> subgrammar KaldiRule; see compile_shared_subgrammar()
+        self._parse_output_cached = functools.lru_cache(maxsize=self.parse_output_cache_size)(self._parse_output_uncached)  # Cleared when rules are added/removed
 
     def close(self):
         """Release native resources owned by this compiler, once."""
@@ -293,6 +548,16 @@ class Compiler(object):
         if decoder is not None:
             decoder.close()
 
+        for rule in list(self.staged_reload_queue):
+            rule._discard_staged()
+        self._cancel_speculative_dictation()
+        compile_executor, self._compile_executor = self._compile_executor, None
+        if compile_executor is not None:
+            shutdown_executor(compile_executor, wait=True)
+        alternative_dictation_executor, self._alternative_dictation_executor = self._alternative_dictation_executor, None
+        if alternative_dictation_executor is not None:
+            shutdown_executor(alternative_dictation_executor, wait=False)  # Don't wait on slow external engines
+
         agf_compiler, self._agf_compiler = self._agf_compiler, None
         if agf_compiler is not None:
             agf_compiler.close()
@@ -306,6 +571,8 @@ class Compiler(object):
         self.compile_duplicate_filename_queue.clear()
         self.load_queue.clear()
         self._num_kaldi_rules = 0
+        self._vacant_rule_ids.clear()
+        self._parse_output_cache_clear()
         for rule in rules:
             rule.loaded = False
             rule.destroyed = True
@@ -321,10 +588,19 @@ class Compiler(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
-    def init_decoder(self, config=None, dictation_fst_file=None):
+    def init_decoder(self, config=None, dictation_fst_file=None, sample_rate=None, num_channels=1, pipelined=False, endpointing=False,
+            early_commit_threshold=None):
+        """
+        Initialize decoder; ``sample_rate`` and ``num_channels`` are of the audio to be decoded, ``pipelined`` enables
+        pipelined decoding, ``endpointing`` enables endpoint detection, and ``early_commit_threshold`` enables early
+        commitment to complete commands (see wrapper::KaldiNNet3Decoder), for which the decoder uses our rules to determine
+        whether its best path reaches a final state.
+        """
         if self.decoder: raise KaldiError("Decoder already initialized")
         if dictation_fst_file is None: dictation_fst_file = self.dictation_fst_filepath
-        decoder_kwargs = dict(model_dir=self.model_dir, tmp_dir=self.tmp_dir, dictation_fst_file=dictation_fst_file, max_num_rules=self._max_rule_id+1, config=config)
+        decoder_kwargs = dict(model_dir=self.model_dir, tmp_dir=self.tmp_dir, dictation_fst_file=dictation_fst_file, max_num_rules=self._max_rule_id+1, config=config,
+            sample_rate=sample_rate, num_channels=num_channels, pipelined=pipelined, endpointing=endpointing,
+            early_commit_threshold=early_commit_threshold)
         if self.decoding_framework == 'agf':
             top_fst_rule = self.compile_top_fst()
             decoder_kwargs.update(top_fst=top_fst_rule.fst_wrapper)
@@ -333,6 +609,11 @@ class Compiler(object):
             self.decoder = KaldiLafNNet3Decoder(**decoder_kwargs)
         else:
             raise KaldiError("Invalid Compiler.decoding_framework: %r" % self.decoding_framework)
+        self.decoder.endpoint_state_func = self._get_endpoint_state
+        set_audio_format = getattr(self.alternative_dictation, 'set_audio_format', None)
+        if set_audio_format is not None:
+            # E.g. AlternativeDictationClient, which tells its server the format of the audio_data we pass it
+            set_audio_format(self.decoder.sample_rate, self.decoder.num_channels)
         return self.decoder
 
     exec_dir = property(lambda self: self.model.exec_dir)
@@ -342,6 +623,7 @@ class Compiler(object):
     fst_cache = property(lambda self: self.model.fst_cache)
 
     num_kaldi_rules = property(lambda self: self._num_kaldi_rules)
+    max_num_rules = property(lambda self: self._max_rule_id + 1)
     lexicon_words = property(lambda self: self.model.words_table.word_to_id_map)
     _longest_word = property(lambda self: self.model.longest_word)
 
@@ -349,17 +631,59 @@ class Compiler(object):
     _dictation_fst_filepath = property(lambda self: os.path.join(self.model_dir,
         (defaults.DEFAULT_DICTATION_FST_FILENAME if self.decoding_framework == 'agf' else 'Gr.fst')))  # FIXME: generalize
     _plain_dictation_hclg_fst_filepath = property(lambda self: os.path.join(self.model_dir, defaults.DEFAULT_PLAIN_DICTATION_HCLG_FST_FILENAME))
+    _reduced_dictation_fst_filepath = property(lambda self: os.path.join(self.model_dir, defaults.DEFAULT_REDUCED_DICTATION_FST_FILENAME))
+    _reduced_plain_dictation_hclg_fst_filepath = property(lambda self: os.path.join(self.model_dir, defaults.DEFAULT_REDUCED_PLAIN_DICTATION_HCLG_FST_FILENAME))
+
+    @property
+    def compile_executor(self):
+        if self._compile_executor is None:
+            self._compile_executor = concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count(), thread_name_prefix='kaldi_compile')
+        return self._compile_executor
+
+    @property
+    def alternative_dictation_executor(self):
+        if self._alternative_dictation_executor is None:
+            self._alternative_dictation_executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='kaldi_alternative_dictation')
+        return self._alternative_dictation_executor
+
+    def _ensure_placeholder_fst(self):
+        """ Compiles (if not already cached) the graph for a nonterminal rule that matches nothing but the empty string, kept in the decoder for non-resident rules, and returns its filepath. """
+        fst = WFST()
+        fst.add_state(initial=True, final=True)
+        fst_text = fst.get_fst_text(fst_cache=self.fst_cache)
+        filepath = os.path.join(self.tmp_dir, fst.filename)
+        if not self.fst_cache.fst_is_current(filepath, touch=True):
+            with KaldiRule.cls_lock:
+                self.prepare_for_compilation()
+            self._compile_agf_graph(compile=True, nonterm=True, input_text=fst_text, output_filename=filepath)
+        return filepath
 
     def alloc_rule_id(self):
+        if self._vacant_rule_ids:
+            id = min(self._vacant_rule_ids)
+            self._vacant_rule_ids.remove(id)
+            self._parse_output_cache_clear()
+            return id
         id = self._num_kaldi_rules
         self._num_kaldi_rules += 1
+        self._parse_output_cache_clear()
         return id
 
     def free_rule_id(self):
         id = self._num_kaldi_rules
         self._num_kaldi_rules -= 1
+        self._parse_output_cache_clear()
         return id
 
+    def _trim_vacant_rule_ids(self):
+        """ Frees vacant ids (see KaldiRule.destroy) at the top of the range, since removing them shifts no other ids. """
+        while (self._num_kaldi_rules - 1) in self._vacant_rule_ids:
+            id = self._num_kaldi_rules - 1
+            if id < self.decoder.num_grammars:
+                self.decoder.remove_grammar_fst(id)
+            self._vacant_rule_ids.remove(id)
+            self.free_rule_id()
+
 
     ####################################################################################################################
     # Methods for compiling graphs.
@@ -370,16 +694,25 @@ class Compiler(object):
         return pronunciations
 
     def prepare_for_compilation(self):
+        # May run on background compilation threads, so leaves the decoder alone; see load_decoder_lexicon
         if self._lexicon_files_stale:
             self.model.generate_lexicon_files()
             self.model.load_words()  # FIXME: This re-loading from the words.txt file may be unnecessary now that we have/use NativeWFST + SymbolTable, but it's not clear if it's safe to remove it.
-            self.decoder.load_lexicon()
+            self._decoder_lexicon_stale = True
             if self._agf_compiler:
                 # TODO: Just update the necessary files in the config
                 self._agf_compiler.destroy()
                 self._agf_compiler = self._init_agf_compiler()
             self._lexicon_files_stale = False
 
+    def load_decoder_lexicon(self):
+        """ Loads the lexicon files regenerated by prepare_for_compilation into the decoder, if needed. Must be called on the decoding thread, between utterances. """
+        with KaldiRule.cls_lock:
+            if not self._decoder_lexicon_stale:
+                return
+            self._decoder_lexicon_stale = False
+        self.decoder.load_lexicon()
+
     def _compile_laf_graph(self, input_text=None, input_filename=None, output_filename=None, **kwargs):
         # FIXME: documentation
         with debug_timer(self._log.debug, "laf graph compilation"):
@@ -410,6 +743,22 @@ class Compiler(object):
         config = { key: value.format(**format_kwargs) for (key, value) in config.items() }
         return KaldiAgfCompiler(config)
 
+    def _agf_graph_config(self, nonterm=False, simplify_lg=True):
+        """ Returns the config dict for compiling a graph with the internal AGF compiler (without any output filename). """
+        config = dict(
+            nonterm_phones_offset = self.model.nonterm_phones_offset,
+            disambig_rxfilename = '{disambig_int}',
+            simplify_lg = simplify_lg,
+            verbose = 3 if self._log.isEnabledFor(5) else 0,
+            tree_rxfilename = '{tree}',
+            model_rxfilename = '{final_mdl}',
+            lex_rxfilename = '{L_disambig_fst}',
+            word_syms_filename = '{words_txt}',
+            )
+        if nonterm:
+            config.update(grammar_prepend_nonterm=self.model.nonterm_words_offset, grammar_append_nonterm=self.model.nonterm_words_offset+1)
+        return { key: value.format(**self.files_dict) if isinstance(value, str) else value for (key, value) in config.items() }
+
     def _compile_agf_graph(self, compile=False, nonterm=False, simplify_lg=True,
             input_text=None, input_filename=None, input_fst=None,
             output_filename=None, return_output_fst=False, **kwargs):
@@ -429,24 +778,12 @@ class Compiler(object):
 
         if self._agf_compiler:
             # Internal-style (no external CLI programs)
-            config = dict(
-                nonterm_phones_offset = self.model.nonterm_phones_offset,
-                disambig_rxfilename = '{disambig_int}',
-                simplify_lg = simplify_lg,
-                verbose = verbose_level,
-                tree_rxfilename = '{tree}',
-                model_rxfilename = '{final_mdl}',
-                lex_rxfilename = '{L_disambig_fst}',
-                word_syms_filename = '{words_txt}',
-                )
+            config = self._agf_graph_config(nonterm=nonterm, simplify_lg=simplify_lg)
             if output_filename:
                 config.update(hclg_wxfilename=output_filename)
             elif self._log.isEnabledFor(3):
                 import datetime
                 config.update(hclg_wxfilename=os.path.join(self.tmp_dir, datetime.datetime.now().isoformat().replace(':', '') + '.fst'))
-            if nonterm:
-                config.update(grammar_prepend_nonterm=self.model.nonterm_words_offset, grammar_append_nonterm=self.model.nonterm_words_offset+1)
-            config = { key: value.format(**format_kwargs) if isinstance(value, str) else value for (key, value) in config.items() }
 
             if 1 != sum(int(i is not None) for i in [input_text, input_filename, input_fst]):
                 raise KaldiError("must pass exactly one input")
@@ -507,9 +844,16 @@ class Compiler(object):
             run("{exec_dir}compile-graph --nonterm-phones-offset={nonterm_phones_offset} --read-disambig-syms={disambig_int} --verbose={verbose}"
                 + " {tree} {final_mdl} {L_disambig_fst} {input_filename} {output_filename}")
 
-    def compile_plain_dictation_fst(self, g_filename=None, output_filename=None):
+    def compile_plain_dictation_fst(self, g_filename=None, output_filename=None, force=False):
+        """
+        Builds the plain dictation graph (HCLG) from ``g_filename``, skipped if its inputs are unchanged since it was last
+        built (unless ``force``). Returns the build report (see DictationGraphBuilder).
+        """
         if g_filename is None: g_filename = self._default_dictation_g_filepath
         if output_filename is None: output_filename = self._plain_dictation_hclg_fst_filepath
+        return DictationGraphBuilder(self, nonterm=False).build(g_filename, output_filename, force=force)
+
+    def _compile_plain_dictation_graph(self, g_filename, output_filename):
         verbose_level = 5 if self._log.isEnabledFor(5) else 0
         format_kwargs = dict(self.files_dict, g_filename=g_filename, output_filename=output_filename, verbose=verbose_level)
         format = ExternalProcess.get_list_formatter(format_kwargs)
@@ -518,9 +862,59 @@ class Compiler(object):
         compile_command = ExternalProcess.compile_graph_agf(*args, **ExternalProcess.get_debug_stderr_kwargs(self._log))
         compile_command()
 
-    def compile_agf_dictation_fst(self, g_filename=None):
+    def compile_agf_dictation_fst(self, g_filename=None, force=False):
+        """
+        Builds the dictation graph (#nonterm:dictation) from ``g_filename``, skipped if its inputs are unchanged since it
+        was last built (unless ``force``). Returns the build report (see DictationGraphBuilder).
+        """
         if g_filename is None: g_filename = self._default_dictation_g_filepath
-        self._compile_agf_graph(input_filename=g_filename, output_filename=self._dictation_fst_filepath, nonterm=True, simplify_lg=False)
+        return DictationGraphBuilder(self, nonterm=True).build(g_filename, self._dictation_fst_filepath, force=force)
+
+    def compile_reduced_dictation_fst(self, arpa_filename, output_filename=None, target_num_ngrams=None, prune_threshold=None,
+            vocabulary=None, plain=False, force=False):
+        """
+        Builds a reduced-size dictation graph, to cut decoder memory, from the ARPA language model ``arpa_filename``:
+        restricted to the words of ``vocabulary`` (if given) and of the lexicon, and relative entropy pruned to at most
+        ``target_num_ngrams`` n-grams and/or by ``prune_threshold`` (see ArpaLanguageModel.prune). The pruned G.fst is
+        written beside ``output_filename``, and the graph is built from it (see DictationGraphBuilder).
+
+        Args:
+            plain (bool): whether to build a plain HCLG.fst (e.g. for PlainDictationRecognizer(fst_file=...)) rather than a dictation graph for KaldiAG
+
+        Returns dict(num_ngrams_before, num_ngrams, num_removed_words, g_filename, g_size_mb, output_filename, graph_size_mb, build_report).
+        """
+        if output_filename is None:
+            output_filename = self._reduced_plain_dictation_hclg_fst_filepath if plain else self._reduced_dictation_fst_filepath
+        lexicon_words = self.lexicon_words
+        if '#0' not in lexicon_words: raise KaldiError("lexicon is missing disambiguation symbol #0 for backoff arcs")
+
+        with debug_timer(self._log.debug, "language model reduction"):
+            language_model = ArpaLanguageModel.read(arpa_filename)
+            num_ngrams_before = language_model.num_ngrams_by_order
+            words = set(lexicon_words) if vocabulary is None else (set(vocabulary) & set(lexicon_words))
+            num_removed_words = language_model.restrict_vocabulary(words)
+            if target_num_ngrams is not None or prune_threshold is not None:
+                language_model.prune(target_num_ngrams=target_num_ngrams, threshold=prune_threshold)
+            num_ngrams_after = language_model.num_ngrams_by_order
+            self._log.info("%s: reduced language model from %s to %s n-grams", self, num_ngrams_before, num_ngrams_after)
+
+        g_filename = os.path.splitext(output_filename)[0] + '.G.fst'
+        g_txt_filename = g_filename + '.txt'
+        with open(g_txt_filename, 'w', encoding='utf-8') as f:
+            f.write(language_model.get_fst_text())
+        del language_model
+        format = ExternalProcess.get_list_formatter(self.files_dict)
+        compile_command = g_txt_filename
+        compile_command |= ExternalProcess.fstcompile(*format('--isymbols={words_txt}', '--osymbols={words_txt}'))
+        compile_command |= ExternalProcess.fstarcsort('--sort_type=ilabel')
+        compile_command |= g_filename
+        ExternalProcess.execute_command_safely(compile_command, self._log)
+        os.remove(g_txt_filename)
+
+        build_report = DictationGraphBuilder(self, nonterm=not plain).build(g_filename, output_filename, force=force)
+        return dict(num_ngrams_before=num_ngrams_before, num_ngrams=num_ngrams_after, num_removed_words=num_removed_words,
+            g_filename=g_filename, g_size_mb=os.path.getsize(g_filename) / float(1 << 20),
+            output_filename=output_filename, graph_size_mb=os.path.getsize(output_filename) / float(1 << 20), build_report=build_report)
 
     # def _compile_base_fsts(self):
     #     filepaths = [self.tmp_dir + filename for filename in ['nonterm_begin.fst', 'nonterm_end.fst']]
@@ -538,7 +932,7 @@ class Compiler(object):
     #         self.fst_cache.add(filepath)
 
     def compile_top_fst(self):
-        return self._build_top_fst(nonterms=['#nonterm:rule'+str(i) for i in range(self._max_rule_id + 1)], noise_words=self._noise_words).compile()
+        return self._build_top_fst(nonterms=self.nonterminals[1:], noise_words=self._noise_words).compile()
 
     def compile_top_fst_dictation_only(self):
         return self._build_top_fst(nonterms=['#nonterm:dictation'], noise_words=self._noise_words).compile()
@@ -618,8 +1012,11 @@ class Compiler(object):
         #         self._log.warning("load_queue has %s but it is already loaded", kaldi_rule)
 
         # Clean out obsolete entries
-        self.compile_queue.difference_update([kaldi_rule for kaldi_rule in self.compile_queue if kaldi_rule.compiled])
-        self.compile_duplicate_filename_queue.difference_update([kaldi_rule for kaldi_rule in self.compile_duplicate_filename_queue if kaldi_rule.compiled])
+        # Rules compiled in the background are left for the collection below, since they may still need their placeholder swapped out
+        self.compile_queue.difference_update([kaldi_rule for kaldi_rule in self.compile_queue
+            if kaldi_rule.compiled and kaldi_rule.compile_future is None])
+        self.compile_duplicate_filename_queue.difference_update([kaldi_rule for kaldi_rule in self.compile_duplicate_filename_queue
+            if kaldi_rule.compiled and kaldi_rule.compile_future is None])
         self.load_queue.difference_update([kaldi_rule for kaldi_rule in self.load_queue if kaldi_rule.loaded])
 
         if self.compile_queue or self.compile_duplicate_filename_queue or self.load_queue:
@@ -650,14 +1047,87 @@ class Compiler(object):
                     assert kaldi_rule.loaded
                     self.load_queue.remove(kaldi_rule)
 
+    def process_queues_in_background(self, grammars_activity=None):
+        """
+        Like process_compile_and_load_queues, but for background_compilation: only waits for the rules needed by
+        ``grammars_activity`` (or all, if None), up to background_compilation_timeout. Rules still compiling after that keep
+        their previous graph in the decoder, or the placeholder if they are new, until a later call finds them ready.
+        """
+        # Rules compiled in the background are left for the collection below, since they may still need their placeholder swapped out
+        self.compile_queue.difference_update([kaldi_rule for kaldi_rule in self.compile_queue
+            if kaldi_rule.compiled and kaldi_rule.compile_future is None])
+        self.compile_duplicate_filename_queue.difference_update([kaldi_rule for kaldi_rule in self.compile_duplicate_filename_queue
+            if kaldi_rule.compiled and kaldi_rule.compile_future is None])
+        self.load_queue.difference_update([kaldi_rule for kaldi_rule in self.load_queue if kaldi_rule.loaded and kaldi_rule.compiled])
+
+        pending_kaldi_rules = self.compile_queue | self.compile_duplicate_filename_queue
+        for kaldi_rule in pending_kaldi_rules:
+            kaldi_rule._submit_compile()
+        if grammars_activity is not None:
+            active_ids = set(active_grammar_ids(grammars_activity))
+            needed_kaldi_rules = [kaldi_rule for kaldi_rule in pending_kaldi_rules if kaldi_rule.id in active_ids]
+        else:
+            needed_kaldi_rules = pending_kaldi_rules
+        needed_futures = set(kaldi_rule.compile_future for kaldi_rule in needed_kaldi_rules if kaldi_rule.compile_future is not None)
+        if needed_futures:
+            with debug_timer(self._log.debug, "waiting for background compilation of %d needed rules" % len(needed_kaldi_rules)):
+                done, not_done = concurrent.futures.wait(needed_futures, timeout=self.background_compilation_timeout)
+            if not_done:
+                self._log.warning("%d needed rules still compiling after timeout; decoding with their previous graphs", len(not_done))
+
+        # Collect rules whose compilation has finished
+        finished_kaldi_rules = []
+        for kaldi_rule in list(self.compile_queue):
+            if kaldi_rule.compile_future is not None and kaldi_rule.compile_future.done():
+                kaldi_rule.compile_future.result()  # Raises any exception from compilation
+                assert kaldi_rule.compiled
+                self.compile_queue.remove(kaldi_rule)
+                finished_kaldi_rules.append(kaldi_rule)
+        for kaldi_rule in list(self.compile_duplicate_filename_queue):
+            if kaldi_rule.compile_future is None or kaldi_rule.compile_future.done():
+                kaldi_rule.compile(duplicate=True)
+                assert kaldi_rule.compiled
+                self.compile_duplicate_filename_queue.remove(kaldi_rule)
+                finished_kaldi_rules.append(kaldi_rule)
+
+        # Load rules in correct order, using the placeholder for new rules that are not ready yet
+        for kaldi_rule in sorted(self.load_queue, key=lambda kr: kr.id):
+            if kaldi_rule.compiled:
+                kaldi_rule.load()
+            elif not kaldi_rule.has_been_loaded:
+                kaldi_rule.load_placeholder()
+            else:
+                continue  # Keep its previous graph in the decoder until it is ready
+            self.load_queue.remove(kaldi_rule)
+
+        # Swap in the real graphs of rules that were loaded with the placeholder while compiling
+        if not self.lazy_load_rules:
+            for kaldi_rule in finished_kaldi_rules:
+                kaldi_rule.make_resident()
+
 
     ####################################################################################################################
     # Methods for recognition.
 
-    def prepare_for_recognition(self):
+    def prepare_for_recognition(self, grammars_activity=None):
+        """
+        Call before (the start of) each utterance, to finish any pending compiling/loading of rules.
+        :param grammars_activity: optional activity of each rule for the coming utterance, in any form accepted by the decoder (list of bools, or sparse collection of active rule ids); required for lazy_load_rules
+        """
+        if self._speculative_dictation is not None:
+            self._cancel_speculative_dictation()  # Left over from an utterance that was never parsed
         try:
             if self.compile_queue or self.compile_duplicate_filename_queue or self.load_queue:
-                self.process_compile_and_load_queues()
+                if self.background_compilation:
+                    self.process_queues_in_background(grammars_activity)
+                else:
+                    self.process_compile_and_load_queues()
+            self.load_decoder_lexicon()  # Including for any rules compiled just now
+            if self.staged_reload_queue:
+                for kaldi_rule in [kaldi_rule for kaldi_rule in self.staged_reload_queue if kaldi_rule.staged_ready]:
+                    kaldi_rule.swap_staged()
+            if self.lazy_load_rules and grammars_activity is not None:
+                self.update_resident_rules(grammars_activity)
         except KaldiError:
             raise
         except Exception:
@@ -666,10 +1136,94 @@ class Compiler(object):
             if self.fst_cache.dirty:
                 self.fst_cache.save()
 
+    def compile_shared_subgrammar(self, name, fst):
+        """
+        Compiles (once) and loads a subgrammar shared by any number of rules, such as numbers, spelled letters, or key
+        names, so it is not duplicated into each of their graphs. Rules reference it by ``name`` with
+        KaldiRule.add_subgrammar_arc, like #nonterm:dictation, and it is made active along with them by
+        add_subgrammar_activity. Change it with reload() on the returned KaldiRule; destroy() unregisters it.
+
+        Args:
+            fst: the subgrammar's FST (WFST, or NativeWFST if native_fst), or a callable to build it in a given new FST
+        """
+        if name in self.shared_subgrammars: raise KaldiError("shared subgrammar %r already exists" % name)
+        kaldi_rule = KaldiRule(self, name, subgrammar=True)
+        try:
+            if callable(fst):
+                fst(kaldi_rule.fst)
+            else:
+                if fst.native != kaldi_rule.fst.native: raise KaldiError("shared subgrammar FST must be %s" % kaldi_rule.fst.__class__.__name__)
+                empty_fst, kaldi_rule.fst = kaldi_rule.fst, fst
+                if empty_fst.native: empty_fst.close()
+            kaldi_rule.compile().load()
+        except Exception:
+            kaldi_rule.destroy()
+            raise
+        self.shared_subgrammars[name] = kaldi_rule
+        return kaldi_rule
+
+    def get_shared_subgrammar(self, name):
+        """ Returns the KaldiRule of the shared subgrammar ``name`` (see compile_shared_subgrammar). """
+        kaldi_rule = self.shared_subgrammars.get(name)
+        if kaldi_rule is None: raise KaldiError("unknown shared subgrammar %r" % name)
+        return kaldi_rule
+
+    def add_subgrammar_activity(self, grammars_activity):
+        """
+        Returns a copy of ``grammars_activity`` with the subgrammars referenced by active rules also made active. A list of
+        bools by rule id returns a list; a sparse collection of active rule ids returns a set.
+        """
+        active_ids = active_grammar_ids(grammars_activity)
+        subgrammar_ids = set()
+        for kaldi_rule_id in active_ids:
+            kaldi_rule = self.kaldi_rule_by_id_dict.get(kaldi_rule_id)
+            if kaldi_rule is not None:
+                subgrammar_ids.update(subgrammar_rule.id for subgrammar_rule in kaldi_rule.subgrammar_rules)
+        if is_sparse_grammars_activity(grammars_activity):
+            return set(int(kaldi_rule_id) for kaldi_rule_id in active_ids) | subgrammar_ids
+        grammars_activity = list(grammars_activity)
+        for subgrammar_id in subgrammar_ids:
+            if subgrammar_id < len(grammars_activity):
+                grammars_activity[subgrammar_id] = True
+        return grammars_activity
+
+    def remove_dictation_activity(self, grammars_activity):
+        """
+        Returns a copy of ``grammars_activity`` with the rules that can recognize dictation (themselves, or through a
+        referenced subgrammar) made inactive, so dictation is never entered (nor its search space expanded) during the
+        utterance. A list of bools by rule id returns a list; a sparse collection of active rule ids returns a set.
+        """
+        dictation_ids = set(kaldi_rule_id for kaldi_rule_id, kaldi_rule in self.kaldi_rule_by_id_dict.items()
+            if kaldi_rule.has_dictation or any(subgrammar_rule.has_dictation for subgrammar_rule in kaldi_rule.subgrammar_rules))
+        if is_sparse_grammars_activity(grammars_activity):
+            return set(int(kaldi_rule_id) for kaldi_rule_id in active_grammar_ids(grammars_activity)) - dictation_ids
+        grammars_activity = list(grammars_activity)
+        for dictation_id in dictation_ids:
+            if dictation_id < len(grammars_activity):
+                grammars_activity[dictation_id] = False
+        return grammars_activity
+
+    def update_resident_rules(self, grammars_activity):
+        """ Makes sure all active rules have their real graph in the decoder, and unloads rules that have been inactive for too long. """
+        now = clock()
+        active_ids = set(active_grammar_ids(grammars_activity))
+        for kaldi_rule_id, kaldi_rule in list(self.kaldi_rule_by_id_dict.items()):
+            if not kaldi_rule.loaded:
+                continue
+            if kaldi_rule_id in active_ids:
+                kaldi_rule.make_resident()
+                kaldi_rule.last_active_time = now
+            elif (kaldi_rule.resident and self.lazy_unload_timeout is not None
+                    and (now - kaldi_rule.last_active_time) > self.lazy_unload_timeout):
+                kaldi_rule.make_nonresident()
+
     wildcard_nonterms = ('#nonterm:dictation', '#nonterm:dictation_cloud')
 
     def parse_output_for_rule(self, kaldi_rule, output):
-        """Can be used even when self.parsing_framework == 'token', only for mimic (which contains no nonterms)."""
+        """
+        Can be used even when self.parsing_framework == 'token', only for mimic (which contains no nonterms).
+        Does not follow subgrammar references (see KaldiRule.add_subgrammar_arc), so does not match through them.
+        """
         labels = kaldi_rule.fst.does_match(output.split(), wildcard_nonterms=self.wildcard_nonterms)
         self._log.log(5, "parse_output_for_rule(%s, %r) got %r", kaldi_rule, output, labels)
         if labels is False:
@@ -680,64 +1234,234 @@ class Compiler(object):
             self._log.error("parsed_output(%r).lower() != output(%r)" % (parsed_output, output))
         return words
 
+    # Format of the audio_data from dictation_info_func, as passed to the decoder (or the default format, without one)
+    _alternative_dictation_bytes_per_sample = property(lambda self: 2 * (self.decoder.num_channels if self.decoder else 1))
+    _alternative_dictation_bytes_per_second = property(lambda self: self._alternative_dictation_bytes_per_sample * (self.decoder.sample_rate if self.decoder else 16000))
+    _speculative_dictation_tolerance_bytes = property(lambda self: self._alternative_dictation_bytes_per_second // 10)  # Alignment jitter of span start allowed
+
     alternative_dictation_regex = re.compile(r'(?<=#nonterm:dictation_cloud )(.*?)(?= #nonterm:end)')  # lookbehind & lookahead assertions
 
-    def parse_output(self, output, dictation_info_func=None):
+    def _get_word_align_words_and_times(self, word_align):
+        """ Returns (words, byte offsets) lists, from ``word_align`` as either get_word_align (tuples, in bytes) or get_word_align_array (structured array, in samples) output. """
+        if isinstance(word_align, np.ndarray):
+            return word_align['word'].tolist(), (word_align['start'] * self._alternative_dictation_bytes_per_sample).tolist()
+        return [word for (word, time, length) in word_align], [time for (word, time, length) in word_align]
+
+    def _get_alternative_dictation_spans(self, audio_data, word_align):
+        """ Returns list of (offset_start, offset_end) byte offsets into ``audio_data`` of each alternative dictation span in ``word_align``. """
+        align_words, times = self._get_word_align_words_and_times(word_align)
+        # Find start & end word-index & byte-offset of each alternative dictation span, in a single pass
+        dictation_spans = []
+        index_start = None
+        for index, word in enumerate(align_words):
+            if word.startswith('#nonterm:dictation_cloud'):
+                index_start = index
+            elif word == '#nonterm:end' and index_start is not None:
+                dictation_spans.append({
+                    'index_start': index_start,
+                    'offset_start': times[index_start],
+                    'index_end': index,
+                    'offset_end': times[index],
+                })
+                index_start = None
+        if not dictation_spans:
+            raise KaldiError("no complete alternative dictation span in word_align")
+
+        # If last dictation is at end of utterance, it should include rest of audio_data; else, it should include half of audio_data between dictation end and start of next word
+        dictation_span = dictation_spans[-1]
+        if dictation_span['index_end'] == len(align_words) - 1:
+            dictation_span['offset_end'] = len(audio_data)
+        else:
+            next_word_time = times[dictation_span['index_end'] + 1]
+            dictation_span['offset_end'] = (dictation_span['offset_end'] + next_word_time) // 2
+
+        return [(dictation_span['offset_start'], dictation_span['offset_end']) for dictation_span in dictation_spans]
+
+    def _prepare_alternative_dictation(self, dictation_info_func):
+        """ Returns (alternative_text_func, dictation_audios, speculative_stream) for the alternative dictation spans of the utterance. """
+        if callable(self.alternative_dictation):
+            alternative_text_func = self.alternative_dictation
+        else:
+            raise TypeError("Invalid alternative_dictation value: %r" % self.alternative_dictation)
+
+        audio_data, word_align = dictation_info_func()
+        self._log.log(5, "alternative_dictation word_align: %s", word_align)
+        dictation_spans = self._get_alternative_dictation_spans(audio_data, word_align)
+        # Slice all spans up front, so they can be processed concurrently
+        dictation_audios = [audio_data[offset_start : offset_end] for (offset_start, offset_end) in dictation_spans]
+        speculative_stream = self._take_speculative_dictation(audio_data, dictation_spans[-1])
+        # If the last span was already streamed during the utterance, only its tail remains to be processed
+        return alternative_text_func, dictation_audios, speculative_stream
+
+    def _perform_alternative_dictation(self, parsed_output, dictation_info_func):
+        """ Returns ``parsed_output`` with the text of each alternative dictation span replaced by the alternative_dictation result for its audio. """
+        alternative_text_func, dictation_audios, speculative_stream = self._prepare_alternative_dictation(dictation_info_func)
+        with debug_timer(self._log.debug, 'alternative_dictation calls'):
+            if speculative_stream is None:
+                alternative_texts = self._call_alternative_dictation(alternative_text_func, dictation_audios)
+            else:
+                alternative_texts = self._call_alternative_dictation(alternative_text_func, dictation_audios[:-1])
+                alternative_texts.append(self._finish_speculative_dictation(speculative_stream))
+        return self._replace_alternative_dictation(parsed_output, dictation_audios, alternative_texts)
+
+    async def _perform_alternative_dictation_async(self, parsed_output, dictation_info_func):
+        """ Like _perform_alternative_dictation, but awaits async alternative_dictation on the running event loop, and runs blocking calls in its default executor. """
+        loop = asyncio.get_running_loop()
+        alternative_text_func, dictation_audios, speculative_stream = self._prepare_alternative_dictation(dictation_info_func)
+        with debug_timer(self._log.debug, 'alternative_dictation calls'):
+            if speculative_stream is None:
+                alternative_texts = await self._call_alternative_dictation_async(alternative_text_func, dictation_audios)
+            else:
+                alternative_texts = await self._call_alternative_dictation_async(alternative_text_func, dictation_audios[:-1])
+                alternative_texts.append(await loop.run_in_executor(None, self._finish_speculative_dictation, speculative_stream))
+        return self._replace_alternative_dictation(parsed_output, dictation_audios, alternative_texts)
+
+    def _replace_alternative_dictation(self, parsed_output, dictation_audios, alternative_texts):
+        for dictation_audio, alternative_text in zip(dictation_audios, alternative_texts):
+            self._log.debug("alternative_dictation: %.2fs audio -> %r", (len(dictation_audio) / self._alternative_dictation_bytes_per_second), alternative_text)
+        # alternative_dictation.write_wav('test.wav', dictation_audio)
+
+        alternative_texts = iter(alternative_texts)
+        def replace_dictation(matchobj: re.Match) -> str:
+            orig_text = matchobj.group(1)
+            alternative_text = next(alternative_texts, None)
+            return (alternative_text or orig_text)
+        return self.alternative_dictation_regex.sub(replace_dictation, parsed_output)
+
+    def _update_speculative_dictation(self, kaldi_rule, parsed_output, dictation_info_func):
         """
-        dictation_info_func: Optional but required for using alternative_dictation; expected to be (audio_data, wrapper::KaldiNNet3Decoder.get_word_align output).
+        For a partial output currently within an alternative dictation span, streams the span's audio so far to the
+        alternative_dictation stream, starting one once the span has lasted alternative_dictation_speculative_delay seconds.
         """
-        assert self.parsing_framework == 'token'
-        self._log.debug("parse_output(%r)" % output)
-        if (output == '') or (output in self._noise_words):
-            return None, [], []
+        open_span_index = parsed_output.rfind('#nonterm:dictation_cloud')
+        if (kaldi_rule is None or not kaldi_rule.has_dictation or open_span_index < 0
+                or parsed_output.find('#nonterm:end', open_span_index) >= 0):
+            return  # Not within an alternative dictation span; keep any stream for the final result
+        audio_data, word_align = dictation_info_func()
+        align_words, times = self._get_word_align_words_and_times(word_align)
+        offset_start = [time for (word, time) in zip(align_words, times) if word.startswith('#nonterm:dictation_cloud')][-1]
+
+        speculative = self._speculative_dictation
+        if speculative is not None and abs(speculative['offset_start'] - offset_start) > self._speculative_dictation_tolerance_bytes:
+            self._log.debug("speculative alternative_dictation: span start moved from %d to %d; restarting", speculative['offset_start'], offset_start)
+            self._cancel_speculative_dictation()
+            speculative = None
+        if speculative is None:
+            if (len(audio_data) - offset_start) < (self.alternative_dictation_speculative_delay * self._alternative_dictation_bytes_per_second):
+                return
+            self._log.debug("speculative alternative_dictation: starting stream at %d", offset_start)
+            speculative = self._speculative_dictation = dict(stream=self.alternative_dictation.start_stream(), offset_start=offset_start, offset_fed=offset_start)
+        if len(audio_data) > speculative['offset_fed']:
+            speculative['stream'].feed(audio_data[speculative['offset_fed']:])
+            speculative['offset_fed'] = len(audio_data)
+
+    def _take_speculative_dictation(self, audio_data, dictation_span):
+        """ Returns the speculative stream if it matches final ``dictation_span`` (having fed it the rest of the span's audio), else None. """
+        speculative, self._speculative_dictation = self._speculative_dictation, None
+        if speculative is None:
+            return None
+        offset_start, offset_end = dictation_span
+        if (abs(speculative['offset_start'] - offset_start) > self._speculative_dictation_tolerance_bytes
+                or speculative['offset_fed'] > offset_end):
+            self._log.debug("speculative alternative_dictation: stream does not match final span; discarding")
+            self._cancel_stream(speculative['stream'])
+            return None
+        try:
+            speculative['stream'].feed(audio_data[speculative['offset_fed'] : offset_end])
+        except Exception:
+            self._log.exception("Exception in speculative alternative_dictation; discarding")
+            self._cancel_stream(speculative['stream'])
+            return None
+        return speculative['stream']
 
-        nonterm_token, _, parsed_output = output.partition(' ')
-        assert nonterm_token.startswith('#nonterm:rule')
-        kaldi_rule_id = int(nonterm_token[len('#nonterm:rule'):])
-        kaldi_rule = self.kaldi_rule_by_id_dict[kaldi_rule_id]
+    def _finish_speculative_dictation(self, stream):
+        try:
+            if self.alternative_dictation_parallel:
+                return self.alternative_dictation_executor.submit(stream.finish).result(timeout=self.alternative_dictation_timeout)
+            return stream.finish()
+        except concurrent.futures.TimeoutError:
+            self._log.warning("speculative alternative_dictation timed out after %ss; using kaldi dictation", self.alternative_dictation_timeout)
+        except Exception:
+            self._log.exception("Exception in speculative alternative_dictation; using kaldi dictation")
+        self._cancel_stream(stream)
+        return None
+
+    def _cancel_speculative_dictation(self):
+        speculative, self._speculative_dictation = self._speculative_dictation, None
+        if speculative is not None:
+            self._cancel_stream(speculative['stream'])
+
+    def _cancel_stream(self, stream):
+        try:
+            stream.cancel()
+        except Exception:
+            self._log.exception("Exception cancelling speculative alternative_dictation stream")
+
+    def _call_alternative_dictation(self, alternative_text_func, dictation_audios):
+        """
+        Returns list of the alternative text for each of ``dictation_audios``, in order. Async callables (anything returning
+        an awaitable), and all callables when alternative_dictation_parallel, are run concurrently, with each span falling
+        back to None (the Kaldi text) upon exception or after alternative_dictation_timeout.
+        """
+        timeout = self.alternative_dictation_timeout
+        if self.alternative_dictation_parallel and not inspect.iscoroutinefunction(alternative_text_func):
+            alternative_texts = self._call_alternative_dictation_parallel(alternative_text_func, dictation_audios, timeout)
+        else:
+            # Calling an async callable only creates its awaitable, so they are still awaited concurrently below
+            alternative_texts = [alternative_text_func(dictation_audio) for dictation_audio in dictation_audios]
 
-        if self.alternative_dictation and dictation_info_func and kaldi_rule.has_dictation and '#nonterm:dictation_cloud' in parsed_output:
+        if not any(inspect.isawaitable(alternative_text) for alternative_text in alternative_texts):
+            return alternative_texts
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._await_alternative_dictation(alternative_texts, timeout))
+        # Blocking here would stall the running event loop, which the awaitables may well be bound to
+        for alternative_text in alternative_texts:
+            if inspect.iscoroutine(alternative_text): alternative_text.close()
+        raise KaldiError("async alternative_dictation cannot be awaited by parse_output from within a running event loop; await parse_output_async instead")
+
+    async def _call_alternative_dictation_async(self, alternative_text_func, dictation_audios):
+        """ Like _call_alternative_dictation, but awaits on the running event loop, running alternative_dictation_parallel calls in its default executor. """
+        timeout = self.alternative_dictation_timeout
+        if self.alternative_dictation_parallel and not inspect.iscoroutinefunction(alternative_text_func):
+            alternative_texts = await asyncio.get_running_loop().run_in_executor(None,
+                self._call_alternative_dictation_parallel, alternative_text_func, dictation_audios, timeout)
+        else:
+            alternative_texts = [alternative_text_func(dictation_audio) for dictation_audio in dictation_audios]
+        return await self._await_alternative_dictation(alternative_texts, timeout)
+
+    def _call_alternative_dictation_parallel(self, alternative_text_func, dictation_audios, timeout):
+        futures = [self.alternative_dictation_executor.submit(alternative_text_func, dictation_audio) for dictation_audio in dictation_audios]
+        deadline = (clock() + timeout) if timeout is not None else None
+        alternative_texts = []
+        for future in futures:
             try:
-                if callable(self.alternative_dictation):
-                    alternative_text_func = self.alternative_dictation
-                else:
-                    raise TypeError("Invalid alternative_dictation value: %r" % self.alternative_dictation)
-
-                audio_data, word_align = dictation_info_func()
-                self._log.log(5, "alternative_dictation word_align: %s", word_align)
-                words, times, lengths = list(zip(*word_align))
-                # Find start & end word-index & byte-offset of each alternative dictation span
-                dictation_spans = [{
-                        'index_start': index,
-                        'offset_start': time,
-                        'index_end': words.index('#nonterm:end', index),
-                        'offset_end': times[words.index('#nonterm:end', index)],
-                    }
-                    for index, (word, time, length) in enumerate(word_align)
-                    if word.startswith('#nonterm:dictation_cloud')]
-
-                # If last dictation is at end of utterance, it should include rest of audio_data; else, it should include half of audio_data between dictation end and start of next word
-                dictation_span = dictation_spans[-1]
-                if dictation_span['index_end'] == len(word_align) - 1:
-                    dictation_span['offset_end'] = len(audio_data)
-                else:
-                    next_word_time = times[dictation_span['index_end'] + 1]
-                    dictation_span['offset_end'] = (dictation_span['offset_end'] + next_word_time) // 2
-
-                def replace_dictation(matchobj: re.Match) -> str:
-                    orig_text = matchobj.group(1)
-                    dictation_span = dictation_spans.pop(0)
-                    dictation_audio = audio_data[dictation_span['offset_start'] : dictation_span['offset_end']]
-                    with debug_timer(self._log.debug, 'alternative_dictation call'):
-                        alternative_text = alternative_text_func(dictation_audio)
-                        self._log.debug("alternative_dictation: %.2fs audio -> %r", (0.5 * len(dictation_audio) / 16000), alternative_text)  # FIXME: hardcoded sample_rate!
-                    # alternative_dictation.write_wav('test.wav', dictation_audio)
-                    return (alternative_text or orig_text)
-
-                parsed_output = self.alternative_dictation_regex.sub(replace_dictation, parsed_output)
-            except Exception as e:
-                self._log.exception("Exception performing alternative dictation")
+                alternative_texts.append(future.result(timeout=(max(0, deadline - clock()) if deadline is not None else None)))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                self._log.warning("alternative_dictation timed out after %ss; using kaldi dictation", timeout)
+                alternative_texts.append(None)
+            except Exception:
+                self._log.exception("Exception in alternative_dictation; using kaldi dictation")
+                alternative_texts.append(None)
+        return alternative_texts
+
+    async def _await_alternative_dictation(self, alternative_texts, timeout):
+        async def wait(alternative_text):
+            if not inspect.isawaitable(alternative_text):
+                return alternative_text
+            try:
+                return await asyncio.wait_for(alternative_text, timeout)
+            except asyncio.TimeoutError:
+                self._log.warning("alternative_dictation timed out after %ss; using kaldi dictation", timeout)
+            except Exception:
+                self._log.exception("Exception in alternative_dictation; using kaldi dictation")
+            return None
+        return await asyncio.gather(*[wait(alternative_text) for alternative_text in alternative_texts])
 
+    def _parse_output_words(self, parsed_output):
+        """ Returns (words, words_are_dictation_mask, in_dictation) for the output text following the rule nonterm. """
         words = []
         words_are_dictation_mask = []
         in_dictation = False
@@ -750,35 +1474,112 @@ class Compiler(object):
             else:
                 words.append(word)
                 words_are_dictation_mask.append(in_dictation)
+        return tuple(words), tuple(words_are_dictation_mask), in_dictation
 
-        return kaldi_rule, words, words_are_dictation_mask
-
-    def parse_partial_output(self, output):
-        assert self.parsing_framework == 'token'
-        self._log.log(3, "parse_partial_output(%r)", output)
+    def _parse_output_uncached(self, output):
+        """ Returns (kaldi_rule, parsed_output, words, words_are_dictation_mask, in_dictation) for the output, with kaldi_rule None if it is not a result. """
         if (output == '') or (output in self._noise_words):
-            return None, [], [], False
-
+            return None, '', (), (), False
         nonterm_token, _, parsed_output = output.partition(' ')
         assert nonterm_token.startswith('#nonterm:rule')
         kaldi_rule_id = int(nonterm_token[len('#nonterm:rule'):])
-        kaldi_rule = self.kaldi_rule_by_id_dict[kaldi_rule_id]
+        kaldi_rule = self.kaldi_rule_by_id_dict.get(kaldi_rule_id)
+        if kaldi_rule is None:
+            # Vacant id, holding only the placeholder (see KaldiRule.destroy)
+            return None, '', (), (), False
+        if kaldi_rule.subgrammar:
+            # Only valid when entered from a referencing rule
+            self._log.debug("parse_output: ignoring output of subgrammar %s on its own", kaldi_rule)
+            return None, '', (), (), False
+        return (kaldi_rule, parsed_output) + self._parse_output_words(parsed_output)
+
+    def _parse_output_cache_clear(self):
+        self._parse_output_cached.cache_clear()
 
-        words = []
-        words_are_dictation_mask = []
-        in_dictation = False
-        for word in parsed_output.split():
-            if word.startswith('#nonterm:'):
-                if word.startswith('#nonterm:dictation'):
-                    in_dictation = True
-                elif in_dictation and word == '#nonterm:end':
-                    in_dictation = False
-            else:
-                words.append(word)
-                words_are_dictation_mask.append(in_dictation)
+    def parse_output(self, output, dictation_info_func=None):
+        """
+        Returns (kaldi_rule, words, words_are_dictation_mask), with the latter two as tuples; results are cached by ``output``
+        (while the set of rules is unchanged), except when performing alternative dictation.
+        dictation_info_func: Optional but required for using alternative_dictation; expected to return (audio_data, wrapper::KaldiNNet3Decoder.get_word_align or get_word_align_array output), and only called when needed (see wrapper::KaldiNNet3Decoder.make_dictation_info_func).
+        """
+        assert self.parsing_framework == 'token'
+        self._log.debug("parse_output(%r)" % output)
+        kaldi_rule, parsed_output, words, words_are_dictation_mask, in_dictation = self._parse_output_cached(output)
+        if kaldi_rule is None:
+            if self._speculative_dictation is not None:
+                self._cancel_speculative_dictation()
+            return None, (), ()
+
+        if self._wants_alternative_dictation(kaldi_rule, parsed_output, dictation_info_func):
+            try:
+                parsed_output = self._perform_alternative_dictation(parsed_output, dictation_info_func)
+                words, words_are_dictation_mask, in_dictation = self._parse_output_words(parsed_output)
+            except Exception as e:
+                self._log.exception("Exception performing alternative dictation")
+        if self._speculative_dictation is not None:
+            self._cancel_speculative_dictation()
 
+        return kaldi_rule, words, words_are_dictation_mask
+
+    async def parse_output_async(self, output, dictation_info_func=None):
+        """
+        Like parse_output, but for calling from within a running event loop: async alternative_dictation is awaited on that
+        loop, and blocking alternative dictation calls run in its default executor rather than blocking it.
+        """
+        assert self.parsing_framework == 'token'
+        self._log.debug("parse_output_async(%r)" % output)
+        kaldi_rule, parsed_output, words, words_are_dictation_mask, in_dictation = self._parse_output_cached(output)
+        if kaldi_rule is None:
+            if self._speculative_dictation is not None:
+                self._cancel_speculative_dictation()
+            return None, (), ()
+
+        if self._wants_alternative_dictation(kaldi_rule, parsed_output, dictation_info_func):
+            try:
+                parsed_output = await self._perform_alternative_dictation_async(parsed_output, dictation_info_func)
+                words, words_are_dictation_mask, in_dictation = self._parse_output_words(parsed_output)
+            except Exception as e:
+                self._log.exception("Exception performing alternative dictation")
+        if self._speculative_dictation is not None:
+            self._cancel_speculative_dictation()
+
+        return kaldi_rule, words, words_are_dictation_mask
+
+    def _wants_alternative_dictation(self, kaldi_rule, parsed_output, dictation_info_func):
+        return bool(self.alternative_dictation and dictation_info_func and kaldi_rule.has_dictation and '#nonterm:dictation_cloud' in parsed_output)
+
+    def parse_partial_output(self, output, dictation_info_func=None):
+        """
+        Returns (kaldi_rule, words, words_are_dictation_mask, in_dictation), with words and mask as tuples; cached like parse_output.
+        dictation_info_func: Optional, for speculative alternative dictation (see Compiler.__init__); expected to be as for parse_output, but for the partial output and the audio_data so far.
+        """
+        assert self.parsing_framework == 'token'
+        self._log.log(3, "parse_partial_output(%r)", output)
+        kaldi_rule, parsed_output, words, words_are_dictation_mask, in_dictation = self._parse_output_cached(output)
+        if in_dictation and dictation_info_func and self.alternative_dictation_speculative_delay is not None:
+            try:
+                self._update_speculative_dictation(kaldi_rule, parsed_output, dictation_info_func)
+            except Exception as e:
+                self._log.exception("Exception performing speculative alternative dictation")
+                self._cancel_speculative_dictation()
         return kaldi_rule, words, words_are_dictation_mask, in_dictation
 
+    def _get_endpoint_state(self, output):
+        """
+        Returns (reached_final, in_dictation, has_dictation) for partial ``output``, for decoder endpointing & early commit:
+        whether it is a complete match of its rule, whether it is within dictation, and whether its rule has dictation.
+        """
+        kaldi_rule, words, words_are_dictation_mask, in_dictation = self.parse_partial_output(output)
+        if kaldi_rule is None or in_dictation:
+            return False, in_dictation, (kaldi_rule is not None and kaldi_rule.has_dictation)
+        try:
+            # Does not follow subgrammar references, so such rules only endpoint by the rules not requiring a final state
+            reached_final = kaldi_rule.fst.does_match(remove_nonterms_in_text(output).split(), wildcard_nonterms=self.wildcard_nonterms) is not False
+        except Exception as e:
+            self._log.log(5, "_get_endpoint_state: cannot match %r for %s: %s", output, kaldi_rule, e)
+            reached_final = False
+        return reached_final, in_dictation, kaldi_rule.has_dictation
+
 ########################################################################################################################
 # Utility functions.
 
@@ -794,6 +1595,13 @@ def remove_nonterms_in_words(words):
 def remove_nonterms_in_text(text):
     return remove_words_in_text(text, lambda word: word.startswith('#nonterm:'))
 
+def shutdown_executor(executor, wait):
+    """ Shuts down a concurrent.futures.Executor, cancelling its pending futures (cancel_futures requires Python 3.9+). """
+    try:
+        executor.shutdown(wait=wait, cancel_futures=True)
+    except TypeError:
+        executor.shutdown(wait=wait)
+
 def run_subprocess(cmd, format_kwargs, description=None, format_kwargs_update=None, **kwargs):
     with debug_timer(_log.debug, description or "description", False), open(os.devnull, 'wb') as devnull:
         output = None if _log.isEnabledFor(logging.DEBUG) else devnull
@@ -6,7 +6,24 @@
 
 DEFAULT_MODEL_DIR = 'kaldi_model'
 FILE_CACHE_FILENAME = 'file_cache.json'
+DEFAULT_MAX_NUM_RULES = 1000  # For converting models; existing models define their own limit
+
+# Endpointing rules (see wrapper::KaldiNNet3Decoder.detect_endpoint), after Kaldi's online2 OnlineEndpointConfig: an
+# endpoint is detected when any rule is satisfied. Times are in seconds. Stricter rules apply while in dictation.
+DEFAULT_ENDPOINT_RULES = (
+    dict(must_contain_nonsilence=False, min_trailing_silence=5.0, must_reach_final=False, min_utterance_length=0.0),
+    dict(must_contain_nonsilence=True, min_trailing_silence=0.15, must_reach_final=True, min_utterance_length=0.0),
+    dict(must_contain_nonsilence=True, min_trailing_silence=0.6, must_reach_final=False, min_utterance_length=0.0),
+    dict(must_contain_nonsilence=False, min_trailing_silence=0.0, must_reach_final=False, min_utterance_length=20.0),
+)
+DEFAULT_DICTATION_ENDPOINT_RULES = (
+    dict(must_contain_nonsilence=False, min_trailing_silence=5.0, must_reach_final=False, min_utterance_length=0.0),
+    dict(must_contain_nonsilence=True, min_trailing_silence=1.0, must_reach_final=False, min_utterance_length=0.0),
+    dict(must_contain_nonsilence=False, min_trailing_silence=0.0, must_reach_final=False, min_utterance_length=30.0),
+)
 
 DEFAULT_DICTATION_G_FILENAME = 'G.fst'
 DEFAULT_DICTATION_FST_FILENAME = 'Dictation.fst'
 DEFAULT_PLAIN_DICTATION_HCLG_FST_FILENAME = 'HCLG.fst'
+DEFAULT_REDUCED_DICTATION_FST_FILENAME = 'Dictation.reduced.fst'
+DEFAULT_REDUCED_PLAIN_DICTATION_HCLG_FST_FILENAME = 'HCLG.reduced.fst'
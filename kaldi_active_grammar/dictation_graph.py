@@ -0,0 +1,385 @@
+#
+# This file is part of kaldi-active-grammar.
+# (c) Copyright 2019 by David Zurow
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Building dictation graphs: cached by the hash of their inputs, so unchanged graphs are not rebuilt; and reduced in size,
+from a pruned and/or vocabulary-restricted language model, evaluated on a local test set.
+"""
+
+import math, os, sys
+from io import open
+
+from . import _log, KaldiError
+from .utils import clock
+
+_log = _log.getChild('dictation_graph')
+
+
+########################################################################################################################
+
+def _peak_memory_bytes():
+    """ Returns (peak resident memory of this process, of its largest terminated child process) in bytes, or None if unavailable. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, but KiB elsewhere
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+########################################################################################################################
+
+class DictationGraphBuilder(object):
+    """
+    Builds a dictation graph (HCLG) from a G.fst, keyed by the hash of its inputs (the contents of the G.fst and of the
+    model files it reads, and the graph options) in the model's FSTFileCache, and skipped if the graph for that key
+    already exists.
+
+    After ``build``, ``report`` is a dict(skipped, seconds, peak_memory_mb, output). Peak memory is the new peak resident
+    memory reached during the build, by this process or by its external compilation process, whichever is larger; it is
+    None if the build stayed below the peaks reached before it (or they are unavailable).
+    """
+
+    # Names of model files the graph is built from
+    dependencies = ('L_disambig_fst', 'disambig_int', 'words_txt', 'tree', 'final_mdl')
+
+    def __init__(self, compiler, nonterm=True):
+        """
+        Args:
+            nonterm (bool): whether to build the graph for #nonterm:dictation in the active grammar (else a plain HCLG)
+        """
+        self.compiler = compiler
+        self.nonterm = bool(nonterm)
+        self.report = None
+
+    name = property(lambda self: 'dictation' if self.nonterm else 'plain_dictation')
+    fst_cache = property(lambda self: self.compiler.fst_cache)
+
+    def build(self, g_filename, output_filename, force=False):
+        """ Builds the graph from ``g_filename`` to ``output_filename``, unless it is current (and not ``force``). Returns ``report``. """
+        if not os.path.isfile(g_filename): raise KaldiError("cannot find G.fst: %r" % g_filename)
+        fst_cache = self.fst_cache
+        files_dict = self.compiler.files_dict
+        model = self.compiler.model
+
+        key = fst_cache.hash_data(['HCLG', fst_cache.hash_file(g_filename), self.nonterm, model.nonterm_phones_offset, model.nonterm_words_offset]
+            + [fst_cache.hash_file(files_dict[name]) for name in self.dependencies])
+        if fst_cache.file_is_current(output_filename, data=key) and not force:
+            _log.info("%s: %r is current; skipped", self, output_filename)
+            self.report = dict(skipped=True, seconds=0.0, peak_memory_mb=None, output=output_filename)
+        else:
+            if self.nonterm:
+                self._run_build(output_filename, lambda: self.compiler._compile_agf_graph(
+                    input_filename=g_filename, output_filename=output_filename, nonterm=True, simplify_lg=False))
+            else:
+                self._run_build(output_filename, lambda: self.compiler._compile_plain_dictation_graph(g_filename, output_filename))
+            fst_cache.add_file(output_filename, data=key)
+
+        if fst_cache.dirty:
+            fst_cache.save()
+        return self.report
+
+    def _run_build(self, output_filename, build_func):
+        """ Calls ``build_func()`` to build ``output_filename``, setting ``report`` with its time and peak memory. """
+        peak_before = _peak_memory_bytes()
+        start_time = clock()
+        build_func()
+        seconds = clock() - start_time
+
+        peak_memory_mb = None
+        peak_after = _peak_memory_bytes()
+        if peak_after is not None:
+            # Peaks are over the whole life of the process (and all its children), so only count if they grew during the build
+            peaks = [after for (before, after) in zip(peak_before, peak_after) if after > before]
+            if peaks: peak_memory_mb = max(peaks) / float(1 << 20)
+        _log.info("%s: build took %.1f s, peak memory %s MB", self, seconds,
+            ('%.0f' % peak_memory_mb) if peak_memory_mb is not None else 'unknown')
+        self.report = dict(skipped=False, seconds=seconds, peak_memory_mb=peak_memory_mb, output=output_filename)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.name)
+
+
+########################################################################################################################
+
+class ArpaLanguageModel(object):
+    """
+    N-gram language model in ARPA format, as ``ngrams[order - 1]``: a dict of word tuple -> [log10 prob, log10 backoff
+    weight (or None)]. Supports relative entropy pruning and vocabulary restriction, to build smaller dictation graphs,
+    and conversion to the text of a G.fst (like Kaldi's arpa2fst).
+    """
+
+    special_words = frozenset(['<s>', '</s>', '<unk>'])
+
+    def __init__(self, ngrams=None):
+        self.ngrams = ngrams if ngrams is not None else []
+
+    order = property(lambda self: len(self.ngrams))
+    num_ngrams = property(lambda self: sum(len(ngrams) for ngrams in self.ngrams))
+    num_ngrams_by_order = property(lambda self: [len(ngrams) for ngrams in self.ngrams])
+    words = property(lambda self: set(ngram[0] for ngram in self.ngrams[0]) if self.ngrams else set())
+
+    @classmethod
+    def read(cls, filename):
+        """ Reads ARPA file ``filename`` (optionally gzipped). """
+        if filename.endswith('.gz'):
+            import gzip
+            f = gzip.open(filename, 'rt', encoding='utf-8')
+        else:
+            f = open(filename, 'r', encoding='utf-8')
+        ngrams = []
+        order = None
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line or line == '\\data\\' or line.startswith('ngram '):
+                    continue
+                if line == '\\end\\':
+                    break
+                if line.startswith('\\') and line.endswith('-grams:'):
+                    order = int(line[1:-len('-grams:')])
+                    while len(ngrams) < order:
+                        ngrams.append(dict())
+                    continue
+                if order is None: raise KaldiError("invalid ARPA file %r: n-gram before any section" % filename)
+                fields = line.split()
+                if len(fields) not in (order + 1, order + 2): raise KaldiError("invalid ARPA file %r: line %r" % (filename, line))
+                backoff = float(fields[order + 1]) if len(fields) == order + 2 else None
+                ngrams[order - 1][tuple(fields[1 : order + 1])] = [float(fields[0]), backoff]
+        if not ngrams: raise KaldiError("invalid ARPA file %r: no n-grams" % filename)
+        return cls(ngrams)
+
+    def write(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('\\data\\\n')
+            for order, ngrams in enumerate(self.ngrams, 1):
+                f.write('ngram %d=%d\n' % (order, len(ngrams)))
+            for order, ngrams in enumerate(self.ngrams, 1):
+                f.write('\n\\%d-grams:\n' % order)
+                for ngram, (log_prob, backoff) in ngrams.items():
+                    if backoff is None: f.write('%.7g\t%s\n' % (log_prob, ' '.join(ngram)))
+                    else: f.write('%.7g\t%s\t%.7g\n' % (log_prob, ' '.join(ngram), backoff))
+            f.write('\n\\end\\\n')
+
+    def backoff(self, history):
+        """ Returns the log10 backoff weight of ``history`` (tuple of words). """
+        entry = self.ngrams[len(history) - 1].get(history) if 0 < len(history) <= self.order else None
+        return entry[1] if (entry is not None and entry[1] is not None) else 0.0
+
+    def log_prob(self, ngram):
+        """ Returns the log10 probability of the last word of ``ngram`` (tuple of words) given the preceding ones, backing off as necessary. """
+        ngram = ngram[-self.order:]
+        result = 0.0
+        while True:
+            entry = self.ngrams[len(ngram) - 1].get(ngram)
+            if entry is not None:
+                return result + entry[0]
+            if len(ngram) == 1:
+                entry = self.ngrams[0].get(('<unk>',))
+                return result + (entry[0] if entry is not None else -99.0)
+            result += self.backoff(ngram[:-1])
+            ngram = ngram[1:]
+
+    def _history_log_prob(self, history, cache):
+        if history not in cache:
+            start = 1 if history[0] == '<s>' else 0  # Sentences always begin with <s>
+            cache[history] = sum(self.log_prob(history[:i + 1]) for i in range(start, len(history)))
+        return cache[history]
+
+    def _children(self, order):
+        """ Returns dict of history -> list of words following it, of the n-grams of ``order``. """
+        children = dict()
+        for ngram in self.ngrams[order - 1]:
+            children.setdefault(ngram[:-1], []).append(ngram[-1])
+        return children
+
+    def _backoff_masses(self, history, words):
+        # Returns (probability mass left for backing off from history, probability mass of words in the backoff distribution)
+        numerator = 1.0 - sum(10 ** self.ngrams[len(history)][history + (word,)][0] for word in words)
+        denominator = 1.0 - sum(10 ** self.log_prob(history[1:] + (word,)) for word in words)
+        return max(numerator, 1e-10), max(denominator, 1e-10)
+
+    def recompute_backoffs(self):
+        """ Recomputes all backoff weights, so each history's distribution is normalized (e.g. after removing n-grams). """
+        for order in range(1, self.order):
+            children = self._children(order + 1)
+            for history, entry in self.ngrams[order - 1].items():
+                words = children.get(history)
+                if not words:
+                    entry[1] = None
+                else:
+                    numerator, denominator = self._backoff_masses(history, words)
+                    entry[1] = math.log10(numerator / denominator)
+
+    def prune(self, target_num_ngrams=None, threshold=None):
+        """
+        Relative entropy (Stolcke) pruning: removes the n-grams (above unigrams) whose removal least increases the
+        model's perplexity, until at most ``target_num_ngrams`` remain, and/or those increasing it relatively by less
+        than ``threshold``. N-grams that are the history of a remaining higher order n-gram are kept. Returns the
+        number of n-grams removed.
+        """
+        if target_num_ngrams is None and threshold is None: raise KaldiError("prune requires target_num_ngrams or threshold")
+        history_cache = dict()
+        candidates = []  # (delta entropy, order, ngram)
+        for order in range(2, self.order + 1):
+            for history, words in self._children(order).items():
+                numerator, denominator = self._backoff_masses(history, words)
+                history_prob = 10 ** self._history_log_prob(history, history_cache)
+                for word in words:
+                    ngram = history + (word,)
+                    prob = 10 ** self.ngrams[order - 1][ngram][0]
+                    lower_prob = 10 ** self.log_prob(ngram[1:])
+                    pruned_backoff = (numerator + prob) / (denominator + lower_prob)
+                    delta = -history_prob * (prob * (math.log(lower_prob * pruned_backoff) - math.log(prob))
+                        + numerator * (math.log(pruned_backoff) - math.log(numerator / denominator)))
+                    candidates.append((delta, order, ngram))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        def select(num_candidates):
+            # Returns the set of n-grams to remove among the first num_candidates, keeping histories of remaining n-grams
+            selected = set(ngram for (delta, order, ngram) in candidates[:num_candidates])
+            removed = set()
+            for order in range(self.order, 1, -1):
+                histories = set(ngram[:-1] for ngram in self.ngrams[order] if ngram not in removed) if order < self.order else set()
+                removed.update(ngram for ngram in self.ngrams[order - 1] if ngram in selected and ngram not in histories)
+            return removed
+
+        num_candidates = 0
+        if threshold is not None:
+            num_candidates = sum(1 for candidate in candidates if math.expm1(candidate[0]) < threshold)
+        removed = select(num_candidates)
+        if target_num_ngrams is not None and self.num_ngrams - len(removed) > target_num_ngrams:
+            # Binary search for the fewest candidates to reach the target (removal is monotonic in the number of candidates)
+            low, high = num_candidates, len(candidates)
+            while low < high:
+                middle = (low + high) // 2
+                if self.num_ngrams - len(select(middle)) <= target_num_ngrams: high = middle
+                else: low = middle + 1
+            removed = select(low)
+            if self.num_ngrams - len(removed) > target_num_ngrams:
+                _log.warning("%s: cannot prune to %d n-grams; unigrams and needed histories alone are %d", self, target_num_ngrams, self.num_ngrams - len(removed))
+
+        for ngram in removed:
+            del self.ngrams[len(ngram) - 1][ngram]
+        self.recompute_backoffs()
+        return len(removed)
+
+    def restrict_vocabulary(self, words):
+        """ Removes all n-grams containing words not in ``words`` (besides <s>, </s>, <unk>), renormalizing. Returns the number of words removed. """
+        words = set(words) | self.special_words
+        num_removed_words = len(self.words - words)
+        for ngrams in self.ngrams:
+            for ngram in [ngram for ngram in ngrams if not words.issuperset(ngram)]:
+                del ngrams[ngram]
+        total = sum(10 ** entry[0] for (ngram, entry) in self.ngrams[0].items() if ngram != ('<s>',))
+        if total <= 0: raise KaldiError("no words left in language model after restricting vocabulary")
+        for ngram, entry in self.ngrams[0].items():
+            if ngram != ('<s>',):
+                entry[0] -= math.log10(total)
+        self.recompute_backoffs()
+        return num_removed_words
+
+    def get_fst_text(self, disambig_symbol='#0'):
+        """
+        Returns the text (in OpenFst format, with costs in natural log) of a G.fst for the model: a state per history, and
+        backoff arcs with input ``disambig_symbol``.
+        """
+        ln10 = math.log(10)
+        histories = set([(), ('<s>',)])
+        for ngrams in self.ngrams[:-1]:
+            histories.update(ngram for (ngram, entry) in ngrams.items() if entry[1] is not None)
+        state_ids = dict()
+        def get_state_id(ngram):
+            # Longest suffix of ngram that is a history; the start state must be 0
+            while ngram not in histories:
+                ngram = ngram[1:]
+            return state_ids.setdefault(ngram, len(state_ids))
+        get_state_id(('<s>',))
+
+        lines_by_state = dict()
+        finals = dict()
+        for ngrams in self.ngrams:
+            for ngram, (log_prob, backoff) in ngrams.items():
+                word = ngram[-1]
+                if word == '<s>':
+                    continue
+                src_state = get_state_id(ngram[:-1])
+                if word == '</s>':
+                    finals[src_state] = -log_prob * ln10
+                else:
+                    lines_by_state.setdefault(src_state, []).append('%d %d %s %s %.6g' % (src_state, get_state_id(ngram), word, word, -log_prob * ln10))
+        for history in histories:
+            if history:
+                src_state = get_state_id(history)
+                lines_by_state.setdefault(src_state, []).append('%d %d %s <eps> %.6g' % (src_state, get_state_id(history[1:]), disambig_symbol, -self.backoff(history) * ln10))
+
+        lines = []
+        for state in sorted(lines_by_state):
+            lines.extend(lines_by_state[state])
+        lines.extend('%d %.6g' % (state, cost) for (state, cost) in sorted(finals.items()))
+        return '\n'.join(lines) + '\n'
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, '/'.join(str(num) for num in self.num_ngrams_by_order))
+
+
+########################################################################################################################
+
+def read_test_set(filename):
+    """
+    Returns list of (wav filename, transcript) read from ``filename``, which has a line per utterance: its wav filename
+    (relative to the directory of ``filename``), then its transcript.
+    """
+    test_set = []
+    directory = os.path.dirname(os.path.abspath(filename))
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.strip().split(None, 1)
+            if fields:
+                test_set.append((os.path.join(directory, fields[0]), fields[1] if len(fields) > 1 else ''))
+    return test_set
+
+def word_edit_distance(reference, hypothesis):
+    """ Returns the number of word substitutions, deletions, and insertions to turn ``reference`` into ``hypothesis`` (lists of words). """
+    distances = list(range(len(hypothesis) + 1))
+    for i, reference_word in enumerate(reference, 1):
+        previous_diagonal, distances[0] = distances[0], i
+        for j, hypothesis_word in enumerate(hypothesis, 1):
+            previous_diagonal, distances[j] = distances[j], min(distances[j] + 1, distances[j - 1] + 1,
+                previous_diagonal + (reference_word != hypothesis_word))
+    return distances[-1]
+
+def evaluate_dictation_graph(graph_filename, test_set, plain=True, model_dir=None, tmp_dir=None):
+    """
+    Decodes each utterance of ``test_set`` (list of (wav filename, transcript), of mono ``int16`` audio) with dictation
+    graph ``graph_filename`` (a plain HCLG.fst if ``plain``, else a dictation graph for KaldiAG). Returns dict(wer,
+    num_words, num_utterances, graph_size_mb, seconds).
+    """
+    import wave
+    from .plain_dictation import PlainDictationRecognizer
+    if not test_set: raise KaldiError("empty test set")
+    with wave.open(test_set[0][0], 'rb') as wav_file:
+        sample_rate = wav_file.getframerate()
+    graph_kwargs = dict(fst_file=graph_filename) if plain else dict(dictation_fst_file=graph_filename)
+
+    num_errors = num_words = 0
+    start_time = clock()
+    with PlainDictationRecognizer(model_dir=model_dir, tmp_dir=tmp_dir, sample_rate=sample_rate, **graph_kwargs) as recognizer:
+        for wav_filename, transcript in test_set:
+            with wave.open(wav_filename, 'rb') as wav_file:
+                if (wav_file.getnchannels(), wav_file.getsampwidth(), wav_file.getframerate()) != (1, 2, sample_rate):
+                    raise KaldiError("test set audio must be mono int16 at %d Hz: %r" % (sample_rate, wav_filename))
+                audio_data = wav_file.readframes(wav_file.getnframes())
+            output, info = recognizer.decode_utterance(audio_data)
+            reference = transcript.lower().split()
+            num_errors += word_edit_distance(reference, output.lower().split())
+            num_words += len(reference)
+            _log.log(13, "evaluate_dictation_graph: %r -> %r", transcript, output)
+    seconds = clock() - start_time
+
+    return dict(wer=(float(num_errors) / num_words if num_words else 0.0), num_words=num_words, num_utterances=len(test_set),
+        graph_size_mb=os.path.getsize(graph_filename) / float(1 << 20), seconds=seconds)
@@ -263,6 +263,13 @@ class Model(object):
         self.longest_word = max(self.words_table.word_to_id_map.keys(), key=len)
         return self.words_table
 
+    def count_rule_nonterms(self):
+        """ Returns the number of rule ids supported by the model, i.e. consecutive ``#nonterm:ruleN`` symbols in the words table. """
+        num_rules = 0
+        while ('#nonterm:rule%d' % num_rules) in self.words_table:
+            num_rules += 1
+        return num_rules
+
     def read_user_lexicon(self, filename=None):
         if filename is None: filename = self.files_dict['user_lexicon.txt']
         with open(filename, 'r', encoding='utf-8') as file:
@@ -445,8 +452,7 @@ class Model(object):
 
 ########################################################################################################################
 
-def convert_generic_model_to_agf(src_dir, model_dir):
-    from .compiler import Compiler
+def convert_generic_model_to_agf(src_dir, model_dir, num_rules=None):
     if PY2:
         from .kaldi import augment_phones_txt_py2 as augment_phones_txt, augment_words_txt_py2 as augment_words_txt
     else:
@@ -477,7 +483,7 @@ def convert_generic_model_to_agf(src_dir, model_dir):
         'final.dubm',
         'final.ie',
     ]
-    nonterminals = list(Compiler.nonterminals)
+    nonterminals = make_nonterminals(num_rules)
 
     for filename in filenames:
         path = find_file(src_dir, filename)
@@ -506,6 +512,12 @@ def convert_generic_model_to_agf(src_dir, model_dir):
 
 ########################################################################################################################
 
+def make_nonterminals(num_rules=None):
+    """ Returns list of nonterminal symbols for a model supporting rule ids ``0 .. num_rules-1`` (plus dictation). """
+    if num_rules is None: num_rules = defaults.DEFAULT_MAX_NUM_RULES
+    if num_rules < 1: raise KaldiError("num_rules must be positive")
+    return ['#nonterm:dictation'] + ['#nonterm:rule%i' % i for i in range(num_rules)]
+
 def str_space_join(iterable):
     return u' '.join(text_type(elem) for elem in iterable)
 
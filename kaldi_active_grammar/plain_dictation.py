@@ -15,7 +15,7 @@ _log = _log.getChild('plain_dictation')
 
 class PlainDictationRecognizer(object):
 
-    def __init__(self, model_dir=None, tmp_dir=None, fst_file=None, config=None):
+    def __init__(self, model_dir=None, tmp_dir=None, fst_file=None, config=None, sample_rate=None, num_channels=1, dictation_fst_file=None):
         """
         Recognizes plain dictation only. If `fst_file` is specified, uses that
         HCLG.fst file; otherwise, uses KaldiAG but dictation only.
@@ -25,6 +25,9 @@ class PlainDictationRecognizer(object):
             tmp_dir (str): optional path to temporary directory
             fst_file (str): optional path to model's HCLG.fst file to use
             config (dict): optional configuration for initialization of decoder
+            sample_rate (int): optional sample rate of the audio to decode; default is the model's
+            num_channels (int): number of (interleaved) channels of the audio to decode
+            dictation_fst_file (str): optional path to dictation graph to use with KaldiAG, instead of the model's
         """
         show_donation_message()
 
@@ -32,7 +35,7 @@ class PlainDictationRecognizer(object):
         self._compiler = None
         self.decoder = None
 
-        kwargs = {}
+        kwargs = dict(sample_rate=sample_rate, num_channels=num_channels)
         if config: kwargs['config'] = dict(config)
 
         if fst_file:
@@ -43,7 +46,7 @@ class PlainDictationRecognizer(object):
         else:
             self._compiler = Compiler(model_dir, tmp_dir, cache_fsts=False)
             top_fst_rule = self._compiler.compile_top_fst_dictation_only()
-            dictation_fst_file = self._compiler.dictation_fst_filepath
+            if not dictation_fst_file: dictation_fst_file = self._compiler.dictation_fst_filepath
             self.decoder = KaldiAgfNNet3Decoder(model_dir=self._compiler.model_dir, tmp_dir=self._compiler.tmp_dir,
                 top_fst=top_fst_rule.fst_wrapper, dictation_fst_file=dictation_fst_file, **kwargs)
 
@@ -76,7 +79,7 @@ class PlainDictationRecognizer(object):
         if self.decoder is None:
             raise KaldiError("Cannot use closed PlainDictationRecognizer")
         if chunk_size:
-            chunk_size *= 2  # Compensate for int16 format
+            chunk_size *= 2 * self.decoder.num_channels  # Compensate for int16 format
             for i in range(0, len(samples_data), chunk_size):
                 self.decoder.decode(samples_data[i : i + chunk_size], False)
             self.decoder.decode(bytes(), True)
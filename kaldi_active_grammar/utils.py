@@ -317,6 +317,26 @@ class FSTFileCache(object):
         hasher.update(data)
         return text_type(hasher.hexdigest())
 
+    def hash_file(self, filepath):
+        """
+        Returns hash of the contents of (possibly large) file ``filepath``, read in chunks. Memoized in the cache by path,
+        size, and modification time, so unchanged files are not re-read.
+        """
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        file_hashes = self.cache.setdefault('file_hashes', dict())
+        entry = file_hashes.get(filepath)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            return entry[2]
+        hasher = hashlib.md5()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(chunk)
+        file_hash = text_type(hasher.hexdigest())
+        file_hashes[filepath] = [stat.st_size, stat.st_mtime, file_hash]
+        self.dirty = True
+        return file_hash
+
     def add_file(self, filepath, data=None):
         # Assumes file is a root dependency
         if data is None:
@@ -0,0 +1,190 @@
+#
+# This file is part of kaldi-active-grammar.
+# (c) Copyright 2019 by David Zurow
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Streaming voice activity detection & endpointing in front of a decoder, so audio between utterances is never decoded.
+"""
+
+import numpy as np
+
+from . import _log, KaldiError
+
+_log = _log.getChild('vad')
+
+
+########################################################################################################################
+
+class VADEndpointer(object):
+    """
+    Segments a stream of ``int16`` mono audio into utterances. Each frame is classified as speech by its energy (computed
+    for all frames of a chunk at once) and optionally also by webrtcvad (only consulted for frames above the energy
+    threshold). An utterance starts when ``ratio`` of the frames in the last ``start_window_ms`` are speech (including
+    the preceding ``start_padding_ms``), and ends when ``ratio`` of the frames in the last ``end_window_ms`` are not.
+    """
+
+    def __init__(self, sample_rate=16000, frame_ms=10, energy_threshold_db=-50.0, webrtcvad_aggressiveness=None,
+            start_window_ms=150, start_padding_ms=100, end_window_ms=150, ratio=0.8):
+        """
+        Args:
+            energy_threshold_db (float): minimum frame energy (RMS, in dBFS) for speech
+            webrtcvad_aggressiveness (int): if not None, also require webrtcvad (optional dependency) to classify the frame as speech, with this aggressiveness (0-3)
+        """
+        self.sample_rate = int(sample_rate)
+        self.frame_samples = self.sample_rate * frame_ms // 1000
+        if self.frame_samples <= 0 or self.frame_samples * 1000 != self.sample_rate * frame_ms:
+            raise KaldiError("invalid frame_ms %r for sample_rate %r" % (frame_ms, sample_rate))
+        self.energy_threshold_db = float(energy_threshold_db)
+        self.num_start_window_frames = max(1, start_window_ms // frame_ms)
+        self.num_start_padding_frames = max(0, start_padding_ms // frame_ms)
+        self.num_end_window_frames = max(1, end_window_ms // frame_ms)
+        self.ratio = float(ratio)
+
+        self.webrtcvad = None
+        if webrtcvad_aggressiveness is not None:
+            if frame_ms not in (10, 20, 30) or self.sample_rate not in (8000, 16000, 32000, 48000):
+                raise KaldiError("webrtcvad requires frame_ms of 10/20/30 and sample_rate of 8/16/32/48 kHz")
+            try:
+                import webrtcvad
+            except ImportError:
+                raise KaldiError("webrtcvad_aggressiveness requires the webrtcvad package")
+            self.webrtcvad = webrtcvad.Vad(webrtcvad_aggressiveness)
+
+        self._num_history_frames = max(self.num_start_window_frames + self.num_start_padding_frames, self.num_end_window_frames)
+        self.reset()
+
+    def reset(self):
+        """ Discard all buffered audio, and any utterance in progress. """
+        self.in_utterance = False
+        self._remainder = np.zeros(0, np.int16)  # Samples of an incomplete frame
+        self._frames = np.zeros((0, self.frame_samples), np.int16)  # Recent frames, for windows & start padding
+        self._speech = np.zeros(0, np.bool_)  # Classification of _frames
+        self._valid_from = 0  # Index into _frames of the first frame after the last transition, from which windows may count
+
+    def classify_frames(self, frames):
+        """ Returns bool array of whether each frame (row) of ``frames`` is speech. """
+        float_frames = frames.astype(np.float32)
+        mean_square = np.einsum('ij,ij->i', float_frames, float_frames) / frames.shape[1]
+        energy_db = 10 * np.log10(mean_square + 1e-10) - 20 * np.log10(32768)
+        speech = energy_db > self.energy_threshold_db
+        if self.webrtcvad is not None:
+            for i in np.flatnonzero(speech):
+                speech[i] = self.webrtcvad.is_speech(frames[i].tobytes(), self.sample_rate)
+        return speech
+
+    def process(self, audio_data):
+        """
+        Returns list of (audio_data, is_start, is_end) segments of utterance audio (``bytes``) within ``audio_data`` (bytes-like
+        or NumPy array of ``int16`` samples), in order. Audio outside of utterances is dropped.
+        """
+        if not isinstance(audio_data, np.ndarray): audio_data = np.frombuffer(audio_data, np.int16)
+        samples = np.concatenate((self._remainder, audio_data)) if len(self._remainder) else audio_data
+        num_new_frames = len(samples) // self.frame_samples
+        self._remainder = samples[num_new_frames * self.frame_samples:].copy()
+        if not num_new_frames:
+            return []
+        new_frames = samples[:num_new_frames * self.frame_samples].reshape(num_new_frames, self.frame_samples)
+
+        frames = np.concatenate((self._frames, new_frames))
+        speech = np.concatenate((self._speech, self.classify_frames(new_frames)))
+        num_frames = len(frames)
+        speech_cumsum = np.concatenate(([0], np.cumsum(speech)))
+        def first_frame_reaching(window, count_speech, pos):
+            # Index of first frame >= pos whose trailing window (entirely since the last transition) reaches ratio, or None
+            first = max(pos, self._valid_from + window - 1)
+            if first >= num_frames: return None
+            counts = speech_cumsum[first + 1:] - speech_cumsum[first + 1 - window : num_frames + 1 - window]
+            if not count_speech: counts = window - counts
+            hits = np.flatnonzero(counts >= self.ratio * window)
+            return (first + hits[0]) if hits.size else None
+
+        segments = []
+        pos = len(self._frames)  # First new frame
+        segment_start, segment_is_start = pos, False
+        while pos < num_frames:
+            if not self.in_utterance:
+                index = first_frame_reaching(self.num_start_window_frames, True, pos)
+                if index is None: break
+                self.in_utterance = True
+                segment_start = max(self._valid_from, index - self.num_start_window_frames - self.num_start_padding_frames + 1)
+                segment_is_start = True
+                pos = self._valid_from = index + 1
+            else:
+                index = first_frame_reaching(self.num_end_window_frames, False, pos)
+                if index is None: break
+                segments.append((frames[segment_start : index + 1].tobytes(), segment_is_start, True))
+                self.in_utterance = False
+                pos = self._valid_from = index + 1
+        if self.in_utterance and (segment_start < num_frames or segment_is_start):
+            segments.append((frames[segment_start:].tobytes(), segment_is_start, False))
+
+        num_dropped = max(0, num_frames - self._num_history_frames)
+        self._frames, self._speech = frames[num_dropped:].copy(), speech[num_dropped:]
+        self._valid_from = max(0, self._valid_from - num_dropped)
+        return segments
+
+
+########################################################################################################################
+
+class EndpointedDecoder(object):
+    """
+    Feeds audio to ``decoder`` through a VADEndpointer, decoding only utterances, and finalizing each at its endpoint.
+    """
+
+    def __init__(self, decoder, endpointer=None, grammars_activity_func=None):
+        """
+        Args:
+            endpointer (VADEndpointer): default is a VADEndpointer at the decoder's sample_rate
+            grammars_activity_func (callable): optional; called at the start of each utterance, returning its grammars_activity for decode
+        """
+        if getattr(decoder, 'num_channels', 1) != 1: raise KaldiError("EndpointedDecoder requires mono audio")
+        self.decoder = decoder
+        self.endpointer = endpointer if endpointer is not None else VADEndpointer(sample_rate=decoder.sample_rate)
+        self.grammars_activity_func = grammars_activity_func
+        self._utterance_audio = []
+        self._decoder_finished = False  # Decoder finished the current utterance before the endpointer ended it
+
+    in_utterance = property(lambda self: self.endpointer.in_utterance)
+
+    def feed(self, audio_data):
+        """
+        Returns list of (output, info, audio_data) for each utterance ended within ``audio_data``. An utterance also ends
+        when the decoder itself finishes it (by its endpointing or early commit), and the rest of its audio is then dropped.
+        """
+        results = []
+        for segment, is_start, is_end in self.endpointer.process(audio_data):
+            if is_start:
+                self._utterance_audio = []
+                self._decoder_finished = False
+            if self._decoder_finished:
+                continue
+            self._utterance_audio.append(segment)
+            if is_start and self.grammars_activity_func is not None:
+                finished = self.decoder.decode(segment, is_end, self.grammars_activity_func())
+            else:
+                finished = self.decoder.decode(segment, is_end)
+            if finished and not is_end:
+                self.decoder.decode(b'', True)
+                self._decoder_finished = True
+            if is_end or finished:
+                results.append(self._finish_utterance())
+        return results
+
+    def flush(self):
+        """ End any utterance in progress (e.g. at end of stream), returning its (output, info, audio_data), or None. """
+        if not self.endpointer.in_utterance:
+            return None
+        self.endpointer.reset()
+        if self._decoder_finished:
+            self._decoder_finished = False
+            return None
+        self.decoder.decode(b'', True)
+        return self._finish_utterance()
+
+    def _finish_utterance(self):
+        output, info = self.decoder.get_output()
+        audio_data, self._utterance_audio = b''.join(self._utterance_audio), []
+        _log.log(13, "endpointed utterance of %.2fs: %r", len(audio_data) / (2.0 * self.endpointer.sample_rate), output)
+        return output, info, audio_data
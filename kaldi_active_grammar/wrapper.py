@@ -8,7 +8,8 @@
 Wrapper classes for Kaldi
 """
 
-import argparse, json, os.path, sys
+import argparse, collections, json, os.path, sys
+import concurrent.futures
 from io import open, StringIO
 
 from six.moves import zip
@@ -24,18 +25,86 @@ _log = _log.getChild('wrapper')
 _log_library = _log.getChild('library')
 
 
+########################################################################################################################
+
+def is_sparse_grammars_activity(grammars_activity):
+    """ Returns whether ``grammars_activity`` is a collection of active grammar ids (set, frozenset, range, or integer array), rather than a bool per grammar. """
+    if isinstance(grammars_activity, np.ndarray):
+        return grammars_activity.dtype != np.bool_
+    return isinstance(grammars_activity, (set, frozenset, range))
+
+def active_grammar_ids(grammars_activity):
+    """ Returns an iterable of the ids of the active grammars in ``grammars_activity`` (in either dense or sparse form). """
+    if is_sparse_grammars_activity(grammars_activity):
+        return grammars_activity
+    if isinstance(grammars_activity, np.ndarray):
+        return np.flatnonzero(grammars_activity).tolist()
+    return [i for (i, active) in enumerate(grammars_activity) if active]
+
+def make_grammars_activity_array(grammars_activity, num_grammars):
+    """
+    Returns ``grammars_activity`` as a contiguous NumPy bool array, for passing to the native decoder without conversion.
+    Accepts either a sequence of bools (one per grammar; a contiguous bool array is used as-is, without copying), or a
+    sparse collection of active grammar ids (see is_sparse_grammars_activity).
+    """
+    if is_sparse_grammars_activity(grammars_activity):
+        if isinstance(grammars_activity, np.ndarray): ids = grammars_activity
+        else: ids = np.fromiter(grammars_activity, np.intp, len(grammars_activity))
+        if ids.size and (ids.min() < 0 or ids.max() >= num_grammars):
+            raise KaldiError("active grammar id out of range for num_grammars = %d" % num_grammars)
+        array = np.zeros(num_grammars, np.bool_)
+        array[ids] = True
+        return array
+    array = np.ascontiguousarray(grammars_activity, dtype=np.bool_)
+    if len(array) != num_grammars:
+        _log.error("wrong len(grammars_activity) = %d != %d = num_grammars" % (len(array), num_grammars))
+    return array
+
+def make_grammar_weights_array(grammar_weights, num_grammars):
+    """
+    Returns ``grammar_weights`` as a NumPy float32 array of cost offsets, one per grammar, added to the cost of a result
+    of the grammar (so negative values boost it), in the units of the ``likelihood`` of get_output. Accepts either a
+    sequence of floats (one per grammar), or a dict of grammar id -> cost offset (others being 0).
+    """
+    if isinstance(grammar_weights, dict):
+        array = np.zeros(num_grammars, np.float32)
+        for grammar_id, weight in grammar_weights.items():
+            if not (0 <= grammar_id < num_grammars):
+                raise KaldiError("grammar id %r out of range for num_grammars = %d" % (grammar_id, num_grammars))
+            array[grammar_id] = weight
+        return array
+    array = np.ascontiguousarray(grammar_weights, dtype=np.float32)
+    if len(array) != num_grammars:
+        raise KaldiError("wrong len(grammar_weights) = %d != %d = num_grammars" % (len(array), num_grammars))
+    return array
+
+_no_grammars_activity = np.zeros(0, np.bool_)
+
+def _grammars_activity_cdata(grammars_activity, num_grammars):
+    """ Returns (array, ``bool *`` cdata pointing into it) for decode; the array must be kept alive during the native call. """
+    if grammars_activity is None:
+        return _no_grammars_activity, _ffi.cast('bool *', _ffi.from_buffer(_no_grammars_activity))
+    # Start of utterance
+    array = make_grammars_activity_array(grammars_activity, num_grammars)
+    if _log.isEnabledFor(5):
+        _log.log(5, "decode: grammars_activity = %s", (array.view(np.uint8) + ord('0')).tobytes().decode('ascii'))
+    return array, _ffi.cast('bool *', _ffi.from_buffer(array))
+
+
 ########################################################################################################################
 
 class KaldiDecoderBase(FFIObject):
     """docstring for KaldiDecoderBase"""
 
-    def __init__(self):
+    def __init__(self, sample_rate=16000, num_channels=1):
         super(KaldiDecoderBase, self).__init__()
 
         show_donation_message()
 
-        self.sample_rate = 16000
-        self.num_channels = 1
+        if int(num_channels) < 1: raise KaldiError("invalid num_channels: %r" % num_channels)
+        self.sample_rate = int(sample_rate)  # Of the audio passed to decode
+        self.num_channels = int(num_channels)  # Of the audio passed to decode, interleaved; downmixed to mono for decoding
+        self.kaldi_frame_length_ms = 30  # Frame shift times frame subsampling factor, of the (chain) model's output frames
         self.bytes_per_kaldi_frame = self.kaldi_frame_num_to_audio_bytes(1)
 
         self._reset_decode_time()
@@ -62,9 +131,10 @@ class KaldiDecoderBase(FFIObject):
             self._reset_decode_time()
 
     def kaldi_frame_num_to_audio_bytes(self, kaldi_frame_num):
-        kaldi_frame_length_ms = 30
         sample_size_bytes = 2 * self.num_channels
-        return int(kaldi_frame_num * kaldi_frame_length_ms * self.sample_rate / 1000 * sample_size_bytes)
+        return int(kaldi_frame_num * self.kaldi_frame_length_ms * self.sample_rate / 1000 * sample_size_bytes)
+
+    samples_per_kaldi_frame = property(lambda self: int(round(self.kaldi_frame_length_ms * self.sample_rate / 1000)))
 
     def audio_bytes_to_s(self, audio_bytes):
         sample_size_bytes = 2 * self.num_channels
@@ -87,9 +157,37 @@ class KaldiNNet3Decoder(KaldiDecoderBase):
         DRAGONFLY_API bool nnet3_base__set_lm_prime_text(void* model_vp, char* prime_cp);
     """
 
-    def __init__(self, model_dir, tmp_dir, words_file=None, word_align_lexicon_file=None, max_num_rules=None, save_adaptation_state=False):
-        super(KaldiNNet3Decoder, self).__init__()
-
+    def __init__(self, model_dir, tmp_dir, words_file=None, word_align_lexicon_file=None, max_num_rules=None, save_adaptation_state=False,
+            sample_rate=None, num_channels=1, pipelined=False, endpointing=False, endpoint_rules=None, dictation_endpoint_rules=None,
+            early_commit_threshold=None, early_commit_min_stable_chunks=2, early_commit_interval=0.1):
+        """
+        Args:
+            sample_rate (int): sample rate of the audio to be passed to decode; default is the model's (the ``sample-frequency`` of its mfcc config); other rates are resampled natively during feature extraction
+            num_channels (int): number of (interleaved) channels of the audio to be passed to decode; multiple channels are downmixed (averaged) to mono
+            pipelined (bool): whether decode queues the native decoding of each (non-final) chunk on a worker thread and returns immediately, so the caller can prepare/capture the next chunk meanwhile; see wait_for_pipeline
+            endpointing (bool): whether decode of each non-final chunk returns whether an endpoint was detected (see detect_endpoint); this waits for any pipelined decoding
+            endpoint_rules (sequence of dict): rules for detect_endpoint; default is defaults.DEFAULT_ENDPOINT_RULES
+            dictation_endpoint_rules (sequence of dict): rules for detect_endpoint while in dictation; default is defaults.DEFAULT_DICTATION_ENDPOINT_RULES
+            early_commit_threshold (float): if not None, decode of each non-final chunk also returns True once the utterance's result is committed early (see detect_early_commit), requiring at least this confidence
+            early_commit_min_stable_chunks (int): number of consecutive early commit checks the best path must be unchanged for, to commit early
+            early_commit_interval (float): seconds of audio between early commit checks (at most one per chunk), each of which computes the best path and its confidence
+        """
+        self.pipelined = bool(pipelined)
+        self.endpointing = bool(endpointing)
+        self.endpoint_rules = tuple(endpoint_rules if endpoint_rules is not None else defaults.DEFAULT_ENDPOINT_RULES)
+        self.dictation_endpoint_rules = tuple(dictation_endpoint_rules if dictation_endpoint_rules is not None else defaults.DEFAULT_DICTATION_ENDPOINT_RULES)
+        self.early_commit_threshold = early_commit_threshold
+        self.early_commit_min_stable_chunks = int(early_commit_min_stable_chunks)
+        self.early_commit_interval = float(early_commit_interval)
+        self.endpoint_state_func = None  # Optional callable(output) -> (reached_final, in_dictation, has_dictation), for detect_endpoint & detect_early_commit; set by Compiler.init_decoder
+        self.committed_output = None  # (output, info) of the utterance in progress, once committed early
+        self._utterance_num_samples = 0
+        self._early_commit_candidate = (None, 0)  # (output, number of consecutive early commit checks it has been the best path)
+        self._last_early_commit_check = None  # Utterance length at the last early commit check of the utterance in progress
+        self._endpoint_state = (None, None)  # (output, endpoint_state_func(output)) of the utterance in progress
+        self._last_endpoint_check = None  # (utterance length, trailing silence) at the last full detect_endpoint of the utterance in progress
+        self._pipeline_executor = None
+        self._pipeline_futures = collections.deque()
         model_dir = os.path.normpath(model_dir)
         if words_file is None: words_file = find_file(model_dir, 'words.txt')
         if word_align_lexicon_file is None: word_align_lexicon_file = find_file(model_dir, 'align_lexicon.int', required=False)
@@ -101,6 +199,13 @@ class KaldiNNet3Decoder(KaldiDecoderBase):
         self.words_file = os.path.normpath(words_file)
         self.word_align_lexicon_file = os.path.normpath(word_align_lexicon_file) if word_align_lexicon_file is not None else None
         self.mfcc_conf_file = os.path.normpath(mfcc_conf_file)
+        self.mfcc_config = self._read_conf_file(self.mfcc_conf_file)
+        self.model_sample_rate = int(float(self.mfcc_config.get('sample-frequency', 16000)))
+        super(KaldiNNet3Decoder, self).__init__(sample_rate=(sample_rate or self.model_sample_rate), num_channels=num_channels)
+        if self.sample_rate != self.model_sample_rate:
+            self.mfcc_conf_file = self._write_resampling_mfcc_conf_file(tmp_dir)
+        self.kaldi_frame_length_ms = self._read_kaldi_frame_length_ms(model_dir, self.mfcc_config)
+        self.bytes_per_kaldi_frame = self.kaldi_frame_num_to_audio_bytes(1)
         self.model_file = os.path.normpath(model_file)
         self.ie_config = self._read_ie_conf_file(model_dir, find_file(model_dir, 'ivector_extractor.conf'))
         self.verbosity = (10 - _log_library.getEffectiveLevel()) if _log_library.isEnabledFor(10) else -1
@@ -117,6 +222,52 @@ class KaldiNNet3Decoder(KaldiDecoderBase):
             }
         if self.max_num_rules is not None: self.config_dict.update(max_num_rules=self.max_num_rules)
 
+    @staticmethod
+    def _read_conf_file(filename):
+        """ Read simple Kaldi config file (of ``--option=value`` lines), returning dict of option (without dashes) -> value string. """
+        config = dict()
+        with open(filename, 'r', encoding='utf-8') as file:
+            for line in file:
+                line = line.split('#', 1)[0].strip()
+                if line.startswith('--'):
+                    key, _, value = line[2:].partition('=')
+                    config[key] = value
+        return config
+
+    def _write_resampling_mfcc_conf_file(self, tmp_dir):
+        """ Write a copy of the mfcc config allowing Kaldi's feature extraction to resample audio of our sample_rate to the model's, returning its filename. """
+        direction = 'downsample' if self.sample_rate > self.model_sample_rate else 'upsample'
+        _log.debug("resampling audio from %d Hz to model's %d Hz during feature extraction", self.sample_rate, self.model_sample_rate)
+        filename = os.path.join(tmp_dir, 'mfcc_allow_%s.conf' % direction)
+        lines = [('--%s=%s' % (key, value) if value else '--' + key) for (key, value) in self.mfcc_config.items() if key != ('allow-' + direction)]
+        lines.append('--allow-%s=true' % direction)
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        return filename
+
+    def _prepare_samples(self, frames):
+        """
+        Returns ``frames`` (bytes-like or NumPy array of ``int16`` samples, interleaved if multi-channel) as a contiguous
+        ``float32`` array of mono samples for the native decoder, converting and downmixing in a single pass.
+        """
+        if not isinstance(frames, np.ndarray): frames = np.frombuffer(frames, np.int16)
+        if self.num_channels == 1:
+            return frames.astype(np.float32)
+        if len(frames) % self.num_channels:
+            raise KaldiError("audio length %d is not a multiple of num_channels = %d" % (len(frames), self.num_channels))
+        return frames.reshape(-1, self.num_channels).mean(axis=1, dtype=np.float32)
+
+    @staticmethod
+    def _read_kaldi_frame_length_ms(model_dir, mfcc_config):
+        """ Returns the length of the decoder's output frames (as used for word alignment), from the feature frame shift and the model's frame subsampling factor. """
+        frame_shift_ms = float(mfcc_config.get('frame-shift', 10))
+        frame_subsampling_factor = 3  # Default for chain models
+        frame_subsampling_factor_file = find_file(model_dir, 'frame_subsampling_factor')
+        if frame_subsampling_factor_file is not None:
+            with open(frame_subsampling_factor_file, 'r', encoding='utf-8') as file:
+                frame_subsampling_factor = int(file.read().strip())
+        return frame_shift_ms * frame_subsampling_factor
+
     def _read_ie_conf_file(self, model_dir, old_filename, search=True):
         """ Read ivector_extractor.conf file, converting relative paths to absolute paths for current configuration, returning dict of config. """
         options_with_path = {
@@ -161,9 +312,152 @@ class KaldiNNet3Decoder(KaldiDecoderBase):
     @saving_adaptation_state.setter
     def saving_adaptation_state(self, value): self._saving_adaptation_state = value
 
-    def _get_model(self):
+    def _get_model(self, wait_for_pipeline=True):
+        if wait_for_pipeline and self._pipeline_futures: self.wait_for_pipeline()
         return self._require_native(getattr(self, '_model', None), 'nnet3 decoder')
 
+    def _decode_native(self, decode_func, num_samples, finalize):
+        self._start_decode_time(num_samples)
+        result = decode_func()
+        self._stop_decode_time(finalize)
+        if not result:
+            raise KaldiError("decoding error")
+
+    def _run_decode(self, decode_func, num_samples, finalize):
+        """
+        Call native ``decode_func`` (returning success), which must keep alive any buffers it uses. If pipelined, it is
+        queued on the worker thread (in order), and only waited for when finalizing; errors are raised by a later call.
+        Returns whether the utterance is finished: finalized, (if endpointing) at an endpoint, or (if early_commit_threshold)
+        committed early.
+        """
+        if finalize:
+            self._utterance_num_samples = 0
+            self.committed_output, self._early_commit_candidate, self._last_early_commit_check = None, (None, 0), None
+            self._endpoint_state, self._last_endpoint_check = (None, None), None
+        else:
+            self._utterance_num_samples += num_samples
+        if not self.pipelined:
+            self._decode_native(decode_func, num_samples, finalize)
+        else:
+            self._queue_decode(decode_func, num_samples, finalize)
+        if finalize:
+            return True
+        if self.committed_output is not None:
+            return True
+        output = None
+        if self.early_commit_threshold is not None and self._early_commit_check_due():
+            output, info = self.get_output()
+            if self.detect_early_commit(output, info):
+                return True
+        if self.endpointing:
+            return self.detect_endpoint(output)
+        return False
+
+    def _queue_decode(self, decode_func, num_samples, finalize):
+        futures = self._pipeline_futures
+        while futures and futures[0].done():
+            futures.popleft().result()  # Raise any error from an earlier chunk
+        if self._pipeline_executor is None:
+            self._pipeline_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='kaldi_decode')
+        futures.append(self._pipeline_executor.submit(self._decode_native, decode_func, num_samples, finalize))
+        if finalize:
+            self.wait_for_pipeline()
+
+    def _early_commit_check_due(self):
+        """ Returns whether early_commit_interval of audio has been decoded since the last early commit check, recording this one if so. """
+        # get_output computes the lattice & confidence, and blocks on any pipelined decoding, so is too costly for every chunk
+        utterance_length = self._utterance_num_samples / self.sample_rate
+        if self._last_early_commit_check is not None and utterance_length - self._last_early_commit_check < self.early_commit_interval:
+            return False
+        self._last_early_commit_check = utterance_length
+        return True
+
+    def detect_early_commit(self, output, info):
+        """
+        Returns whether to commit early to the best path ``output`` (with ``info``) of the utterance in progress, storing it in
+        ``committed_output`` if so: when it is a complete match of a rule without dictation (as given by
+        ``endpoint_state_func``), its confidence is at least ``early_commit_threshold``, and it has been unchanged for
+        ``early_commit_min_stable_chunks`` checks. Called once per ``early_commit_interval`` of audio.
+        """
+        candidate_output, num_chunks = self._early_commit_candidate
+        num_chunks = (num_chunks + 1) if output == candidate_output else 1
+        self._early_commit_candidate = (output, num_chunks)
+        if not output or self.endpoint_state_func is None or num_chunks < self.early_commit_min_stable_chunks:
+            return False
+        confidence = info.get('confidence')
+        if confidence is None or not (confidence >= self.early_commit_threshold):  # Including NaN
+            return False
+        reached_final, in_dictation, has_dictation = self._get_endpoint_state(output)
+        if not reached_final or has_dictation:
+            return False
+        _log.log(13, "%s: committing early at %.2fs to %r %s", self, self._utterance_num_samples / self.sample_rate, output, info)
+        self.committed_output = (output, info)
+        return True
+
+    def detect_endpoint(self, output=None):
+        """
+        Returns whether the utterance in progress has reached an endpoint, i.e. whether any rule of ``endpoint_rules`` (or
+        of ``dictation_endpoint_rules``, while in dictation) is satisfied, by: whether the best path contains any words,
+        the trailing silence after its last word, whether it reaches a final state, and the utterance length so far.
+        Whether the best path reaches a final state and is in dictation are given by ``endpoint_state_func``, if set.
+
+        Since trailing silence grows no faster than the utterance, the best path (and its word alignment) is only
+        examined once enough audio has been decoded since the last time for some rule to possibly be satisfied.
+        """
+        utterance_length = self._utterance_num_samples / self.sample_rate
+        if self._last_endpoint_check is not None:
+            last_utterance_length, last_trailing_silence = self._last_endpoint_check
+            max_trailing_silence = last_trailing_silence + (utterance_length - last_utterance_length)
+            if not any(max_trailing_silence >= rule['min_trailing_silence'] and utterance_length >= rule['min_utterance_length']
+                    for rule in self.endpoint_rules + self.dictation_endpoint_rules):
+                return False
+        if output is None: output, info = self.get_output()
+        word_align = self.get_word_align_array(output)
+        word_ends = [start + length for (word, start, length) in word_align.tolist() if not word.startswith('#nonterm:')]
+        trailing_silence = utterance_length - (max(word_ends) / self.sample_rate if word_ends else 0)
+        self._last_endpoint_check = (utterance_length, trailing_silence)
+        reached_final, in_dictation, has_dictation = self._get_endpoint_state(output)
+        for rule in (self.dictation_endpoint_rules if in_dictation else self.endpoint_rules):
+            if ((word_ends or not rule['must_contain_nonsilence'])
+                    and trailing_silence >= rule['min_trailing_silence']
+                    and (reached_final or not rule['must_reach_final'])
+                    and utterance_length >= rule['min_utterance_length']):
+                _log.log(13, "%s: endpoint detected at %.2fs with %.2fs trailing silence (reached_final=%s, in_dictation=%s) by rule %s",
+                    self, utterance_length, trailing_silence, reached_final, in_dictation, rule)
+                return True
+        return False
+
+    def _get_endpoint_state(self, output):
+        """ Returns ``endpoint_state_func(output)``, reusing the result while the best path of the utterance is unchanged. """
+        if self.endpoint_state_func is None:
+            return (False, False, False)
+        cached_output, endpoint_state = self._endpoint_state
+        if output != cached_output or endpoint_state is None:
+            endpoint_state = self.endpoint_state_func(output)
+            self._endpoint_state = (output, endpoint_state)
+        return endpoint_state
+
+    def wait_for_pipeline(self):
+        """ Wait for all queued (pipelined) decoding to complete, raising the first error. Called automatically by all other native operations. """
+        futures = self._pipeline_futures
+        error = None
+        while futures:
+            try:
+                futures.popleft().result()
+            except Exception as e:
+                if error is None: error = e
+        if error is not None:
+            raise error
+
+    def _shutdown_pipeline(self):
+        try:
+            self.wait_for_pipeline()
+        except Exception as e:
+            _log.warning("%s: error in pipelined decoding while closing: %s", self, e)
+        executor, self._pipeline_executor = self._pipeline_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
     def load_lexicon(self, words_file=None, word_align_lexicon_file=None):
         """ Only necessary when you update the lexicon after initialization. """
         if words_file is None: words_file = self.words_file
@@ -203,18 +497,39 @@ class KaldiNNet3Decoder(KaldiDecoderBase):
         _log.log(7, "get_output: %r %s", output_str, info)
         return output_str, info
 
-    def get_word_align(self, output):
-        """Returns tuple of tuples: words (including nonterminals but not eps), each's time (in bytes), and each's length (in bytes)."""
+    word_align_dtype = np.dtype([('word', object), ('start', np.int64), ('length', np.int64)])
+
+    def get_word_align_array(self, output):
+        """
+        Returns structured NumPy array (of dtype ``word_align_dtype``) with an entry for each word of ``output`` (including
+        nonterminals but not eps): the word, and its start and length (in samples, per channel).
+        """
         words = output.split()
-        num_words = len(words)
-        kaldi_frame_times_p = _ffi.new('int32_t[]', num_words)
-        kaldi_frame_lengths_p = _ffi.new('int32_t[]', num_words)
-        result = self._lib.nnet3_base__get_word_align(self._get_model(), kaldi_frame_times_p, kaldi_frame_lengths_p, num_words)
+        kaldi_frames = np.zeros((2, len(words)), np.int32)  # Times & lengths, filled in place by native code
+        result = self._lib.nnet3_base__get_word_align(self._get_model(),
+            _ffi.cast('int32_t *', _ffi.from_buffer(kaldi_frames[0])), _ffi.cast('int32_t *', _ffi.from_buffer(kaldi_frames[1])), len(words))
         if not result:
             raise KaldiError("get_word_align error")
-        times = [kaldi_frame_num * self.bytes_per_kaldi_frame for kaldi_frame_num in kaldi_frame_times_p]
-        lengths = [kaldi_frame_num * self.bytes_per_kaldi_frame for kaldi_frame_num in kaldi_frame_lengths_p]
-        return tuple(zip(words, times, lengths))
+        word_align = np.empty(len(words), self.word_align_dtype)
+        word_align['word'] = words
+        word_align['start'] = kaldi_frames[0]
+        word_align['start'] *= self.samples_per_kaldi_frame
+        word_align['length'] = kaldi_frames[1]
+        word_align['length'] *= self.samples_per_kaldi_frame
+        return word_align
+
+    def get_word_align(self, output):
+        """Returns tuple of tuples: words (including nonterminals but not eps), each's time (in bytes), and each's length (in bytes)."""
+        word_align = self.get_word_align_array(output)
+        bytes_per_sample = 2 * self.num_channels
+        return tuple(zip(word_align['word'].tolist(), (word_align['start'] * bytes_per_sample).tolist(), (word_align['length'] * bytes_per_sample).tolist()))
+
+    def make_dictation_info_func(self, audio_data, output):
+        """
+        Returns ``dictation_info_func`` for Compiler.parse_output (or parse_partial_output), which only computes the word
+        alignment of ``output`` (which must be the current output) if alternative dictation is actually performed.
+        """
+        return lambda: (audio_data, self.get_word_align_array(output))
 
     def set_lm_prime_text(self, prime_text):
         prime_text = prime_text.strip()
@@ -251,31 +566,147 @@ class KaldiPlainNNet3Decoder(KaldiNNet3Decoder):
         self._model = self._own_native(model, self._lib.nnet3_plain__destruct, 'plain nnet3 decoder')
 
     def close(self):
+        self._shutdown_pipeline()
         self._release_native('_model', self._lib.nnet3_plain__destruct, 'plain nnet3 decoder')
 
     destroy = close
 
     def decode(self, frames, finalize):
         """Continue decoding with given new audio data."""
-        if not isinstance(frames, np.ndarray): frames = np.frombuffer(frames, np.int16)
-        frames = frames.astype(np.float32)
+        frames = self._prepare_samples(frames)
         frames_char = _ffi.from_buffer(frames)
         frames_float = _ffi.cast('float *', frames_char)
 
-        self._start_decode_time(len(frames))
-        result = self._lib.nnet3_plain__decode(self._get_model(), self.sample_rate, len(frames), frames_float, finalize, self._saving_adaptation_state)
-        self._stop_decode_time(finalize)
+        model, sample_rate, saving_adaptation_state = self._get_model(wait_for_pipeline=False), self.sample_rate, self._saving_adaptation_state
+        return self._run_decode(lambda: self._lib.nnet3_plain__decode(model, sample_rate, len(frames), frames_float, finalize, saving_adaptation_state),
+            len(frames), finalize)
 
-        if not result:
-            raise KaldiError("decoding error")
-        return finalize
+
+########################################################################################################################
+
+class KaldiGrammarNNet3Decoder(KaldiNNet3Decoder):
+    """ Base for decoders with a dynamic list of grammars (by index), whose activity is chosen at the start of each utterance. """
+
+    def __init__(self, **kwargs):
+        super(KaldiGrammarNNet3Decoder, self).__init__(**kwargs)
+        self.num_grammars = 0
+        self._activity_profiles = dict()  # name -> frozenset of active grammar indexes
+        self._activity_profile_arrays = dict()  # name -> bool array for current num_grammars, passed to native decode
+        self._weighted_utterance = None  # dict(samples, grammars_activity, grammar_weights) of the utterance in progress, if decoded with grammar_weights
+        self._warned_grammar_weights_ignored = False
+
+    def define_activity_profile(self, name, grammar_ids):
+        """
+        Define (or redefine) named activity profile ``name``, activating grammar indexes ``grammar_ids``, for passing to
+        decode(activity_profile=name). Its activity array is built once and reused until the number of grammars changes.
+        Removing a grammar updates all profiles to its shifted indexes.
+        """
+        grammar_ids = frozenset(int(grammar_id) for grammar_id in grammar_ids)
+        if any(grammar_id < 0 for grammar_id in grammar_ids): raise KaldiError("invalid grammar index in activity profile %r" % name)
+        self._activity_profiles[name] = grammar_ids
+        self._activity_profile_arrays.pop(name, None)
+
+    def remove_activity_profile(self, name):
+        del self._activity_profiles[name]
+        self._activity_profile_arrays.pop(name, None)
+
+    activity_profiles = property(lambda self: dict(self._activity_profiles))
+
+    def _get_activity_profile_array(self, name):
+        array = self._activity_profile_arrays.get(name)
+        if array is None or len(array) != self.num_grammars:
+            grammar_ids = self._activity_profiles.get(name)
+            if grammar_ids is None: raise KaldiError("undefined activity profile %r" % name)
+            array = make_grammars_activity_array(grammar_ids, self.num_grammars)
+            array.flags.writeable = False
+            self._activity_profile_arrays[name] = array
+        return array
+
+    def _remove_grammar_from_activity_profiles(self, grammar_fst_index):
+        for name, grammar_ids in self._activity_profiles.items():
+            self._activity_profiles[name] = frozenset((grammar_id if grammar_id < grammar_fst_index else grammar_id - 1)
+                for grammar_id in grammar_ids if grammar_id != grammar_fst_index)
+        self._activity_profile_arrays.clear()
+
+    def _prepare_grammars_activity(self, grammars_activity, activity_profile):
+        """ Returns (array, ``bool *`` cdata pointing into it) for decode; the array must be kept alive during the native call. """
+        if activity_profile is not None:
+            if grammars_activity is not None: raise KaldiError("cannot pass both grammars_activity and activity_profile")
+            grammars_activity = self._get_activity_profile_array(activity_profile)
+        return _grammars_activity_cdata(grammars_activity, self.num_grammars)
+
+    _decode_function_name = None  # Name of native decode function, taking grammars_activity
+
+    def _decode_samples(self, samples, finalize, grammars_activity_array, grammars_activity_cp):
+        """ Decodes ``samples`` (as from _prepare_samples); the arrays are kept alive by the queued call. """
+        samples_float = _ffi.cast('float *', _ffi.from_buffer(samples))
+        decode_function = getattr(self._lib, self._decode_function_name)
+        model, sample_rate, saving_adaptation_state = self._get_model(wait_for_pipeline=False), self.sample_rate, self._saving_adaptation_state
+        return self._run_decode(lambda: decode_function(model, sample_rate, len(samples), samples_float, finalize,
+            grammars_activity_cp, len(grammars_activity_array), saving_adaptation_state), len(samples), finalize)
+
+    def _decode_utterance_samples(self, samples, finalize, start_of_utterance, grammars_activity_array, grammars_activity_cp, grammar_weights):
+        """ Decodes ``samples``, keeping those of an utterance with ``grammar_weights`` to choose its output when finalized. """
+        if start_of_utterance:
+            self._weighted_utterance = None
+            if grammar_weights is not None:
+                if (self.endpointing or self.early_commit_threshold is not None) and not self._warned_grammar_weights_ignored:
+                    _log.warning("%s: grammar_weights are only applied when the utterance is finalized, not by endpointing or early commit", self)
+                    self._warned_grammar_weights_ignored = True
+                self._weighted_utterance = dict(samples=[], grammars_activity=np.array(grammars_activity_array, np.bool_),
+                    grammar_weights=make_grammar_weights_array(grammar_weights, self.num_grammars))
+        elif grammar_weights is not None:
+            raise KaldiError("grammar_weights can only be given at the start of an utterance, with its activity")
+        if self._weighted_utterance is not None:
+            self._weighted_utterance['samples'].append(samples)
+        result = self._decode_samples(samples, finalize, grammars_activity_array, grammars_activity_cp)
+        if finalize and self._weighted_utterance is not None:
+            weighted_utterance, self._weighted_utterance = self._weighted_utterance, None
+            self._redecode_with_grammar_weights(np.concatenate(weighted_utterance['samples']),
+                weighted_utterance['grammars_activity'], weighted_utterance['grammar_weights'])
+        return result
+
+    def _redecode_with_grammar_weights(self, samples, grammars_activity, grammar_weights):
+        """
+        Chooses the output of the just finalized utterance ``samples`` by ``grammar_weights``, re-decoding it with only the
+        active grammars of each weight (most boosted first) and keeping the result with the best likelihood minus weight.
+        Groups that cannot beat the best so far, given the likelihood with all active grammars, are skipped. Afterwards,
+        the decoder holds the chosen result (or the original one, if no group had any). Adaptation state is only saved by
+        the first decode. Each re-decode costs as much as decoding the utterance in the first place, all at finalization.
+        """
+        output, info = self.get_output()
+        weights = np.unique(grammar_weights[grammars_activity])  # Sorted
+        if not output or len(weights) <= 1:
+            return  # A uniform weight cannot change the result
+        max_likelihood = info['likelihood']
+        best_weight, best_score, decoded_weight = None, -np.inf, None
+        saving_adaptation_state, self._saving_adaptation_state = self._saving_adaptation_state, False
+        try:
+            for weight in weights:
+                if max_likelihood - weight <= best_score:
+                    break
+                self._decode_samples(samples, True, *_grammars_activity_cdata(grammars_activity & (grammar_weights == weight), self.num_grammars))
+                decoded_weight = weight
+                output, info = self.get_output()
+                if output and info['likelihood'] - weight > best_score:
+                    best_weight, best_score = weight, info['likelihood'] - weight
+            if best_weight is None and decoded_weight is not None:
+                # No group produced a result, so restore the original one
+                self._decode_samples(samples, True, *_grammars_activity_cdata(grammars_activity, self.num_grammars))
+            elif best_weight is not None and best_weight != decoded_weight:
+                self._decode_samples(samples, True, *_grammars_activity_cdata(grammars_activity & (grammar_weights == best_weight), self.num_grammars))
+        finally:
+            self._saving_adaptation_state = saving_adaptation_state
+        _log.log(13, "%s: chose result with weight %s by grammar_weights", self, best_weight)
 
 
 ########################################################################################################################
 
-class KaldiAgfNNet3Decoder(KaldiNNet3Decoder):
+class KaldiAgfNNet3Decoder(KaldiGrammarNNet3Decoder):
     """docstring for KaldiAgfNNet3Decoder"""
 
+    _decode_function_name = 'nnet3_agf__decode'
+
     _library_header_text = KaldiNNet3Decoder._library_header_text + """
         DRAGONFLY_API void* nnet3_agf__construct(char* model_dir_cp, char* config_str_cp, int32_t verbosity);
         DRAGONFLY_API bool nnet3_agf__destruct(void* model_vp);
@@ -317,9 +748,9 @@ class KaldiAgfNNet3Decoder(KaldiNNet3Decoder):
         model = self._lib.nnet3_agf__construct(en(self.model_dir), en(json.dumps(self.config_dict)), self.verbosity)
         if not model: raise KaldiError("failed nnet3_agf__construct")
         self._model = self._own_native(model, self._lib.nnet3_agf__destruct, 'AGF nnet3 decoder')
-        self.num_grammars = 0
 
     def close(self):
+        self._shutdown_pipeline()
         self._release_native('_model', self._lib.nnet3_agf__destruct, 'AGF nnet3 decoder')
 
     destroy = close
@@ -353,32 +784,20 @@ class KaldiAgfNNet3Decoder(KaldiNNet3Decoder):
         if not result:
             raise KaldiError("error removing grammar #%s" % grammar_fst_index)
         self.num_grammars -= 1
+        self._remove_grammar_from_activity_profiles(grammar_fst_index)
 
-    def decode(self, frames, finalize, grammars_activity=None):
-        """Continue decoding with given new audio data."""
-        # grammars_activity = [True] * self.num_grammars
-        # grammars_activity = np.random.choice([True, False], len(grammars_activity)).tolist(); print grammars_activity; time.sleep(5)
-        if grammars_activity is None:
-            grammars_activity = []
-        else:
-            # Start of utterance
-            _log.log(5, "decode: grammars_activity = %s", ''.join('1' if a else '0' for a in grammars_activity))
-            if len(grammars_activity) != self.num_grammars:
-                _log.error("wrong len(grammars_activity) = %d != %d = num_grammars" % (len(grammars_activity), self.num_grammars))
+    def decode(self, frames, finalize, grammars_activity=None, activity_profile=None, grammar_weights=None):
+        """
+        Continue decoding with given new audio data.
+        :param grammars_activity: at the start of each utterance, which grammars are active: a sequence of bools (one per grammar), or a sparse collection of active grammar ids (see make_grammars_activity_array); None otherwise
+        :param activity_profile: alternatively, at the start of each utterance, name of a profile from define_activity_profile
+        :param grammar_weights: optionally, at the start of each utterance, cost offsets of results of each grammar (see make_grammar_weights_array), without recompilation; these are not applied during decoding (so not to partial outputs, endpointing, or early commit), but by re-decoding the whole utterance when finalized, once per distinct weight, multiplying its finalization latency & CPU
+        """
+        start_of_utterance = (grammars_activity is not None or activity_profile is not None)
+        grammars_activity_array, grammars_activity_cp = self._prepare_grammars_activity(grammars_activity, activity_profile)
 
-        if not isinstance(frames, np.ndarray): frames = np.frombuffer(frames, np.int16)
-        frames = frames.astype(np.float32)
-        frames_char = _ffi.from_buffer(frames)
-        frames_float = _ffi.cast('float *', frames_char)
-
-        self._start_decode_time(len(frames))
-        result = self._lib.nnet3_agf__decode(self._get_model(), self.sample_rate, len(frames), frames_float, finalize,
-            grammars_activity, len(grammars_activity), self._saving_adaptation_state)
-        self._stop_decode_time(finalize)
-
-        if not result:
-            raise KaldiError("decoding error")
-        return finalize
+        return self._decode_utterance_samples(self._prepare_samples(frames), finalize, start_of_utterance,
+            grammars_activity_array, grammars_activity_cp, grammar_weights)
 
 
 ########################################################################################################################
@@ -426,9 +845,11 @@ class KaldiAgfCompiler(FFIObject):
 
 ########################################################################################################################
 
-class KaldiLafNNet3Decoder(KaldiNNet3Decoder):
+class KaldiLafNNet3Decoder(KaldiGrammarNNet3Decoder):
     """docstring for KaldiLafNNet3Decoder"""
 
+    _decode_function_name = 'nnet3_laf__decode'
+
     _library_header_text = KaldiNNet3Decoder._library_header_text + """
         DRAGONFLY_API void* nnet3_laf__construct(char* model_dir_cp, char* config_str_cp, int32_t verbosity);
         DRAGONFLY_API bool nnet3_laf__destruct(void* model_vp);
@@ -456,9 +877,9 @@ class KaldiLafNNet3Decoder(KaldiNNet3Decoder):
         model = self._lib.nnet3_laf__construct(en(self.model_dir), en(json.dumps(self.config_dict)), self.verbosity)
         if not model: raise KaldiError("failed nnet3_laf__construct")
         self._model = self._own_native(model, self._lib.nnet3_laf__destruct, 'LAF nnet3 decoder')
-        self.num_grammars = 0
 
     def close(self):
+        self._shutdown_pipeline()
         self._release_native('_model', self._lib.nnet3_laf__destruct, 'LAF nnet3 decoder')
 
     destroy = close
@@ -494,32 +915,20 @@ class KaldiLafNNet3Decoder(KaldiNNet3Decoder):
         if not result:
             raise KaldiError("error removing grammar #%s" % grammar_fst_index)
         self.num_grammars -= 1
-
-    def decode(self, frames, finalize, grammars_activity=None):
-        """Continue decoding with given new audio data."""
-        # grammars_activity = [True] * self.num_grammars
-        # grammars_activity = np.random.choice([True, False], len(grammars_activity)).tolist(); print grammars_activity; time.sleep(5)
-        if grammars_activity is None:
-            grammars_activity = []
-        else:
-            # Start of utterance
-            _log.log(5, "decode: grammars_activity = %s", ''.join('1' if a else '0' for a in grammars_activity))
-            if len(grammars_activity) != self.num_grammars:
-                _log.error("wrong len(grammars_activity) = %d != %d = num_grammars" % (len(grammars_activity), self.num_grammars))
-
-        if not isinstance(frames, np.ndarray): frames = np.frombuffer(frames, np.int16)
-        frames = frames.astype(np.float32)
-        frames_char = _ffi.from_buffer(frames)
-        frames_float = _ffi.cast('float *', frames_char)
-
-        self._start_decode_time(len(frames))
-        result = self._lib.nnet3_laf__decode(self._get_model(), self.sample_rate, len(frames), frames_float, finalize,
-            grammars_activity, len(grammars_activity), self._saving_adaptation_state)
-        self._stop_decode_time(finalize)
-
-        if not result:
-            raise KaldiError("decoding error")
-        return finalize
+        self._remove_grammar_from_activity_profiles(grammar_fst_index)
+
+    def decode(self, frames, finalize, grammars_activity=None, activity_profile=None, grammar_weights=None):
+        """
+        Continue decoding with given new audio data.
+        :param grammars_activity: at the start of each utterance, which grammars are active: a sequence of bools (one per grammar), or a sparse collection of active grammar ids (see make_grammars_activity_array); None otherwise
+        :param activity_profile: alternatively, at the start of each utterance, name of a profile from define_activity_profile
+        :param grammar_weights: optionally, at the start of each utterance, cost offsets of results of each grammar (see make_grammar_weights_array), without recompilation; these are not applied during decoding (so not to partial outputs, endpointing, or early commit), but by re-decoding the whole utterance when finalized, once per distinct weight, multiplying its finalization latency & CPU
+        """
+        start_of_utterance = (grammars_activity is not None or activity_profile is not None)
+        grammars_activity_array, grammars_activity_cp = self._prepare_grammars_activity(grammars_activity, activity_profile)
+
+        return self._decode_utterance_samples(self._prepare_samples(frames), finalize, start_of_utterance,
+            grammars_activity_array, grammars_activity_cp, grammar_weights)
 
 
 ########################################################################################################################
@@ -231,6 +231,7 @@ setup(
     extras_require={  # Optional
         'g2p_en': ['g2p_en >= 2.1.0'],
         'online': ['requests >= 2.18'],
+        'vad': ['webrtcvad >= 2.0'],
         # 'dev': ['check-manifest'],
         # "test": [
         #     # See requirements-test.txt
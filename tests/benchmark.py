@@ -0,0 +1,151 @@
+#
+# This file is part of kaldi-active-grammar.
+# (c) Copyright 2019 by David Zurow
+# Licensed under the AGPL-3.0; see LICENSE.txt file.
+#
+
+"""
+Standalone benchmarks (not collected by pytest). Run from the tests directory (where the model is), e.g.:
+
+    python benchmark.py rules --sizes 1000 5000 10000
+    python benchmark.py decode --wav some_utterance.wav --chunk_ms 30 --realtime
+
+Rule counts above what the model supports are skipped; convert a model with more rule nonterminals using
+``python -m kaldi_active_grammar convert_generic_model_to_agf --num_rules 10000 ...``.
+"""
+
+import argparse, logging, statistics, time, wave
+
+import numpy as np
+
+from kaldi_active_grammar import Compiler, KaldiRule
+from kaldi_active_grammar.utils import clock
+
+
+def report(desc, times):
+    times_ms = [t * 1000 for t in times]
+    print("  %-32s median %8.2f ms   min %8.2f ms   max %8.2f ms   (n=%d)" % (desc, statistics.median(times_ms), min(times_ms), max(times_ms), len(times_ms)))
+
+def make_word_rule(compiler, name, word):
+    rule = KaldiRule(compiler, name)
+    fst = rule.fst
+    initial_state = fst.add_state(initial=True)
+    final_state = fst.add_state(final=True)
+    fst.add_arc(initial_state, final_state, word)
+    rule.compile()
+    rule.load()
+    return rule
+
+def silence(seconds, sample_rate=16000):
+    return np.zeros(int(seconds * sample_rate), dtype=np.int16).tobytes()
+
+def read_wav(filename):
+    with wave.open(filename, 'rb') as wav_file:
+        assert wav_file.getsampwidth() == 2, "only int16 wav files are supported"
+        return wav_file.readframes(wav_file.getnframes()), wav_file.getframerate(), wav_file.getnchannels()
+
+
+########################################################################################################################
+
+def benchmark_rules(args):
+    """ Cost of supporting (not loading) many rule ids: top FST compilation, decoder construction, and utterance start. """
+    for size in args.sizes:
+        print("max_num_rules=%d" % size)
+        with Compiler(args.model_dir, args.tmp_dir) as probe:
+            supported = probe.max_num_rules
+        if size > supported:
+            print("  skipped: model supports only %d rules" % supported)
+            continue
+
+        with Compiler(args.model_dir, args.tmp_dir, max_num_rules=size) as compiler:
+            start_time = clock()
+            top_fst_rule = compiler.compile_top_fst()
+            report("compile_top_fst", [clock() - start_time])
+            del top_fst_rule
+
+            start_time = clock()
+            decoder = compiler.init_decoder()
+            report("init_decoder", [clock() - start_time])
+
+            words = [word for word in ('hello', 'world', 'testing', 'computer', 'window') if word in compiler.model.words_table]
+            rules = [make_word_rule(compiler, 'Rule%d' % i, words[i % len(words)]) for i in range(args.num_loaded)]
+            activity = [i < args.num_active for i in range(len(rules))]
+            audio = silence(0.03)
+
+            start_times, total_times = [], []
+            for _ in range(args.repeat):
+                start_time = clock()
+                decoder.decode(audio, False, activity)
+                start_times.append(clock() - start_time)
+                decoder.decode(audio, True)
+                total_times.append(clock() - start_time)
+                decoder.get_output()
+            report("utterance start (first decode)", start_times)
+            report("utterance total (2 chunks)", total_times)
+
+
+def benchmark_decode(args):
+    """ Serial vs pipelined decode: time the caller is blocked per chunk, and latency from the final chunk to the result. """
+    if args.wav:
+        audio, sample_rate, num_channels = read_wav(args.wav)
+    else:
+        audio, sample_rate, num_channels = silence(2.0), None, 1
+    bytes_per_second = 2 * num_channels * (sample_rate or 16000)
+    chunk_size = int(args.chunk_ms * bytes_per_second / 1000) // (2 * num_channels) * (2 * num_channels)
+    chunks = [audio[i : i + chunk_size] for i in range(0, len(audio), chunk_size)]
+    print("%d chunks of %d ms%s" % (len(chunks), args.chunk_ms, (", fed in real time" if args.realtime else "")))
+
+    for pipelined in (False, True):
+        print("pipelined=%s" % pipelined)
+        with Compiler(args.model_dir, args.tmp_dir) as compiler:
+            decoder = compiler.init_decoder(sample_rate=sample_rate, num_channels=num_channels, pipelined=pipelined)
+            words = [word for word in ('hello', 'world', 'testing', 'computer', 'window') if word in compiler.model.words_table]
+            rules = [make_word_rule(compiler, 'Rule%d' % i, word) for (i, word) in enumerate(words)]
+            activity = [True] * len(rules)
+
+            chunk_times, final_times = [], []
+            for _ in range(args.repeat):
+                for i, chunk in enumerate(chunks):
+                    start_time = clock()
+                    decoder.decode(chunk, False, (activity if i == 0 else None))
+                    elapsed = clock() - start_time
+                    chunk_times.append(elapsed)
+                    if args.realtime and elapsed < (len(chunk) / bytes_per_second):
+                        time.sleep(len(chunk) / bytes_per_second - elapsed)  # Simulate waiting for audio capture
+                start_time = clock()
+                decoder.decode(b'', True)
+                decoder.get_output()
+                final_times.append(clock() - start_time)
+            report("decode call per chunk (blocked)", chunk_times)
+            report("final chunk to output", final_times)
+
+
+########################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="kaldi-active-grammar benchmarks")
+    parser.add_argument('-m', '--model_dir')
+    parser.add_argument('-t', '--tmp_dir')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_rules = subparsers.add_parser('rules', help=benchmark_rules.__doc__)
+    parser_rules.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser_rules.add_argument('--num_loaded', type=int, default=100, help="number of rules loaded into the decoder")
+    parser_rules.add_argument('--num_active', type=int, default=10, help="number of loaded rules active per utterance")
+    parser_rules.add_argument('--repeat', type=int, default=20)
+    parser_rules.set_defaults(func=benchmark_rules)
+
+    parser_decode = subparsers.add_parser('decode', help=benchmark_decode.__doc__)
+    parser_decode.add_argument('--wav', help="int16 wav file to decode (default: silence)")
+    parser_decode.add_argument('--chunk_ms', type=int, default=30)
+    parser_decode.add_argument('--realtime', action='store_true', help="feed chunks at real-time pace, as from a microphone")
+    parser_decode.add_argument('--repeat', type=int, default=10)
+    parser_decode.set_defaults(func=benchmark_decode)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from kaldi_active_grammar import KaldiError
+from kaldi_active_grammar.wrapper import active_grammar_ids, is_sparse_grammars_activity, make_grammar_weights_array, make_grammars_activity_array
+
+
+@pytest.mark.parametrize('grammars_activity', [
+    [False, True, False, False, True],
+    (False, True, False, False, True),
+    np.array([False, True, False, False, True]),
+    {1, 4},
+    frozenset([4, 1]),
+    np.array([4, 1], dtype=np.int32),
+])
+def test_forms_are_equivalent(grammars_activity):
+    array = make_grammars_activity_array(grammars_activity, 5)
+    assert array.dtype == np.bool_ and array.flags.c_contiguous
+    assert array.tolist() == [False, True, False, False, True]
+    assert sorted(active_grammar_ids(grammars_activity)) == [1, 4]
+
+def test_sparseness():
+    assert is_sparse_grammars_activity({0})
+    assert is_sparse_grammars_activity(range(3))
+    assert is_sparse_grammars_activity(np.array([0, 2]))
+    assert not is_sparse_grammars_activity([True, False])
+    assert not is_sparse_grammars_activity(np.array([True, False]))
+
+def test_bool_array_is_not_copied():
+    grammars_activity = np.zeros(1000, np.bool_)
+    grammars_activity[[3, 999]] = True
+    assert make_grammars_activity_array(grammars_activity, 1000) is grammars_activity
+
+def test_empty():
+    assert make_grammars_activity_array(set(), 3).tolist() == [False, False, False]
+    assert make_grammars_activity_array([], 0).tolist() == []
+
+def test_sparse_id_out_of_range():
+    with pytest.raises(KaldiError):
+        make_grammars_activity_array({3}, 3)
+    with pytest.raises(KaldiError):
+        make_grammars_activity_array({-1}, 3)
+
+def test_grammar_weights():
+    assert make_grammar_weights_array([0, -1.5, 2], 3).tolist() == [0, -1.5, 2]
+    assert make_grammar_weights_array({1: -1.5}, 3).tolist() == [0, -1.5, 0]
+    assert make_grammar_weights_array({}, 2).dtype == np.float32
+    with pytest.raises(KaldiError):
+        make_grammar_weights_array({3: 1.0}, 3)
+    with pytest.raises(KaldiError):
+        make_grammar_weights_array([0, 1], 3)
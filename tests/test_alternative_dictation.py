@@ -0,0 +1,113 @@
+import socket, threading, time
+
+import pytest
+
+from kaldi_active_grammar import KaldiError
+from kaldi_active_grammar.alternative_dictation import AlternativeDictationClient, AlternativeDictationServer, LatencyMetrics
+
+
+class FakeRecognizer:
+    """Stands in for PlainDictationRecognizer, so the server can be tested without a model."""
+
+    def __init__(self):
+        self.calls = []
+        self.closed = False
+
+    def decode_utterance(self, samples_data):
+        if samples_data == b'fail':
+            raise ValueError("decoding failed")
+        self.calls.append(bytes(samples_data))
+        if samples_data == b'slow':
+            time.sleep(0.5)
+        return ('text of %d bytes' % len(samples_data), {})
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def recognizer():
+    return FakeRecognizer()
+
+@pytest.fixture
+def server(recognizer):
+    with AlternativeDictationServer(recognizer) as server:
+        yield server
+    assert not recognizer.closed  # Not owned by the server
+
+
+def test_single_span(server, recognizer):
+    with AlternativeDictationClient(server.url, batch_window=0) as client:
+        assert client(b'\x01\x00' * 100) == 'text of 200 bytes'
+        assert client(b'\x02\x00' * 50) == 'text of 100 bytes'
+    assert recognizer.calls == [b'\x01\x00' * 100, b'\x02\x00' * 50]
+
+def test_connection_is_reused(server):
+    with AlternativeDictationClient(server.url, batch_window=0) as client:
+        client(b'\x00' * 10)
+        connection = client._pool.queue[-1]
+        client(b'\x00' * 10)
+        assert client._pool.queue[-1] is connection
+
+def test_reconnects_after_server_closes_connection(server):
+    with AlternativeDictationClient(server.url, batch_window=0) as client:
+        client(b'\x00' * 10)
+        client._pool.queue[-1].sock.shutdown(socket.SHUT_RDWR)  # Simulate stale pooled connection
+        assert client(b'\x00' * 20) == 'text of 20 bytes'
+
+def test_no_retry_after_timeout(server, recognizer):
+    with AlternativeDictationClient(server.url, timeout=0.1) as client:
+        with pytest.raises(KaldiError):
+            client.recognize_batch([b'slow'])
+    time.sleep(0.6)
+    assert recognizer.calls == [b'slow']
+
+def test_concurrent_spans_are_batched(server, recognizer):
+    requests = []
+    with AlternativeDictationClient(server.url, batch_window=0.5) as client:
+        original_request = client._request
+        client._request = lambda audio_datas: requests.append(len(audio_datas)) or original_request(audio_datas)
+        results = [None] * 3
+        def run(i):
+            results[i] = client(b'\x00' * (2 * (i + 1)))
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    assert results == ['text of 2 bytes', 'text of 4 bytes', 'text of 6 bytes']
+    assert requests == [3]
+
+def test_recognize_batch(server):
+    with AlternativeDictationClient(server.url) as client:
+        assert client.recognize_batch([b'\x00' * 4, b'', b'\x00' * 8]) == ['text of 4 bytes', 'text of 0 bytes', 'text of 8 bytes']
+
+def test_metrics(server):
+    with AlternativeDictationClient(server.url, batch_window=0) as client:
+        for _ in range(5):
+            client(b'\x00' * 10)
+        summary = client.metrics.summary()
+    assert set(summary) == {'queue', 'request', 'decode', 'total'}
+    assert summary['total']['count'] == 5
+    assert 0 <= summary['total']['p50_ms'] <= summary['total']['p95_ms'] <= summary['total']['max_ms']
+
+def test_server_error(server):
+    with AlternativeDictationClient(server.url, batch_window=0) as client:
+        with pytest.raises(KaldiError):
+            client(b'fail')
+        assert client(b'\x00' * 10) == 'text of 10 bytes'
+
+def test_audio_format_mismatch_rejected(recognizer):
+    recognizer.decoder = type('FakeDecoder', (), dict(sample_rate=16000, num_channels=1))()
+    with AlternativeDictationServer(recognizer) as server, AlternativeDictationClient(server.url, batch_window=0) as client:
+        assert client(b'\x00' * 10) == 'text of 10 bytes'
+        for sample_rate, num_channels in [(8000, 1), (16000, 2)]:
+            client.set_audio_format(sample_rate, num_channels)
+            with pytest.raises(KaldiError):
+                client(b'\x00' * 10)
+    assert recognizer.calls == [b'\x00' * 10]
+
+def test_latency_metrics_bounded():
+    metrics = LatencyMetrics(max_samples=3)
+    for seconds in [1, 2, 3, 4]:
+        metrics.record('x', seconds)
+    assert metrics.summary()['x']['count'] == 3
+    assert metrics.summary()['x']['max_ms'] == 4000
@@ -0,0 +1,148 @@
+import math
+import os
+
+import pytest
+
+from kaldi_active_grammar import KaldiError
+from kaldi_active_grammar.dictation_graph import ArpaLanguageModel, DictationGraphBuilder, read_test_set, word_edit_distance
+from kaldi_active_grammar.utils import FSTFileCache
+
+
+class FakeModel(object):
+    nonterm_phones_offset = 100
+    nonterm_words_offset = 200
+
+class FakeCompiler(object):
+    """ Just what DictationGraphBuilder uses of a Compiler, writing fake graphs instead of compiling them. """
+
+    def __init__(self, model_dir):
+        self.model_dir = self.tmp_dir = model_dir
+        self.model = FakeModel()
+        self.files_dict = {}
+        for name in ['L_disambig_fst', 'disambig_int', 'words_txt', 'tree', 'final_mdl']:
+            self.files_dict[name] = os.path.join(model_dir, name)
+            write(self.files_dict[name], name)
+        self.fst_cache = FSTFileCache(os.path.join(model_dir, 'file_cache.json'), tmp_dir=model_dir)
+        self.graphs_built = []
+
+    def _compile_agf_graph(self, input_filename=None, output_filename=None, **kwargs):
+        self.graphs_built.append(output_filename)
+        write(output_filename, 'HCLG')
+
+def write(filename, data):
+    with open(filename, 'w') as f:
+        f.write(data)
+
+@pytest.fixture
+def g_filename(tmp_path):
+    filename = str(tmp_path / 'G.fst')
+    write(filename, 'G')
+    return filename
+
+def test_skips_unchanged(tmp_path, g_filename):
+    compiler = FakeCompiler(str(tmp_path))
+    output_filename = str(tmp_path / 'Dictation.fst')
+    builder = DictationGraphBuilder(compiler)
+    report = builder.build(g_filename, output_filename)
+    assert not report['skipped'] and report['seconds'] >= 0 and os.path.isfile(output_filename)
+    assert builder.build(g_filename, output_filename)['skipped']
+    assert not builder.build(g_filename, output_filename, force=True)['skipped']
+
+    write(g_filename, 'G changed')
+    assert not builder.build(g_filename, output_filename)['skipped']
+    write(compiler.files_dict['L_disambig_fst'], 'L changed')
+    assert not builder.build(g_filename, output_filename)['skipped']
+    write(compiler.files_dict['final_mdl'], 'model changed')
+    assert not builder.build(g_filename, output_filename)['skipped']
+    assert compiler.graphs_built == [output_filename] * 5
+
+    # Persisted across cache instances
+    compiler.fst_cache = FSTFileCache(compiler.fst_cache.cache_filename, tmp_dir=str(tmp_path))
+    assert DictationGraphBuilder(compiler).build(g_filename, output_filename)['skipped']
+
+ARPA_TEXT = """
+\\data\\
+ngram 1=6
+ngram 2=6
+
+\\1-grams:
+-0.69897\t</s>
+-99\t<s>\t-0.3
+-0.5228787\thello\t-0.2
+-0.5228787\tworld\t-0.25
+-1.0\tthere\t-0.1
+-1.0\trare\t-0.1
+
+\\2-grams:
+-0.2\t<s> hello
+-1.5\t<s> rare
+-0.3\thello world
+-0.9\thello there
+-0.1\tworld </s>
+-2.0\trare world
+\\end\\
+"""
+
+@pytest.fixture
+def language_model(tmp_path):
+    filename = str(tmp_path / 'lm.arpa')
+    write(filename, ARPA_TEXT)
+    language_model = ArpaLanguageModel.read(filename)
+    language_model.recompute_backoffs()
+    return language_model
+
+def total_prob(language_model, history):
+    return sum(10 ** language_model.log_prob(history + (word,)) for word in language_model.words if word != '<s>')
+
+def test_arpa_read_write(tmp_path, language_model):
+    assert language_model.num_ngrams_by_order == [6, 6]
+    assert language_model.ngrams[1][('hello', 'world')] == [-0.3, None]
+    filename = str(tmp_path / 'written.arpa')
+    language_model.write(filename)
+    written_language_model = ArpaLanguageModel.read(filename)
+    assert [sorted(ngrams) for ngrams in written_language_model.ngrams] == [sorted(ngrams) for ngrams in language_model.ngrams]
+    assert written_language_model.backoff(('hello',)) == pytest.approx(language_model.backoff(('hello',)))
+    with pytest.raises(KaldiError):
+        write(filename, 'hello world')
+        ArpaLanguageModel.read(filename)
+
+def test_arpa_backoff(language_model):
+    assert language_model.log_prob(('hello', 'world')) == -0.3
+    assert language_model.log_prob(('world', 'hello')) == pytest.approx(language_model.backoff(('world',)) - 0.5228787)
+    for history in [('<s>',), ('hello',), ('world',)]:
+        assert total_prob(language_model, history) == pytest.approx(1.0, abs=0.05)
+
+def test_arpa_prune(language_model):
+    assert language_model.prune(target_num_ngrams=9) == 3
+    assert language_model.num_ngrams_by_order == [6, 3]
+    assert ('hello', 'world') in language_model.ngrams[1] and ('rare', 'world') not in language_model.ngrams[1]
+    assert language_model.ngrams[0][('rare',)][1] is None  # No longer a history
+    assert total_prob(language_model, ('hello',)) == pytest.approx(1.0, abs=0.05)
+    assert language_model.prune(threshold=math.inf) == 3
+    assert language_model.num_ngrams_by_order == [6, 0]
+
+def test_arpa_restrict_vocabulary(language_model):
+    assert language_model.restrict_vocabulary(['hello', 'world']) == 2
+    assert language_model.words == {'<s>', '</s>', 'hello', 'world'}
+    assert language_model.num_ngrams_by_order == [4, 3]
+    assert total_prob(language_model, ()) == pytest.approx(1.0)
+
+def test_arpa_fst_text(language_model):
+    lines = [line.split() for line in language_model.get_fst_text().splitlines()]
+    assert lines[0][0] == '0'  # Start state (<s>) first
+    arcs = [line for line in lines if len(line) == 5]
+    finals = [line for line in lines if len(line) == 2]
+    assert ['hello', 'hello'] in [arc[2:4] for arc in arcs if arc[0] == '0']
+    assert sum(1 for arc in arcs if arc[2] == '#0' and arc[3] == '<eps>') == 4  # <s>, hello, world, rare
+    assert len(finals) == 2  # world (explicitly), and unigram state
+
+def test_word_edit_distance():
+    assert word_edit_distance('a b c'.split(), 'a b c'.split()) == 0
+    assert word_edit_distance('a b c'.split(), 'a x c d'.split()) == 2
+    assert word_edit_distance([], 'a b'.split()) == 2
+    assert word_edit_distance('a b'.split(), []) == 2
+
+def test_read_test_set(tmp_path):
+    filename = str(tmp_path / 'test_set.txt')
+    write(filename, 'one.wav hello world\n\ntwo.wav\n')
+    assert read_test_set(filename) == [(str(tmp_path / 'one.wav'), 'hello world'), (str(tmp_path / 'two.wav'), '')]
@@ -1,9 +1,11 @@
 
+import threading
 from typing import Callable, Optional, Union
 
+import numpy as np
 import pytest
 
-from kaldi_active_grammar import Compiler, KaldiRule, NativeWFST, WFST
+from kaldi_active_grammar import Compiler, KaldiError, KaldiRule, NativeWFST, WFST
 from tests.helpers import *
 
 
@@ -50,14 +52,14 @@ class TestGrammar:
         recognized_rule, words, words_are_dictation_mask = self.compiler.parse_output(output)
         if expected_rule is None:
             assert recognized_rule is None
-            assert words == []
-            assert words_are_dictation_mask == []
+            assert words == ()
+            assert words_are_dictation_mask == ()
         else:
             assert recognized_rule == expected_rule
-            assert words == expected_words
+            assert words == tuple(expected_words)
             if expected_words_are_dictation_mask is None:
                 expected_words_are_dictation_mask = [False] * len(words)
-            assert words_are_dictation_mask == expected_words_are_dictation_mask
+            assert words_are_dictation_mask == tuple(expected_words_are_dictation_mask)
 
     def test_simple_rule(self):
         def _build(fst):
@@ -458,10 +460,341 @@ class TestGrammar:
         text = f"dictate {dictation_words}".strip()
         self.decode(text, [True], rule, expected_words_are_dictation_mask=expected_mask)
 
+    def test_dictation_activity(self):
+        """Test dictation can be disabled for an utterance via the activity of the rules that contain it."""
+        def _build(fst):
+            initial_state = fst.add_state(initial=True)
+            write_state = fst.add_state()
+            dictation_state = fst.add_state()
+            end_state = fst.add_state()
+            final_state = fst.add_state(final=True)
+            fst.add_arc(initial_state, write_state, 'dictate')
+            fst.add_arc(write_state, dictation_state, '#nonterm:dictation')
+            fst.add_arc(dictation_state, end_state, None, '#nonterm:end')
+            fst.add_arc(end_state, final_state, None)
+        dictation_rule = self.make_rule('DictationRule', _build, has_dictation=True)
+        def _build_command(fst):
+            fst.add_arc(fst.add_state(initial=True), fst.add_state(final=True), 'dictate')
+        command_rule = self.make_rule('CommandRule', _build_command, has_dictation=False)
+        assert self.compiler.remove_dictation_activity([True, True]) == [False, True]
+        assert self.compiler.remove_dictation_activity({0, 1}) == {1}
+
+        self.decoder.decode(self.audio_generator("dictate hello world"), True, self.compiler.remove_dictation_activity([True, True]))
+        recognized_rule, words, words_are_dictation_mask = self.compiler.parse_output(self.decoder.get_output()[0])
+        assert recognized_rule in (command_rule, None)
+        assert True not in words_are_dictation_mask
+        self.decode("dictate hello world", [True, True], dictation_rule, expected_words_are_dictation_mask=[False, True, True])
+
+    def test_subgrammar_list(self):
+        """Test a rule referencing a separately compiled list subgrammar, and reloading only the list."""
+        list_rule = KaldiRule(self.compiler, 'ListRule', subgrammar=True)
+        def _build_list(fst, items):
+            initial_state = fst.add_state(initial=True)
+            final_state = fst.add_state(final=True)
+            for item in items:
+                fst.add_arc(initial_state, final_state, item)
+        _build_list(list_rule.fst, ['red', 'green'])
+        list_rule.compile().load()
+
+        rule = KaldiRule(self.compiler, 'ParentRule')
+        initial_state = rule.fst.add_state(initial=True)
+        list_state = rule.fst.add_state()
+        final_state = rule.fst.add_state(final=True)
+        rule.fst.add_arc(initial_state, list_state, 'color')
+        rule.add_subgrammar_arc(list_state, final_state, list_rule)
+        rule.compile().load()
+        assert rule.subgrammar_rules == {list_rule}
+
+        activity = self.compiler.add_subgrammar_activity([False, True])
+        assert activity == [True, True]
+        assert self.compiler.add_subgrammar_activity({1}) == {0, 1}
+        self.decode("color green", activity, rule)
+
+        with list_rule.reload():
+            _build_list(list_rule.fst, ['blue'])
+            list_rule.compile()
+        self.decode("color blue", activity, rule)
+
+    def test_subgrammar_destroy_lower_rule(self):
+        """Test that destroying a rule below a referenced subgrammar keeps the subgrammar's id, so its parent still decodes."""
+        def _build_hello(fst):
+            fst.add_arc(fst.add_state(initial=True), fst.add_state(final=True), 'hello')
+        hello_rule = self.make_rule('HelloRule', _build_hello)
+        def _build_list(fst):
+            fst.add_arc(fst.add_state(initial=True), fst.add_state(final=True), 'green')
+        list_rule = self.make_rule('ListRule', _build_list, subgrammar=True)
+        def _build_parent(fst):
+            list_state = fst.add_state()
+            fst.add_arc(fst.add_state(initial=True), list_state, 'color')
+            parent_rule.add_subgrammar_arc(list_state, fst.add_state(final=True), list_rule)
+        parent_rule = KaldiRule(self.compiler, 'ParentRule')
+        _build_parent(parent_rule.fst)
+        parent_rule.compile().load()
+
+        hello_rule.destroy()
+        assert (list_rule.id, parent_rule.id) == (1, 2)
+        assert self.compiler.num_kaldi_rules == 3
+        self.decode("color green", self.compiler.add_subgrammar_activity([False, False, True]), parent_rule)
+
+        # The vacant id is reused by the next rule
+        new_rule = self.make_rule('NewRule', _build_hello)
+        assert new_rule.id == 0
+        self.decode("hello", [True, False, False], new_rule)
+        self.decode("color green", self.compiler.add_subgrammar_activity([False, False, True]), parent_rule)
+
+    def test_shared_subgrammar(self):
+        """Test a shared subgrammar compiled once and referenced by name from multiple rules."""
+        def _build_digits(fst):
+            initial_state = fst.add_state(initial=True)
+            final_state = fst.add_state(final=True)
+            for word in ['one', 'two', 'three']:
+                fst.add_arc(initial_state, final_state, word)
+        digits_rule = self.compiler.compile_shared_subgrammar('digits', _build_digits)
+        assert self.compiler.get_shared_subgrammar('digits') is digits_rule
+        with pytest.raises(KaldiError):
+            self.compiler.compile_shared_subgrammar('digits', _build_digits)
+
+        def _make_parent(name, prefix):
+            rule = KaldiRule(self.compiler, name)
+            initial_state = rule.fst.add_state(initial=True)
+            digits_state = rule.fst.add_state()
+            final_state = rule.fst.add_state(final=True)
+            rule.fst.add_arc(initial_state, digits_state, prefix)
+            rule.add_subgrammar_arc(digits_state, final_state, 'digits')
+            return rule.compile().load()
+        go_rule = _make_parent('GoRule', 'go')
+        page_rule = _make_parent('PageRule', 'page')
+        assert go_rule.subgrammar_rules == page_rule.subgrammar_rules == {digits_rule}
+
+        self.decode("go two", self.compiler.add_subgrammar_activity([False, True, False]), go_rule)
+        self.decode("page three", self.compiler.add_subgrammar_activity({2}), page_rule)
+
+        with pytest.raises(KaldiError):
+            go_rule.add_subgrammar_arc(0, 1, 'unknown')
+
+    def test_staged_reload(self):
+        """Test that a staged reload keeps the old graph live until swapped in at an utterance boundary."""
+        def _build_hello(fst):
+            initial_state = fst.add_state(initial=True)
+            final_state = fst.add_state(final=True)
+            fst.add_arc(initial_state, final_state, 'hello')
+        rule = self.make_rule('StagedRule', _build_hello)
+        with rule.staged_reload() as fst:
+            initial_state = fst.add_state(initial=True)
+            final_state = fst.add_state(final=True)
+            fst.add_arc(initial_state, final_state, 'world')
+        assert rule.staged_future is not None
+        self.decode("hello", [True], rule)
+
+        rule.staged_future.result(timeout=60)
+        self.compiler.prepare_for_recognition()
+        assert rule.staged_future is None
+        self.decode("world", [True], rule)
+
+    def test_max_num_rules(self):
+        assert self.compiler.max_num_rules == self.compiler.model.count_rule_nonterms()
+        with pytest.raises(KaldiError):
+            Compiler(max_num_rules=self.compiler.max_num_rules + 1)
+        with Compiler(max_num_rules=2) as compiler:
+            decoder = compiler.init_decoder()
+            rules = [KaldiRule(compiler, 'Rule%d' % i) for i in range(2)]
+            with pytest.raises(KaldiError):
+                KaldiRule(compiler, 'Rule2')
+            for rule in rules:
+                rule.fst.add_arc(rule.fst.add_state(initial=True), rule.fst.add_state(final=True), 'hello')
+                rule.compile().load()
+            decoder.decode(self.audio_generator("hello"), True, [False, True])
+            recognized_rule, words, words_are_dictation_mask = compiler.parse_output(decoder.get_output()[0])
+            assert recognized_rule == rules[1]
+            assert words == ('hello',)
+
+    @pytest.mark.parametrize('sample_rate, num_channels', [(None, 2), (32000, 1), (32000, 2)])
+    def test_audio_format(self, sample_rate, num_channels):
+        """Test decoding audio of another sample rate and/or interleaved channels than the model's."""
+        with Compiler() as compiler:
+            decoder = compiler.init_decoder(sample_rate=sample_rate, num_channels=num_channels)
+            assert decoder.sample_rate == (sample_rate or decoder.model_sample_rate)
+            rule = KaldiRule(compiler, 'TestRule')
+            rule.fst.add_arc(rule.fst.add_state(initial=True), rule.fst.add_state(final=True), 'hello')
+            rule.compile().load()
+            samples = np.frombuffer(self.audio_generator("hello"), np.int16)
+            if sample_rate: samples = np.repeat(samples, sample_rate // decoder.model_sample_rate)
+            samples = np.repeat(samples, num_channels)  # Interleave identical channels
+            decoder.decode(samples.tobytes(), True, [True])
+            output, info = decoder.get_output()
+            recognized_rule, words, words_are_dictation_mask = compiler.parse_output(output)
+            assert recognized_rule == rule
+            assert words == ('hello',)
+            word_align = decoder.get_word_align(output)
+            assert word_align[-1][1] < len(samples) * 2
+
+    def test_pipelined_decode(self):
+        """Test pipelined decoding of chunks gives the same result as serial decoding."""
+        with Compiler() as compiler:
+            decoder = compiler.init_decoder(pipelined=True)
+            rule = KaldiRule(compiler, 'TestRule')
+            rule.fst.add_arc(rule.fst.add_state(initial=True), rule.fst.add_state(final=True), 'hello')
+            rule.compile().load()
+            audio_data = self.audio_generator("hello")
+            chunk_size = 2 * 1600
+            for i in range(0, len(audio_data), chunk_size):
+                assert decoder.decode(audio_data[i : i + chunk_size], False, ([True] if i == 0 else None)) is False
+            assert decoder.decode(b'', True) is True
+            assert not decoder._pipeline_futures
+            recognized_rule, words, words_are_dictation_mask = compiler.parse_output(decoder.get_output()[0])
+            assert recognized_rule == rule
+            assert words == ('hello',)
+
+    def test_endpointing(self):
+        """Test decode detects the endpoint after a complete command, before the trailing silence ends."""
+        with Compiler() as compiler:
+            decoder = compiler.init_decoder(endpointing=True)
+            rule = KaldiRule(compiler, 'TestRule')
+            rule.fst.add_arc(rule.fst.add_state(initial=True), rule.fst.add_state(final=True), 'hello')
+            rule.compile().load()
+            audio_data = self.audio_generator("hello") + b'\x00' * (2 * 16000)
+            chunk_size = 2 * 480
+            endpoint_index = None
+            for i in range(0, len(audio_data), chunk_size):
+                if decoder.decode(audio_data[i : i + chunk_size], False, ([True] if i == 0 else None)):
+                    endpoint_index = i
+                    break
+            assert endpoint_index is not None and endpoint_index < len(audio_data) - 16000
+            decoder.decode(b'', True)
+            recognized_rule, words, words_are_dictation_mask = compiler.parse_output(decoder.get_output()[0])
+            assert recognized_rule == rule
+            assert words == ('hello',)
+            assert compiler._get_endpoint_state('#nonterm:rule%d hello' % rule.id) == (True, False, False)
+
+    def test_endpointing_rate_limited(self):
+        """Test endpoint detection only examines the best path when an endpoint is possible, and matches each output once."""
+        with Compiler() as compiler:
+            decoder = compiler.init_decoder(endpointing=True)
+            rule = KaldiRule(compiler, 'TestRule')
+            rule.fst.add_arc(rule.fst.add_state(initial=True), rule.fst.add_state(final=True), 'hello')
+            rule.compile().load()
+            get_output_outputs, endpoint_state_outputs = [], []
+            get_output, endpoint_state_func = decoder.get_output, decoder.endpoint_state_func
+            def counting_get_output(*args, **kwargs):
+                result = get_output(*args, **kwargs)
+                get_output_outputs.append(result[0])
+                return result
+            def counting_endpoint_state_func(output):
+                endpoint_state_outputs.append(output)
+                return endpoint_state_func(output)
+            decoder.get_output, decoder.endpoint_state_func = counting_get_output, counting_endpoint_state_func
+
+            audio_data = self.audio_generator("hello") + b'\x00' * (2 * 16000)
+            chunk_size = 2 * 160
+            num_chunks = 0
+            for i in range(0, len(audio_data), chunk_size):
+                num_chunks += 1
+                if decoder.decode(audio_data[i : i + chunk_size], False, ([True] if i == 0 else None)):
+                    break
+            else:
+                assert False, "no endpoint detected"
+            assert len(get_output_outputs) < num_chunks
+            assert len(endpoint_state_outputs) == len([output for (j, output) in enumerate(get_output_outputs) if j == 0 or output != get_output_outputs[j - 1]])
+            decoder.decode(b'', True)
+
+    def test_early_commit(self):
+        """Test decode commits early to a complete command, before the trailing silence ends."""
+        with Compiler() as compiler:
+            decoder = compiler.init_decoder(early_commit_threshold=0.5)
+            rule = KaldiRule(compiler, 'TestRule')
+            rule.fst.add_arc(rule.fst.add_state(initial=True), rule.fst.add_state(final=True), 'hello')
+            rule.compile().load()
+            audio_data = self.audio_generator("hello") + b'\x00' * (2 * 16000)
+            chunk_size = 2 * 480
+            get_output_calls = []
+            original_get_output = decoder.get_output
+            decoder.get_output = lambda *args, **kwargs: get_output_calls.append(None) or original_get_output(*args, **kwargs)
+            committed_index = None
+            for i in range(0, len(audio_data), chunk_size):
+                if decoder.decode(audio_data[i : i + chunk_size], False, ([True] if i == 0 else None)):
+                    committed_index = i
+                    break
+            assert committed_index is not None and committed_index < len(audio_data) - 16000
+            assert len(get_output_calls) < (committed_index // chunk_size + 1) / 2  # Checked only once per early_commit_interval
+            decoder.get_output = original_get_output
+            output, info = decoder.committed_output
+            assert info['confidence'] >= 0.5
+            recognized_rule, words, words_are_dictation_mask = compiler.parse_output(output)
+            assert recognized_rule == rule
+            assert words == ('hello',)
+            decoder.decode(b'', True)
+            assert decoder.committed_output is None
+
+    def test_grammar_weights(self):
+        """Test per-utterance grammar weights change which rule is recognized, without recompilation."""
+        rules = []
+        for word in ['hello', 'yellow']:
+            def _build(fst):
+                fst.add_arc(fst.add_state(initial=True), fst.add_state(final=True), word)
+            rules.append(self.make_rule('Rule_' + word, _build))
+        audio_data = self.audio_generator("hello")
+        self.decoder.decode(audio_data, True, [True, True], grammar_weights={0: 100.0})
+        recognized_rule, words, words_are_dictation_mask = self.compiler.parse_output(self.decoder.get_output()[0])
+        assert recognized_rule == rules[1]
+        self.decoder.decode(audio_data, True, [True, True], grammar_weights={1: 1.0})
+        recognized_rule, words, words_are_dictation_mask = self.compiler.parse_output(self.decoder.get_output()[0])
+        assert recognized_rule == rules[0]
+        self.decode("hello", [True, True], rules[0])  # Weights only apply to their utterance
+        with pytest.raises(KaldiError):
+            self.decoder.decode(audio_data, False, None, grammar_weights={0: 1.0})
+
     def test_no_rules(self):
         """Test decoding when no rules are defined."""
         self.decode("hello", [], None)
 
+    def test_sparse_activity(self):
+        rules = []
+        for word in ['hello', 'world', 'testing']:
+            def _build(fst):
+                fst.add_arc(fst.add_state(initial=True), fst.add_state(final=True), word)
+            rules.append(self.make_rule(word.capitalize() + 'Rule', _build))
+        self.decode("world", {1}, rules[1])
+        self.decode("testing", np.array([2]), rules[2])
+        self.decode("hello", np.array([True, False, False]), rules[0])
+        self.decode("hello", set(), None)
+
+    def test_activity_profiles(self):
+        rules = []
+        for word in ['hello', 'world', 'testing']:
+            def _build(fst):
+                fst.add_arc(fst.add_state(initial=True), fst.add_state(final=True), word)
+            rules.append(self.make_rule(word.capitalize() + 'Rule', _build))
+        self.decoder.define_activity_profile('editor', [0, 2])
+        self.decoder.define_activity_profile('browser', [1])
+
+        self.decoder.decode(self.audio_generator("world"), True, activity_profile='browser')
+        assert self.compiler.parse_output(self.decoder.get_output()[0])[0] == rules[1]
+        self.decoder.decode(self.audio_generator("testing"), True, activity_profile='editor')
+        assert self.compiler.parse_output(self.decoder.get_output()[0])[0] == rules[2]
+        with pytest.raises(KaldiError):
+            self.decoder.decode(self.audio_generator("hello"), True, [True, True, True], activity_profile='editor')
+        with pytest.raises(KaldiError):
+            self.decoder.decode(self.audio_generator("hello"), True, activity_profile='terminal')
+
+        rules[1].destroy()
+        assert self.decoder.activity_profiles == {'editor': frozenset([0, 1]), 'browser': frozenset()}
+        self.decoder.decode(self.audio_generator("testing"), True, activity_profile='editor')
+        assert self.compiler.parse_output(self.decoder.get_output()[0])[0] == rules[2]
+
+    def test_parse_output_cache(self):
+        def _build(fst):
+            fst.add_arc(fst.add_state(initial=True), fst.add_state(final=True), 'hello')
+        rule = self.make_rule('HelloRule', _build)
+        result = self.compiler.parse_output('#nonterm:rule0 hello')
+        assert result == (rule, ('hello',), (False,))
+        assert self.compiler.parse_output('#nonterm:rule0 hello')[1] is result[1]
+        assert self.compiler.parse_partial_output('#nonterm:rule0 hello') == (rule, ('hello',), (False,), False)
+        assert self.compiler.parse_output('') == (None, (), ())
+
+        rule.destroy()
+        new_rule = self.make_rule('NewRule', _build)
+        assert self.compiler.parse_output('#nonterm:rule0 hello')[0] is new_rule
+
     def test_no_active_rules(self):
         """Test decoding when no rules are active."""
         def _build(fst):
@@ -516,6 +849,136 @@ class TestGrammar:
             self.decode(text, [True], rule)
 
 
+class TestLazyLoadRules:
+    """Tests for loading rule graphs upon first activation."""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, change_to_test_dir, audio_generator):
+        self.compiler = Compiler(lazy_load_rules=True, lazy_unload_timeout=0)
+        self.decoder = self.compiler.init_decoder()
+        self.audio_generator = audio_generator
+        yield
+        self.compiler.close()
+
+    def make_rule(self, name: str, word: str) -> KaldiRule:
+        rule = KaldiRule(self.compiler, name)
+        initial_state = rule.fst.add_state(initial=True)
+        final_state = rule.fst.add_state(final=True)
+        rule.fst.add_arc(initial_state, final_state, word)
+        rule.compile(lazy=True).load(lazy=True)
+        return rule
+
+    def decode(self, text: str, kaldi_rules_activity: list[bool]):
+        self.compiler.prepare_for_recognition(kaldi_rules_activity)
+        self.decoder.decode(self.audio_generator(text), True, kaldi_rules_activity)
+        output, info = self.decoder.get_output()
+        return self.compiler.parse_output(output)
+
+    def test_rules_loaded_only_upon_activation(self):
+        hello_rule = self.make_rule('HelloRule', 'hello')
+        world_rule = self.make_rule('WorldRule', 'world')
+        self.compiler.prepare_for_recognition()
+        assert hello_rule.loaded and world_rule.loaded
+        assert not hello_rule.resident and not world_rule.resident
+
+        kaldi_rule, words, words_are_dictation_mask = self.decode('world', [False, True])
+        assert kaldi_rule == world_rule
+        assert words == ('world',)
+        assert world_rule.resident
+        assert not hello_rule.resident
+
+    def test_inactive_rules_unloaded_after_timeout(self):
+        hello_rule = self.make_rule('HelloRule', 'hello')
+        world_rule = self.make_rule('WorldRule', 'world')
+        self.decode('hello', [True, False])
+        assert hello_rule.resident
+
+        kaldi_rule, words, words_are_dictation_mask = self.decode('world', [False, True])
+        assert kaldi_rule == world_rule
+        assert not hello_rule.resident
+
+        kaldi_rule, words, words_are_dictation_mask = self.decode('hello', [True, False])
+        assert kaldi_rule == hello_rule
+        assert words == ('hello',)
+
+
+class TestBackgroundCompilation:
+    """Tests for compiling queued rules in the background."""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, change_to_test_dir, audio_generator):
+        self.compiler = Compiler(background_compilation=True)
+        self.decoder = self.compiler.init_decoder()
+        self.audio_generator = audio_generator
+        yield
+        self.compiler.close()
+
+    def make_rule(self, name: str, word: str) -> KaldiRule:
+        rule = KaldiRule(self.compiler, name)
+        initial_state = rule.fst.add_state(initial=True)
+        final_state = rule.fst.add_state(final=True)
+        rule.fst.add_arc(initial_state, final_state, word)
+        rule.compile(lazy=True).load(lazy=True)
+        return rule
+
+    def test_compile_future_exposed_and_decodes(self):
+        rule = self.make_rule('HelloRule', 'hello')
+        if rule.compiled:
+            pytest.skip("rule graph was already in the FileCache")
+        assert rule.compile_future is not None
+        assert rule.compile_future.result(timeout=60) is rule
+        self.compiler.prepare_for_recognition([True])
+        assert rule.loaded and rule.resident
+
+        self.decoder.decode(self.audio_generator('hello'), True, [True])
+        output, info = self.decoder.get_output()
+        kaldi_rule, words, words_are_dictation_mask = self.compiler.parse_output(output)
+        assert kaldi_rule == rule
+        assert words == ('hello',)
+
+    def test_only_waits_for_active_rules(self):
+        hello_rule = self.make_rule('HelloRule', 'hello')
+        world_rule = self.make_rule('WorldRule', 'world')
+        self.compiler.prepare_for_recognition([False, True])
+        assert world_rule.compiled and world_rule.loaded and world_rule.resident
+        assert hello_rule.loaded  # Possibly with the placeholder, if still compiling
+        self.decoder.decode(self.audio_generator('world'), True, [False, True])
+        output, info = self.decoder.get_output()
+        kaldi_rule, words, words_are_dictation_mask = self.compiler.parse_output(output)
+        assert kaldi_rule == world_rule
+
+        self.compiler.prepare_for_recognition()
+        assert hello_rule.compiled and hello_rule.resident
+
+    def test_placeholder_replaced_after_compile_finishes_between_utterances(self):
+        release_compile = threading.Event()
+        hello_rule = KaldiRule(self.compiler, 'HelloRule')
+        hello_rule.fst.add_arc(hello_rule.fst.add_state(initial=True), hello_rule.fst.add_state(final=True), 'hello')
+        finish_compile = hello_rule.finish_compile
+        def blocked_finish_compile():
+            release_compile.wait(timeout=60)
+            return finish_compile()
+        hello_rule.finish_compile = blocked_finish_compile
+        hello_rule.compile(lazy=True).load(lazy=True)
+        if hello_rule.compiled:
+            pytest.skip("rule graph was already in the FileCache")
+        world_rule = self.make_rule('WorldRule', 'world')
+        self.compiler.prepare_for_recognition([False, True])
+        assert hello_rule.loaded and not hello_rule.resident
+
+        # Compilation finishes before the next utterance is prepared
+        release_compile.set()
+        hello_rule.compile_future.result(timeout=60)
+        assert hello_rule.compiled
+        self.compiler.prepare_for_recognition([True, False])
+        assert hello_rule.resident
+        self.decoder.decode(self.audio_generator('hello'), True, [True, False])
+        output, info = self.decoder.get_output()
+        kaldi_rule, words, words_are_dictation_mask = self.compiler.parse_output(output)
+        assert kaldi_rule == hello_rule
+        assert words == ('hello',)
+
+
 class TestAlternativeDictation:
     """Tests for alternative dictation feature."""
 
@@ -578,7 +1041,7 @@ class TestAlternativeDictation:
 
         assert len(self.alternative_dictation_calls) == 0
         assert kaldi_rule == rule
-        assert words == ['hello']
+        assert words == ('hello',)
 
     def test_alternative_dictation_integration_full_decode(self, change_to_test_dir):
         """Full integration test: rule with dictation, decode audio, alternative dictation called and replaces text."""
@@ -627,6 +1090,9 @@ class TestAlternativeDictation:
 
         # Get word alignment for alternative dictation
         word_align = decoder.get_word_align(output)
+        word_align_array = decoder.get_word_align_array(output)
+        assert word_align_array['word'].tolist() == [word for (word, time, length) in word_align]
+        assert (word_align_array['start'] * 2).tolist() == [time for (word, time, length) in word_align]
 
         # Create dictation_info_func that returns audio and word_align
         def dictation_info_func():
@@ -699,7 +1165,7 @@ class TestAlternativeDictation:
 
         assert len(self.alternative_dictation_calls) == 1
         assert len(self.alternative_dictation_calls[0]) > 0
-        assert 'ALTERNATIVE_TEXT' in words or words == ['start', 'finish']
+        assert 'ALTERNATIVE_TEXT' in words or words == ('start', 'finish')
 
     @pytest.mark.parametrize('output_text,word_align,audio_size,expected_audio_size', [
         (
@@ -770,6 +1236,186 @@ class TestAlternativeDictation:
 
         assert call_count[0] == 2
 
+    multiple_spans_output_text = '#nonterm:rule0 start #nonterm:dictation_cloud first #nonterm:end middle #nonterm:dictation_cloud second #nonterm:end'
+    multiple_spans_word_align = [
+        ('#nonterm:rule0', 0, 0),
+        ('start', 0, 4000),
+        ('#nonterm:dictation_cloud', 4000, 0),
+        ('first', 4000, 4000),
+        ('#nonterm:end', 8000, 0),
+        ('middle', 8000, 4000),
+        ('#nonterm:dictation_cloud', 12000, 0),
+        ('second', 12000, 4000),
+        ('#nonterm:end', 16000, 0),
+    ]
+
+    def test_alternative_dictation_parallel(self):
+        """Test spans are processed concurrently, with results assembled in order."""
+        import threading
+        barrier = threading.Barrier(2, timeout=5)
+
+        def parallel_alternative_func(audio_data):
+            barrier.wait()  # Deadlocks (times out) unless both spans are in flight at once
+            return 'ALT_%d' % len(audio_data)
+
+        compiler = self.track(Compiler(alternative_dictation=parallel_alternative_func, alternative_dictation_parallel=True))
+        self.create_mock_rule(compiler)
+        kaldi_rule, words, words_are_dictation_mask = self.parse_with_dictation_info(compiler, self.multiple_spans_output_text, b'\x00' * 24000, self.multiple_spans_word_align)
+
+        assert words == ('start', 'ALT_4000', 'middle', 'ALT_12000')
+        assert words_are_dictation_mask == (False, True, False, True)
+
+    def test_alternative_dictation_word_align_array(self):
+        """Test word_align as a structured array in samples (get_word_align_array) gives the same spans as in bytes."""
+        from kaldi_active_grammar.wrapper import KaldiNNet3Decoder
+        word_align_array = np.array([(word, time // 2, length // 2) for (word, time, length) in self.multiple_spans_word_align],
+            dtype=KaldiNNet3Decoder.word_align_dtype)
+        compiler = self.track(Compiler(alternative_dictation=lambda audio_data: 'ALT_%d' % len(audio_data)))
+        self.create_mock_rule(compiler)
+        kaldi_rule, words, words_are_dictation_mask = self.parse_with_dictation_info(compiler, self.multiple_spans_output_text, b'\x00' * 24000, word_align_array)
+
+        assert words == ('start', 'ALT_4000', 'middle', 'ALT_12000')
+        assert words_are_dictation_mask == (False, True, False, True)
+
+    def test_alternative_dictation_parallel_timeout(self):
+        """Test a span that times out falls back to the kaldi text, without affecting other spans."""
+        import time
+        release = []
+
+        def slow_alternative_func(audio_data):
+            if len(audio_data) == 4000:
+                while not release: time.sleep(0.01)
+            return 'ALT'
+
+        compiler = self.track(Compiler(alternative_dictation=slow_alternative_func, alternative_dictation_parallel=True, alternative_dictation_timeout=0.2))
+        self.create_mock_rule(compiler)
+        kaldi_rule, words, words_are_dictation_mask = self.parse_with_dictation_info(compiler, self.multiple_spans_output_text, b'\x00' * 24000, self.multiple_spans_word_align)
+        release.append(True)
+
+        assert words == ('start', 'first', 'middle', 'ALT')
+
+    def test_alternative_dictation_async(self):
+        """Test async callables are awaited concurrently."""
+        import asyncio
+        started = []
+
+        async def async_alternative_func(audio_data):
+            started.append(len(audio_data))
+            while len(started) < 2: await asyncio.sleep(0.01)
+            return 'ALT_%d' % len(audio_data)
+
+        compiler = self.track(Compiler(alternative_dictation=async_alternative_func, alternative_dictation_timeout=5))
+        self.create_mock_rule(compiler)
+        kaldi_rule, words, words_are_dictation_mask = self.parse_with_dictation_info(compiler, self.multiple_spans_output_text, b'\x00' * 24000, self.multiple_spans_word_align)
+
+        assert words == ('start', 'ALT_4000', 'middle', 'ALT_12000')
+
+    def test_alternative_dictation_parse_output_async(self):
+        """Test parse_output_async awaits on the caller's event loop, while parse_output there falls back to the kaldi text."""
+        import asyncio
+
+        async def async_alternative_func(audio_data):
+            await asyncio.sleep(0)
+            return 'ALT_%d' % len(audio_data)
+
+        compiler = self.track(Compiler(alternative_dictation=async_alternative_func))
+        self.create_mock_rule(compiler)
+        def dictation_info_func():
+            return b'\x00' * 24000, self.multiple_spans_word_align
+
+        async def parse():
+            return (await compiler.parse_output_async(self.multiple_spans_output_text, dictation_info_func=dictation_info_func),
+                compiler.parse_output(self.multiple_spans_output_text, dictation_info_func=dictation_info_func))
+        (kaldi_rule, words, words_are_dictation_mask), (_, sync_words, _) = asyncio.run(parse())
+
+        assert words == ('start', 'ALT_4000', 'middle', 'ALT_12000')
+        assert sync_words == ('start', 'first', 'middle', 'second')
+
+    def test_alternative_dictation_async_callable_object_and_partial(self):
+        """Test awaitables returned by callables that are not themselves coroutine functions are awaited too."""
+        import asyncio, functools
+
+        async def async_alternative_func(prefix, audio_data):
+            await asyncio.sleep(0)
+            return '%s_%d' % (prefix, len(audio_data))
+
+        class AsyncAlternativeDictation:
+            async def __call__(self, audio_data):
+                return await async_alternative_func('CALL', audio_data)
+
+        for alternative_dictation, prefix in [(functools.partial(async_alternative_func, 'PARTIAL'), 'PARTIAL'), (AsyncAlternativeDictation(), 'CALL')]:
+            compiler = self.track(Compiler(alternative_dictation=alternative_dictation))
+            self.create_mock_rule(compiler)
+            kaldi_rule, words, words_are_dictation_mask = self.parse_with_dictation_info(compiler, self.multiple_spans_output_text, b'\x00' * 24000, self.multiple_spans_word_align)
+            assert words == ('start', prefix + '_4000', 'middle', prefix + '_12000')
+
+    class MockStreamingAlternativeDictation:
+        """Callable alternative dictation that also supports the speculative streaming protocol."""
+        def __init__(self):
+            self.streams = []
+        def __call__(self, audio_data):
+            return 'CALLED'
+        def start_stream(self):
+            stream = TestAlternativeDictation.MockStream()
+            self.streams.append(stream)
+            return stream
+
+    class MockStream:
+        def __init__(self):
+            self.audio_data = b''
+            self.cancelled = False
+        def feed(self, audio_data):
+            self.audio_data += audio_data
+        def finish(self):
+            return 'STREAMED'
+        def cancel(self):
+            self.cancelled = True
+
+    speculative_partial_word_align = [
+        ('#nonterm:rule0', 0, 0),
+        ('start', 0, 4000),
+        ('#nonterm:dictation_cloud', 4000, 0),
+        ('first', 4000, 4000),
+    ]
+
+    def test_alternative_dictation_speculative(self):
+        """Test the open dictation span is streamed from partials, and only its tail is fed at the end."""
+        alternative_dictation = self.MockStreamingAlternativeDictation()
+        compiler = self.track(Compiler(alternative_dictation=alternative_dictation, alternative_dictation_speculative_delay=0.1))
+        self.create_mock_rule(compiler)
+        audio_data = bytes(range(256)) * 100
+
+        partial_output = '#nonterm:rule0 start #nonterm:dictation_cloud first'
+        compiler.parse_partial_output(partial_output, dictation_info_func=lambda: (audio_data[:5000], self.speculative_partial_word_align))
+        assert alternative_dictation.streams == []  # Not yet long enough
+        compiler.parse_partial_output(partial_output, dictation_info_func=lambda: (audio_data[:12000], self.speculative_partial_word_align))
+        assert len(alternative_dictation.streams) == 1
+        stream = alternative_dictation.streams[0]
+        assert stream.audio_data == audio_data[4000:12000]
+
+        output_text = '#nonterm:rule0 start #nonterm:dictation_cloud first #nonterm:end'
+        word_align = self.speculative_partial_word_align + [('#nonterm:end', 8000, 0)]
+        kaldi_rule, words, words_are_dictation_mask = self.parse_with_dictation_info(compiler, output_text, audio_data[:16000], word_align)
+        assert words == ('start', 'STREAMED')
+        assert stream.audio_data == audio_data[4000:16000]
+        assert not stream.cancelled
+
+    def test_alternative_dictation_speculative_mismatch(self):
+        """Test a stream whose span start does not match the final alignment is discarded in favor of a normal call."""
+        alternative_dictation = self.MockStreamingAlternativeDictation()
+        compiler = self.track(Compiler(alternative_dictation=alternative_dictation, alternative_dictation_speculative_delay=0.1))
+        self.create_mock_rule(compiler)
+        audio_data = b'\x00' * 16000
+
+        compiler.parse_partial_output('#nonterm:rule0 start #nonterm:dictation_cloud first', dictation_info_func=lambda: (audio_data[:12000], self.speculative_partial_word_align))
+        assert len(alternative_dictation.streams) == 1
+
+        output_text = '#nonterm:rule0 start #nonterm:dictation_cloud first #nonterm:end'
+        word_align = [('#nonterm:rule0', 0, 0), ('start', 0, 8000), ('#nonterm:dictation_cloud', 8000, 0), ('first', 8000, 4000), ('#nonterm:end', 12000, 0)]
+        kaldi_rule, words, words_are_dictation_mask = self.parse_with_dictation_info(compiler, output_text, audio_data, word_align)
+        assert words == ('start', 'CALLED')
+        assert alternative_dictation.streams[0].cancelled
+
     @pytest.mark.parametrize('alternative_func,expected_words', [
         (lambda x: None, ['original', 'text']),
         (lambda x: '', ['original', 'text']),
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from kaldi_active_grammar import KaldiError
+from kaldi_active_grammar.vad import EndpointedDecoder, VADEndpointer
+
+
+sample_rate = 16000
+
+def tone(seconds, amplitude=8000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+
+def silence(seconds):
+    return np.zeros(int(seconds * sample_rate), np.int16)
+
+def make_audio():
+    # 0.5s silence, 0.5s tone, 0.5s silence, 0.3s tone, 0.5s silence
+    return np.concatenate((silence(0.5), tone(0.5), silence(0.5), tone(0.3), silence(0.5)))
+
+def utterances(segments):
+    result, current = [], None
+    for audio_data, is_start, is_end in segments:
+        if is_start:
+            assert current is None
+            current = b''
+        assert current is not None
+        current += audio_data
+        if is_end:
+            result.append(current)
+            current = None
+    return result, current
+
+def test_segments_utterances():
+    endpointer = VADEndpointer()
+    segments = endpointer.process(make_audio())
+    result, current = utterances(segments)
+    assert current is None and not endpointer.in_utterance
+    assert len(result) == 2
+    # Each utterance includes its tone, start padding, and the end window of silence, but not the rest of the silence
+    first = np.frombuffer(result[0], np.int16)
+    assert 0.5 * sample_rate < len(first) < 1.0 * sample_rate
+    assert np.count_nonzero(first) >= 0.49 * sample_rate
+
+@pytest.mark.parametrize('chunk_size', [160, 480, 1000, 4096])
+def test_chunking_is_equivalent(chunk_size):
+    audio = make_audio()
+    expected, _ = utterances(VADEndpointer().process(audio))
+    endpointer = VADEndpointer()
+    segments = []
+    for i in range(0, len(audio), chunk_size):
+        segments.extend(endpointer.process(audio[i : i + chunk_size].tobytes()))
+    assert utterances(segments) == (expected, None)
+
+def test_silence_is_dropped():
+    endpointer = VADEndpointer()
+    assert endpointer.process(silence(2.0)) == []
+    assert endpointer.process(tone(0.05)) == []  # Too short to start an utterance
+
+def test_invalid_frame_ms():
+    with pytest.raises(KaldiError):
+        VADEndpointer(sample_rate=16000, frame_ms=0)
+
+
+class FakeDecoder:
+    sample_rate = sample_rate
+
+    def __init__(self, finish_after_calls=None):
+        self.calls = []
+        self.finish_after_calls = finish_after_calls  # Simulates the decoder's own endpointing/early commit
+        self.utterance_calls = 0
+
+    def decode(self, frames, finalize, grammars_activity=None):
+        self.calls.append((len(frames), finalize, grammars_activity))
+        self.utterance_calls = 0 if finalize else (self.utterance_calls + 1)
+        return finalize or (self.finish_after_calls is not None and self.utterance_calls >= self.finish_after_calls)
+
+    def get_output(self):
+        return 'output%d' % len(self.calls), {}
+
+def test_endpointed_decoder():
+    decoder = FakeDecoder()
+    endpointed_decoder = EndpointedDecoder(decoder, grammars_activity_func=lambda: [True])
+    audio = make_audio().tobytes()
+    results = []
+    for i in range(0, len(audio), 960):
+        results.extend(endpointed_decoder.feed(audio[i : i + 960]))
+    assert len(results) == 2
+    assert sum(length for (length, finalize, grammars_activity) in decoder.calls) == sum(len(audio_data) for (output, info, audio_data) in results)
+    assert [finalize for (length, finalize, grammars_activity) in decoder.calls].count(True) == 2
+    assert [grammars_activity for (length, finalize, grammars_activity) in decoder.calls].count([True]) == 2
+    assert endpointed_decoder.flush() is None
+
+def test_endpointed_decoder_flush():
+    decoder = FakeDecoder()
+    endpointed_decoder = EndpointedDecoder(decoder)
+    assert endpointed_decoder.feed(np.concatenate((silence(0.2), tone(0.5)))) == []
+    assert endpointed_decoder.in_utterance
+    output, info, audio_data = endpointed_decoder.flush()
+    assert decoder.calls[-1] == (0, True, None)
+    assert not endpointed_decoder.in_utterance
+
+def test_endpointed_decoder_finished_by_decoder():
+    decoder = FakeDecoder(finish_after_calls=3)
+    endpointed_decoder = EndpointedDecoder(decoder, grammars_activity_func=lambda: [True])
+    audio = make_audio().tobytes()
+    results = []
+    for i in range(0, len(audio), 960):
+        results.extend(endpointed_decoder.feed(audio[i : i + 960]))
+    assert len(results) == 2
+    # Each utterance is finalized once, right after the decoder finished it, and the rest of its audio is dropped
+    assert [finalize for (length, finalize, grammars_activity) in decoder.calls] == [False, False, False, True] * 2
+    assert endpointed_decoder.flush() is None